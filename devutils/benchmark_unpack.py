@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Benchmarks unpacking a generated multi-block xz tar archive with tar alone,
+with a parallel decompressor piped into tar, and with the Python extractor,
+which decompresses the blocks in parallel.
+
+Requires tar and xz on UNIX.
+"""
+
+import argparse
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'utils'))
+from _common import get_logger, add_common_params
+from _extraction import ( #pylint: disable=protected-access
+    _extract_tar_with_python, _extract_tar_with_tar, get_parallel_decompressor)
+sys.path.pop(0)
+
+
+def _generate_archive(archive_path, size, block_size):
+    """Generates a compressible tar.xz archive of about size bytes of data"""
+    tar_path = archive_path.with_suffix('')
+    words = [os.urandom(8).hex().encode() for _ in range(4096)]
+    rng = random.Random(0)
+    file_size = 1 << 20
+    with tarfile.open(str(tar_path), 'w') as tar_file:
+        for index in range(max(size // file_size, 1)):
+            data = b' '.join(rng.choice(words) for _ in range(file_size // 17))
+            tarinfo = tarfile.TarInfo('src/dir{}/file{}.txt'.format(index % 16, index))
+            tarinfo.size = len(data)
+            tar_file.addfile(tarinfo, io.BytesIO(data))
+    # Multi-threaded compression writes multiple blocks, which can be decompressed in parallel
+    subprocess.run(('xz', '-T0', '--block-size={}'.format(block_size), '-f', str(tar_path)),
+                   check=True)
+
+
+def _time_extraction(tar_bin, archive_path, output_dir, method):
+    start_time = time.monotonic()
+    if method == 'Python extractor':
+        output_dir.mkdir()
+        _extract_tar_with_python(archive_path, output_dir, Path('src'), True, None)
+    else:
+        _extract_tar_with_tar(tar_bin, archive_path, output_dir, Path('src'), True, None,
+                              method == 'Parallel decompressor')
+    seconds = time.monotonic() - start_time
+    shutil.rmtree(str(output_dir))
+    return seconds
+
+
+def main():
+    """CLI entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size',
+                        type=int,
+                        default=256,
+                        help='Size of the archive contents in MiB. Default: %(default)s')
+    parser.add_argument('--block-size',
+                        type=int,
+                        default=4,
+                        help='Size of the xz blocks in MiB. Default: %(default)s')
+    parser.add_argument('--runs',
+                        type=int,
+                        default=3,
+                        help='Number of extractions per method. Default: %(default)s')
+    add_common_params(parser)
+    args = parser.parse_args()
+
+    tar_bin = shutil.which('tar')
+    if tar_bin is None or shutil.which('xz') is None:
+        get_logger().error('tar and xz are required')
+        sys.exit(1)
+    decompressor_cmd = get_parallel_decompressor('.xz')
+    if decompressor_cmd is None:
+        get_logger().warning('No parallel xz decompressor found; both methods use tar alone')
+    else:
+        get_logger().info('Parallel decompressor: %s', ' '.join(decompressor_cmd))
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, 'archive.tar.xz')
+        get_logger().info('Generating archive...')
+        _generate_archive(archive_path, args.size << 20, args.block_size << 20)
+        get_logger().info('Archive size: %.1f MiB', archive_path.stat().st_size / (1 << 20))
+        output_dir = Path(tmpdirname, 'out')
+        for method in ('tar alone', 'Parallel decompressor', 'Python extractor'):
+            times = [
+                _time_extraction(tar_bin, archive_path, output_dir, method)
+                for _ in range(args.runs)
+            ]
+            get_logger().info('%s: best %.2fs, mean %.2fs', method, min(times),
+                              sum(times) / len(times))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,27 +6,39 @@
 """
 Checks if files in a list exist.
 
-Used for quick validation of lists in CI checks.
+Used for quick validation of lists in CI checks. Files can also be checked in a
+.tar or .tar.xz source archive using its member index, without unpacking it.
 """
 
 import argparse
 import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'utils'))
+from archive_index import load_index
+sys.path.pop(0)
+
 
 def main():
     """CLI entrypoint"""
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument('root_dir', type=Path, help='The directory to check from')
+    parser.add_argument('root_dir',
+                        type=Path,
+                        help='The directory, or .tar or .tar.xz source archive, to check from')
     parser.add_argument('input_files', type=Path, nargs='+', help='The files lists to check')
     args = parser.parse_args()
 
+    index = load_index(args.root_dir) if args.root_dir.is_file() else None
     for input_name in args.input_files:
         file_iter = filter(
             len, map(str.strip,
                      Path(input_name).read_text(encoding='UTF-8').splitlines()))
         for file_name in file_iter:
-            if not Path(args.root_dir, file_name).exists():
+            if index is None:
+                exists = Path(args.root_dir, file_name).exists()
+            else:
+                exists = Path(file_name).as_posix() in index
+            if not exists:
                 print('ERROR: Path "{}" from file "{}" does not exist.'.format(
                     file_name, input_name),
                       file=sys.stderr)
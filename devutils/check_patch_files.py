@@ -24,6 +24,7 @@ from third_party import unidiff
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'utils'))
 from _common import ENCODING, get_logger, parse_series # pylint: disable=wrong-import-order
+from _patch_bundle import PatchBundle, is_bundle # pylint: disable=wrong-import-order
 sys.path.pop(0)
 
 # File suffixes to ignore for checking unused patches
@@ -34,11 +35,17 @@ def _read_series_file(patches_dir, series_file, join_dir=False):
     """
     Returns a generator over the entries in the series file
 
-    patches_dir is a pathlib.Path to the directory of patches
-    series_file is a pathlib.Path relative to patches_dir
+    patches_dir is a pathlib.Path to the directory of patches, or a patch bundle
+    series_file is a pathlib.Path relative to patches_dir. It is ignored for bundles.
 
-    join_dir indicates if the patches_dir should be joined with the series entries
+    join_dir indicates if the patches_dir should be joined with the series entries.
+        For bundles, the BundledPatch of each entry is generated instead.
     """
+    if is_bundle(patches_dir):
+        bundle = PatchBundle(patches_dir)
+        for entry in bundle.series:
+            yield bundle.get_patch(entry) if join_dir else entry
+        return
     for entry in parse_series(patches_dir / series_file):
         if join_dir:
             yield patches_dir / entry
@@ -79,6 +86,9 @@ def check_unused_patches(patches_dir, series_path=Path('series')):
 
     Returns True if there are unused patches; False otherwise.
     """
+    if is_bundle(patches_dir):
+        # Bundles only contain the patches of their series
+        return False
     unused_patches = set()
     for path in patches_dir.rglob('*'):
         if path.is_dir():
@@ -122,7 +132,8 @@ def main():
                         '--patches',
                         type=Path,
                         default=default_patches_dir,
-                        help='Path to the patches directory to use. Default: %(default)s')
+                        help=('Path to the patches directory or patch bundle to use. '
+                              'Default: %(default)s'))
     args = parser.parse_args()
 
     warnings = False
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Finds the patches affected by changes to the Chromium source files they modify
+
+The impact index records the lines of the upstream files each hunk of the patches
+depends on, and the hashes of the upstream files it was built from. Hunks of later
+patches are mapped back through the earlier patches modifying the same file. Given the
+old and new versions of the files, only patches with hunks overlapping changed lines
+can fail to apply. With manifests of file hashes instead of source trees, all hunks of
+changed files are considered affected.
+"""
+
+import argparse
+import difflib
+import hashlib
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'third_party'))
+import unidiff
+sys.path.pop(0)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'utils'))
+from domain_substitution import TREE_ENCODINGS
+from _common import ENCODING, get_logger, parse_series, add_common_params
+from _patch_bundle import PatchBundle, is_bundle
+sys.path.pop(0)
+
+# Version of the impact index format
+_INDEX_VERSION = 1
+
+
+def decode_file_lines(raw_content, file_path):
+    """Returns the list of lines of the source file file_path with the raw_content bytes"""
+    content = None
+    for encoding in TREE_ENCODINGS:
+        try:
+            content = raw_content.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    if not content:
+        raise UnicodeDecodeError('Unable to decode with any encoding: %s' % file_path)
+    return content.split('\n')
+
+
+def hash_file_lines(file_lines):
+    """Returns the hash of a source file from its lines from decode_file_lines()"""
+    return hashlib.sha256('\n'.join(file_lines).encode(ENCODING, 'surrogatepass')).hexdigest()
+
+
+def read_patches(patches_path, series_path):
+    """
+    Returns a dict of the names of the patches in the series to their text, in series order
+
+    patches_path is the pathlib.Path of the patches directory or patch bundle.
+    series_path is the pathlib.Path of the series file. It is ignored for bundles.
+    """
+    patch_texts = dict()
+    if is_bundle(patches_path):
+        bundle = PatchBundle(patches_path)
+        for name in bundle.series:
+            patch_texts[name] = bundle.read_patch(name).decode(ENCODING)
+    else:
+        for name in parse_series(series_path):
+            patch_texts[name] = (patches_path / name).read_text(encoding=ENCODING)
+    return patch_texts
+
+
+def _get_regions(patched_file):
+    """
+    Returns (source start, source length, target start, target length) of the hunks,
+    with the start of empty regions at the line after the position of the hunk
+    """
+    regions = []
+    for hunk in patched_file:
+        source_start = hunk.source_start if hunk.source_length else hunk.source_start + 1
+        target_start = hunk.target_start if hunk.target_length else hunk.target_start + 1
+        regions.append((source_start, hunk.source_length, target_start, hunk.target_length))
+    return regions
+
+
+def _map_line(line, regions, last):
+    """
+    Returns the line number before applying hunks with regions of the line after applying
+    them. Lines added by a hunk are mapped to the first or last line it replaced.
+    """
+    offset = 0
+    for source_start, source_length, target_start, target_length in regions:
+        if line < target_start:
+            break
+        if line < target_start + target_length:
+            return source_start + source_length - 1 if last else source_start
+        offset = source_start + source_length - target_start - target_length
+    return line + offset
+
+
+def get_hunk_ranges(patch_sets): #pylint: disable=too-many-locals
+    """
+    Returns the lines of the upstream files the hunks of patches depend on
+
+    patch_sets is a dict of patch names to unidiff.PatchSet, in series order.
+
+    Returns a dict of patch names to dicts of the relative paths of the files they modify
+    to a list of [first line, end line) of each hunk in the upstream file, or None if the
+    file is added by the patches.
+    """
+    # Relative paths to the list of regions of each patch applied to the file so far,
+    # or None for files added by patches
+    applied_regions = dict()
+    hunk_ranges = dict()
+    for name, patch_set in patch_sets.items():
+        file_ranges = hunk_ranges[name] = dict()
+        for patched_file in patch_set:
+            history = applied_regions.get(patched_file.path, [])
+            if history is None or (patched_file.is_added_file and not history):
+                file_ranges[patched_file.path] = applied_regions[patched_file.path] = None
+                continue
+            regions = _get_regions(patched_file)
+            ranges = []
+            for source_start, source_length, _, _ in regions:
+                if source_length:
+                    first, end = source_start, source_start + source_length
+                else:
+                    # The hunk depends on the lines around its position
+                    first, end = source_start - 1, source_start + 1
+                for earlier_regions in reversed(history):
+                    mapped_first = _map_line(first, earlier_regions, False)
+                    end = max(_map_line(end - 1, earlier_regions, True) + 1, mapped_first + 1)
+                    first = mapped_first
+                ranges.append([first, end])
+            file_ranges[patched_file.path] = ranges
+            history.append(regions)
+            applied_regions[patched_file.path] = history
+    return hunk_ranges
+
+
+def build_index(patch_texts, file_hashes):
+    """
+    Returns the impact index of patches
+
+    patch_texts is a dict of patch names to their text, in series order
+    file_hashes is a dict of the relative paths of upstream files modified by the patches
+        to their hash from hash_file_lines(), or None if they do not exist.
+    """
+    hunk_ranges = get_hunk_ranges({
+        name: unidiff.PatchSet(text)
+        for name, text in patch_texts.items()
+    })
+    index = {'version': _INDEX_VERSION, 'patches': dict(), 'files': dict()}
+    for name, text in patch_texts.items():
+        index['patches'][name] = {
+            'sha256': hashlib.sha256(text.encode(ENCODING)).hexdigest(),
+            'files': hunk_ranges[name],
+        }
+        for file_path in hunk_ranges[name]:
+            index['files'][file_path] = file_hashes.get(file_path)
+    return index
+
+
+def load_impact_index(index_path):
+    """Returns the impact index at index_path. Raises ValueError if it is invalid."""
+    with index_path.open(encoding=ENCODING) as index_file:
+        index = json.load(index_file)
+    if index.get('version') != _INDEX_VERSION:
+        raise ValueError('Unsupported impact index version: {}'.format(index_path))
+    return index
+
+
+def write_impact_index(index_path, index):
+    """Writes the impact index to index_path"""
+    with index_path.open('w', encoding=ENCODING) as index_file:
+        json.dump(index, index_file, indent=1, sort_keys=True)
+
+
+def get_changed_ranges(old_lines, new_lines):
+    """
+    Returns a list of [first line, end line) of old_lines changed in new_lines.
+    Lines inserted before a line are an empty range at that line.
+    """
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [[first + 1, end + 1] for tag, first, end, _, _ in matcher.get_opcodes()
+            if tag != 'equal']
+
+
+def _overlaps(hunk_range, changed_range):
+    first, end = hunk_range
+    changed_first, changed_end = changed_range
+    if changed_first == changed_end:
+        # Lines inserted between two lines of the hunk
+        return first < changed_first < end
+    return changed_first < end and first < changed_end
+
+
+def get_affected_hunks(index, changes, patch_texts=None):
+    """
+    Returns the hunks of patches affected by changes of upstream files
+
+    index is the impact index
+    changes is a dict of the relative paths of changed upstream files to their changed
+        ranges from get_changed_ranges(), or None if all lines may have changed.
+    patch_texts is a dict of patch names to their current text. Patches that are not
+        in the index or changed since are affected entirely. Patches in the index but not
+        in patch_texts were removed from the series and are skipped.
+
+    Returns a dict of affected patch names to dicts of relative paths to the list of the
+    numbers of the affected hunks of the file, or None if all hunks are affected.
+    """
+    affected = dict()
+    for name, entry in index['patches'].items():
+        if patch_texts is not None and name not in patch_texts:
+            continue
+        for file_path, ranges in entry['files'].items():
+            if file_path not in changes:
+                continue
+            if ranges is None or changes[file_path] is None:
+                affected.setdefault(name, dict())[file_path] = None
+                continue
+            hunks = [
+                hunk_num for hunk_num, hunk_range in enumerate(ranges, start=1) if any(
+                    _overlaps(hunk_range, x) for x in changes[file_path])
+            ]
+            if hunks:
+                affected.setdefault(name, dict())[file_path] = hunks
+    for name, text in (patch_texts or dict()).items():
+        entry = index['patches'].get(name)
+        if entry is None or entry['sha256'] != hashlib.sha256(text.encode(ENCODING)).hexdigest():
+            affected[name] = {file_path: None for file_path in entry['files']} if entry else {}
+    return affected
+
+
+def _read_tree_lines(tree_path, file_path):
+    try:
+        return decode_file_lines((tree_path / file_path).read_bytes(), file_path)
+    except FileNotFoundError:
+        return None
+
+
+def _read_manifest(manifest_path):
+    """Returns the dict of relative paths to hashes of a manifest written by "manifest" """
+    file_hashes = dict()
+    with manifest_path.open(encoding=ENCODING) as manifest_file:
+        for line in manifest_file:
+            if line.strip():
+                file_hash, file_path = line.rstrip('\n').split(' ', 1)
+                file_hashes[file_path.lstrip(' ')] = file_hash
+    return file_hashes
+
+
+def _get_file_version(source, file_path):
+    """Returns the hash and the lines of file_path in source, or None if unavailable"""
+    if isinstance(source, dict):
+        value = source.get(file_path)
+        if isinstance(value, list):
+            return hash_file_lines(value), value
+        return value, None
+    lines = _read_tree_lines(source, file_path)
+    return (None if lines is None else hash_file_lines(lines)), lines
+
+
+def get_changes(index, old_source, new_source):
+    """
+    Returns the changes of the upstream files of the index for get_affected_hunks()
+
+    old_source and new_source are pathlib.Path of source trees, or dicts of relative paths
+    to file hashes, like from manifests, or to lists of lines from decode_file_lines().
+    Missing files in dicts do not exist.
+
+    Changed lines are only found when both versions of a file have lines, and the old
+    version is the one the index was built from. Otherwise all lines may have changed.
+    """
+    changes = dict()
+    for file_path, index_hash in index['files'].items():
+        old_hash, old_lines = _get_file_version(old_source, file_path)
+        new_hash, new_lines = _get_file_version(new_source, file_path)
+        if old_hash == new_hash:
+            continue
+        if old_lines is not None and new_lines is not None and old_hash == index_hash:
+            changes[file_path] = get_changed_ranges(old_lines, new_lines)
+        else:
+            changes[file_path] = None
+    return changes
+
+
+def _build_callback(args):
+    patch_texts = read_patches(args.patches, args.series)
+    index = build_index(patch_texts, dict())
+    file_hashes = dict()
+    for file_path in index['files']:
+        lines = _read_tree_lines(args.tree, file_path)
+        file_hashes[file_path] = None if lines is None else hash_file_lines(lines)
+    write_impact_index(args.index, build_index(patch_texts, file_hashes))
+    get_logger().info('Indexed %d patches modifying %d files', len(patch_texts), len(file_hashes))
+
+
+def _manifest_callback(args):
+    index = load_impact_index(args.index)
+    with args.output.open('w', encoding=ENCODING) as manifest_file:
+        for file_path in sorted(index['files']):
+            lines = _read_tree_lines(args.tree, file_path)
+            if lines is not None:
+                manifest_file.write('{}  {}\n'.format(hash_file_lines(lines), file_path))
+
+
+def get_source(source_path):
+    """Returns the source tree or manifest at source_path for get_changes()"""
+    if source_path.is_dir():
+        return source_path
+    return _read_manifest(source_path)
+
+
+def _affected_callback(args):
+    index = load_impact_index(args.index)
+    if args.old:
+        old_source = get_source(args.old)
+    else:
+        old_source = index['files']
+    patch_texts = None
+    if args.patches:
+        patch_texts = read_patches(args.patches, args.series)
+        for name in index['patches']:
+            if name not in patch_texts:
+                get_logger().warning('Skipping patch removed from the series: %s', name)
+    affected = get_affected_hunks(index, get_changes(index, old_source, get_source(args.new)),
+                                  patch_texts)
+    series = list(patch_texts or index['patches'])
+    for name in sorted(affected, key=series.index):
+        print(name)
+        for file_path, hunks in sorted(affected[name].items()):
+            if hunks is None:
+                print('    {}: all hunks'.format(file_path))
+            else:
+                print('    {}: hunks {}'.format(file_path, ', '.join(map(str, hunks))))
+    get_logger().info('%d of %d patches are affected', len(affected), len(series))
+
+
+def main():
+    """CLI Entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_common_params(parser)
+    subparsers = parser.add_subparsers(title='Impact index actions', dest='action', required=True)
+
+    def _add_patches_params(subparser, default):
+        if default is None:
+            patches_help = 'The patches directory or patch bundle.'
+        else:
+            patches_help = 'The patches directory or patch bundle. Default: %(default)s'
+        subparser.add_argument('-p', '--patches', type=Path, default=default, help=patches_help)
+        subparser.add_argument('-s',
+                               '--series',
+                               type=Path,
+                               help=('The series file of a patches directory. '
+                                     'Default: series in the patches directory'))
+
+    build_parser = subparsers.add_parser('build',
+                                         help='Build the impact index of a series',
+                                         description='Builds the impact index of a series.')
+    _add_patches_params(build_parser, Path('patches'))
+    build_parser.add_argument('tree', type=Path, help='The unmodified source tree.')
+    build_parser.add_argument('index', type=Path, help='The impact index to write.')
+    build_parser.set_defaults(callback=_build_callback)
+
+    manifest_parser = subparsers.add_parser(
+        'manifest',
+        help='Write a manifest of the files in the index',
+        description=('Writes the hashes of the files of a source tree modified by the '
+                     'patches of the index, to compare source trees that are not available '
+                     'at the same time.'))
+    manifest_parser.add_argument('index', type=Path, help='The impact index.')
+    manifest_parser.add_argument('tree', type=Path, help='The unmodified source tree.')
+    manifest_parser.add_argument('output', type=Path, help='The manifest to write.')
+    manifest_parser.set_defaults(callback=_manifest_callback)
+
+    affected_parser = subparsers.add_parser(
+        'affected',
+        help='List the patches affected by changes of the source',
+        description=('Lists the patches and hunks affected by the changes between two '
+                     'source trees or manifests. If --patches is given, patches changed '
+                     'since the index was built are listed too, and patches removed from '
+                     'the series are skipped.'))
+    _add_patches_params(affected_parser, None)
+    affected_parser.add_argument(
+        '--old',
+        type=Path,
+        help=('The old source tree or manifest. '
+              'Default: the hashes of the source the index was built from'))
+    affected_parser.add_argument('index', type=Path, help='The impact index.')
+    affected_parser.add_argument('new', type=Path, help='The new source tree or manifest.')
+    affected_parser.set_defaults(callback=_affected_callback)
+
+    args = parser.parse_args()
+    if getattr(args, 'patches', None) and args.series is None:
+        args.series = args.patches / 'series'
+    args.callback(args)
+
+
+if __name__ == '__main__':
+    main()
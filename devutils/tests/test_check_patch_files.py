@@ -12,10 +12,12 @@ from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent / 'utils'))
 from _common import get_logger, set_logging_level
+from _patch_bundle import write_bundle
 sys.path.pop(0)
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-from check_patch_files import check_series_duplicates
+from check_patch_files import (check_patch_readability, check_series_duplicates,
+                               check_unused_patches)
 sys.path.pop(0)
 
 
@@ -46,5 +48,26 @@ def test_check_series_duplicates():
         assert check_series_duplicates(patches_dir)
 
 
+def test_check_patch_bundle():
+    """Test checks of patch bundles"""
+
+    set_logging_level(logging.DEBUG)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        bundle_path = Path(tmpdirname, 'patches.bundle')
+        patch_data = {
+            'a.patch': b'--- a/a.txt\n+++ b/a.txt\n@@ -1 +1 @@\n-a\n+b\n',
+            'b.patch': b'--- a/b.txt\n+++ b/b.txt\n@@ -1 +1 @@\n-a\n',
+        }
+        write_bundle(bundle_path, ['a.patch'], patch_data)
+        assert not check_patch_readability(bundle_path)
+        assert not check_series_duplicates(bundle_path)
+        assert not check_unused_patches(bundle_path)
+
+        write_bundle(bundle_path, ['a.patch', 'b.patch', 'a.patch'], patch_data)
+        assert check_patch_readability(bundle_path)
+        assert check_series_duplicates(bundle_path)
+
+
 if __name__ == '__main__':
     test_check_series_duplicates()
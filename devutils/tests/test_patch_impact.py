@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""Test patch_impact.py"""
+
+import logging
+import tempfile
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent / 'utils'))
+from _common import set_logging_level
+sys.path.pop(0)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import patch_impact
+import validate_patches
+sys.path.pop(0)
+
+_ORIGINAL_LINES = ['line{}'.format(x) for x in range(1, 11)] + ['']
+
+_PATCH_TEXTS = {
+    '1.patch': ('--- a/a.txt\n+++ b/a.txt\n@@ -1,3 +1,4 @@\n'
+                ' line1\n-line2\n+LINE2\n+extra\n line3\n'),
+    '2.patch': ('--- a/a.txt\n+++ b/a.txt\n@@ -7,3 +7,3 @@\n'
+                ' line6\n-line7\n+LINE7\n line8\n'),
+    '3.patch': '--- /dev/null\n+++ b/b.txt\n@@ -0,0 +1 @@\n+new\n',
+}
+
+
+def test_hunk_ranges():
+    """Test mapping hunks of later patches to upstream lines"""
+    hunk_ranges = patch_impact.get_hunk_ranges({
+        name: patch_impact.unidiff.PatchSet(text)
+        for name, text in _PATCH_TEXTS.items()
+    })
+    assert hunk_ranges == {
+        '1.patch': {
+            'a.txt': [[1, 4]]
+        },
+        '2.patch': {
+            'a.txt': [[6, 9]]
+        },
+        '3.patch': {
+            'b.txt': None
+        },
+    }
+
+
+def test_affected_hunks():
+    """Test finding the patches affected by changes of the source"""
+
+    #pylint: disable=protected-access
+    set_logging_level(logging.DEBUG)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        old_tree = Path(tmpdirname, 'old')
+        new_tree = Path(tmpdirname, 'new')
+        for tree_path in (old_tree, new_tree):
+            tree_path.mkdir()
+            (tree_path / 'a.txt').write_text('\n'.join(_ORIGINAL_LINES))
+        file_hashes = {'a.txt': patch_impact.hash_file_lines(_ORIGINAL_LINES)}
+        index = patch_impact.build_index(_PATCH_TEXTS, file_hashes)
+        assert index['files'] == {'a.txt': file_hashes['a.txt'], 'b.txt': None}
+
+        # Unrelated changes
+        new_lines = list(_ORIGINAL_LINES)
+        new_lines[4] = 'line5 changed'
+        new_lines.insert(9, 'inserted')
+        (new_tree / 'a.txt').write_text('\n'.join(new_lines))
+        changes = patch_impact.get_changes(index, old_tree, new_tree)
+        assert changes == {'a.txt': [[5, 6], [10, 10]]}
+        assert not patch_impact.get_affected_hunks(index, changes, _PATCH_TEXTS)
+
+        # Changes of lines the hunks depend on, and of files added by patches
+        new_lines.insert(1, 'inserted')
+        new_lines[8] = 'line8 changed'
+        (new_tree / 'a.txt').write_text('\n'.join(new_lines))
+        (new_tree / 'b.txt').write_text('new\n')
+        changes = patch_impact.get_changes(index, old_tree, new_tree)
+        assert patch_impact.get_affected_hunks(index, changes) == {
+            '1.patch': {
+                'a.txt': [1]
+            },
+            '2.patch': {
+                'a.txt': [1]
+            },
+            '3.patch': {
+                'b.txt': None
+            },
+        }
+
+        # Changed patches and manifests of hashes
+        patch_texts = dict(_PATCH_TEXTS)
+        patch_texts['1.patch'] = patch_texts['1.patch'].replace('extra', 'more')
+        changes = patch_impact.get_changes(index, index['files'], index['files'])
+        assert not changes
+        assert patch_impact.get_affected_hunks(index, changes, patch_texts) == {
+            '1.patch': {
+                'a.txt': None
+            }
+        }
+        changes = patch_impact.get_changes(index, index['files'], {})
+        assert changes == {'a.txt': None}
+        assert set(patch_impact.get_affected_hunks(index, changes)) == {'1.patch', '2.patch'}
+
+        # Changed lines are found with the lines of the files, like from validate_patches.py
+        new_lines = list(_ORIGINAL_LINES)
+        new_lines[4] = 'line5 changed'
+        changes = patch_impact.get_changes(index, old_tree, {'a.txt': new_lines})
+        assert changes == {'a.txt': [[5, 6]]}
+        changes = patch_impact.get_changes(index, index['files'], {'a.txt': new_lines})
+        assert changes == {'a.txt': None}
+
+        # validate_patches selects the affected patches and their chains
+        _, patch_cache = validate_patches._load_all_patches(
+            _PATCH_TEXTS, _write_patches(Path(tmpdirname, 'patches')))
+        assert validate_patches._get_affected_series(list(_PATCH_TEXTS), patch_cache, _PATCH_TEXTS,
+                                                     index, {'a.txt': [[5, 6]]}) == ()
+        assert validate_patches._get_affected_series(list(_PATCH_TEXTS), patch_cache, _PATCH_TEXTS,
+                                                     index,
+                                                     {'a.txt': None}) == ('1.patch', '2.patch')
+        assert validate_patches._get_affected_series(list(_PATCH_TEXTS), patch_cache, patch_texts,
+                                                     index, {}) == ('1.patch', '2.patch')
+
+
+def _write_patches(patches_dir):
+    patches_dir.mkdir()
+    for name, text in _PATCH_TEXTS.items():
+        (patches_dir / name).write_text(text)
+    return patches_dir
+
+
+def test_affected_removed_patch(capsys, monkeypatch):
+    """Test listing the affected patches after a patch was removed from the series"""
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        index_path = Path(tmpdirname, 'index.json')
+        file_hashes = {'a.txt': patch_impact.hash_file_lines(_ORIGINAL_LINES)}
+        patch_impact.write_impact_index(index_path,
+                                        patch_impact.build_index(_PATCH_TEXTS, file_hashes))
+        patches_dir = _write_patches(Path(tmpdirname, 'patches'))
+        (patches_dir / 'series').write_text('1.patch\n3.patch\n')
+        patch_texts = patch_impact.read_patches(patches_dir, patches_dir / 'series')
+        index = patch_impact.load_impact_index(index_path)
+        changes = {'a.txt': None}
+        assert set(patch_impact.get_affected_hunks(index, changes)) == {'1.patch', '2.patch'}
+        assert set(patch_impact.get_affected_hunks(index, changes, patch_texts)) == {'1.patch'}
+
+        new_tree = Path(tmpdirname, 'new')
+        new_tree.mkdir()
+        monkeypatch.setattr(sys, 'argv', [
+            'patch_impact.py', 'affected', '--patches',
+            str(patches_dir),
+            str(index_path),
+            str(new_tree)
+        ])
+        patch_impact.main()
+        assert capsys.readouterr().out == '1.patch\n    a.txt: all hunks\n'
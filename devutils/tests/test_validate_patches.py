@@ -5,8 +5,15 @@
 # found in the LICENSE file.
 """Test validate_patches.py"""
 
+import base64
+import contextlib
+import http.server
 import logging
+import lzma
+import tarfile
 import tempfile
+import threading
+import time
 import sys
 from pathlib import Path
 
@@ -73,5 +80,156 @@ def test_test_patches():
     assert _run_test_patches(patch_content)
 
 
+def test_retrieve_archive_files():
+    """Test _retrieve_archive_files reads the same files as _retrieve_local_files"""
+
+    #pylint: disable=protected-access
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_dir = Path(tmpdirname, 'chromium-1.0')
+        Path(source_dir, 'chrome').mkdir(parents=True)
+        Path(source_dir, 'chrome', 'foo.cc').write_text('foo\nbar\n')
+        Path(source_dir, 'baz.txt').write_text('baz')
+        Path(source_dir, 'dangling.txt').symlink_to('missing.txt')
+        archive_path = Path(tmpdirname, 'chromium-1.0.tar.xz')
+        with lzma.open(str(archive_path), 'w') as xz_file, \
+                tarfile.open(fileobj=xz_file, mode='w') as tar_file:
+            tar_file.add(str(source_dir), arcname='chromium-1.0')
+
+        # Directories and dangling links are missing files
+        required_files = [
+            Path('chrome', 'foo.cc'),
+            Path('baz.txt'),
+            Path('missing.txt'),
+            Path('chrome'),
+            Path('dangling.txt'),
+        ]
+        files_under_test = validate_patches._retrieve_archive_files(required_files, archive_path)
+        assert files_under_test == validate_patches._retrieve_local_files(
+            required_files, source_dir)
+        assert files_under_test[Path('chrome', 'foo.cc')] == ['foo', 'bar', '']
+        assert set(files_under_test) == {Path('chrome', 'foo.cc'), Path('baz.txt')}
+
+
+class _GitilesRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves files like gitiles with format=TEXT, from memory"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        pass
+
+    def do_GET(self): #pylint: disable=invalid-name
+        """Handle GET requests"""
+        path = self.path.split('?', 1)[0]
+        with self.server.lock:
+            self.server.requests.append(path)
+            self.server.request_times.append(time.monotonic())
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.in_flight -= 1
+            retry_later = path in self.server.retry_after
+            self.server.retry_after.discard(path)
+        if retry_later:
+            self.server.retry_after_times.append(time.monotonic())
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if path not in self.server.files:
+            self.send_error(404)
+            return
+        body = base64.b64encode(self.server.files[path].encode())
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextlib.contextmanager
+def _serve_gitiles(files, retry_after=(), latency=0.05):
+    """
+    Context manager yielding a local fake gitiles server and its base URL
+
+    files is a dict of URL paths to the text of the files
+    retry_after is the URL paths to answer once with HTTP 429 and Retry-After
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _GitilesRequestHandler)
+    server.daemon_threads = True
+    server.files = files
+    server.retry_after = set(retry_after)
+    server.latency = latency
+    server.requests = []
+    server.request_times = []
+    server.retry_after_times = []
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, args=(0.01, ), daemon=True)
+    thread.start()
+    try:
+        yield server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_retrieve_remote_files(monkeypatch):
+    """Test concurrent _retrieve_remote_files against a fake gitiles server"""
+
+    #pylint: disable=protected-access
+    set_logging_level(logging.DEBUG)
+
+    src_repo = '/chromium/src.git/+/{}/'.format(validate_patches.get_chromium_version())
+    files = {
+        src_repo + 'chrome/a.cc': 'a\n',
+        src_repo + 'chrome/b.cc': 'b\n',
+        '/foo.git/+/abc/x.h': 'x\n',
+        '/foo.git/+/abc/z.h': 'z\n',
+        '/bar.git/+/def/y.h': 'y\n',
+    }
+    with _serve_gitiles(files, retry_after=[src_repo + 'chrome/b.cc']) as (server, base_url):
+        files[src_repo + 'DEPS'] = ("deps = {{'src/third_party/foo': '{}/foo.git@abc'}}\n"
+                                    "recursedeps = ['third_party/foo']\n").format(base_url)
+        files['/foo.git/+/abc/DEPS'] = ("use_relative_paths = True\n"
+                                        "deps = {{'bar': '{}/bar.git@def'}}\n").format(base_url)
+        monkeypatch.setattr(validate_patches, '_CHROMIUM_REPO_URL', base_url + '/chromium/src.git')
+        monkeypatch.setattr(validate_patches, '_GITILES_DOMAIN', '127.0.0.1')
+        monkeypatch.setattr(validate_patches, '_HOST_THROTTLE', validate_patches._HostThrottle())
+
+        required_files = [
+            Path('chrome', 'a.cc'),
+            Path('chrome', 'b.cc'),
+            Path('third_party', 'foo', 'x.h'),
+            Path('third_party', 'foo', 'z.h'),
+            Path('third_party', 'foo', 'bar', 'y.h'),
+            Path('missing.cc'),
+        ]
+        files_under_test = validate_patches._retrieve_remote_files(required_files, jobs=3)
+        assert files_under_test == {
+            Path('chrome', 'a.cc'): ['a', ''],
+            Path('chrome', 'b.cc'): ['b', ''],
+            Path('third_party', 'foo', 'x.h'): ['x', ''],
+            Path('third_party', 'foo', 'z.h'): ['z', ''],
+            Path('third_party', 'foo', 'bar', 'y.h'): ['y', ''],
+        }
+        # Each DEPS file is downloaded once, with a bounded number of concurrent requests
+        assert server.requests.count(src_repo + 'DEPS') == 1
+        assert server.requests.count('/foo.git/+/abc/DEPS') == 1
+        # No request reaches the host during Retry-After, apart from those sent
+        # before the client received the 429
+        assert server.requests.count(src_repo + 'chrome/b.cc') == 2
+        retry_after_time, = server.retry_after_times
+        assert not [
+            request_time for request_time in server.request_times
+            if retry_after_time + 0.1 < request_time < retry_after_time + 1
+        ]
+        assert max(server.request_times) >= retry_after_time + 1
+        assert 1 < server.max_in_flight <= 3
+
+
 if __name__ == '__main__':
     test_test_patches()
+    test_retrieve_archive_files()
@@ -22,7 +22,7 @@ from pathlib import Path, PurePosixPath
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'utils'))
 from _common import get_logger
 from domain_substitution import DomainRegexList, TREE_ENCODINGS
-from prune_binaries import CONTINGENT_PATHS
+from prune_binaries import CONTINGENT_PATHS, PRUNING_EXCLUDE_PATTERNS
 sys.path.pop(0)
 
 # Encoding for output files
@@ -39,63 +39,8 @@ PRUNING_INCLUDE_PATTERNS = [
     'components/signin/public/base/signin_pref_names.h',
 ]
 
-# pathlib.Path.match() paths to exclude from binary pruning
-PRUNING_EXCLUDE_PATTERNS = [
-    'chrome/common/win/eventlog_messages.mc', # TODO: False positive textfile
-    # Exclusions for DOM distiller (contains model data only)
-    'components/dom_distiller/core/data/distillable_page_model_new.bin',
-    'components/dom_distiller/core/data/long_page_model.bin',
-    # Exclusions for GeoLanguage data
-    # Details: https://docs.google.com/document/d/18WqVHz5F9vaUiE32E8Ge6QHmku2QSJKvlqB9JjnIM-g/edit
-    # Introduced with: https://chromium.googlesource.com/chromium/src/+/6647da61
-    'components/language/content/browser/ulp_language_code_locator/geolanguage-data_rank0.bin',
-    'components/language/content/browser/ulp_language_code_locator/geolanguage-data_rank1.bin',
-    'components/language/content/browser/ulp_language_code_locator/geolanguage-data_rank2.bin',
-    # Exclusion for required prebuilt object for Windows arm64 builds
-    'third_party/crashpad/crashpad/util/misc/capture_context_win_arm64.obj',
-    'third_party/icu/common/icudtl.dat', # Exclusion for ICU data
-    # Exclusion for Android
-    'build/android/chromium-debug.keystore',
-    'third_party/icu/android/icudtl.dat',
-    'third_party/icu/common/icudtb.dat',
-    # Exclusion for rollup v4.0+
-    'third_party/node/node_modules/@rollup/wasm-node/dist/wasm-node/bindings_wasm_bg.wasm',
-    # Exclusion for performance tracing
-    'third_party/perfetto/src/trace_processor/importers/proto/atoms.descriptor',
-    # Exclusions for safe file extensions
-    '*.avif',
-    '*.ttf',
-    '*.png',
-    '*.jpg',
-    '*.webp',
-    '*.gif',
-    '*.ico',
-    '*.mp3',
-    '*.wav',
-    '*.flac',
-    '*.icns',
-    '*.woff',
-    '*.woff2',
-    '*makefile',
-    '*.profdata',
-    '*.xcf',
-    '*.cur',
-    '*.pdf',
-    '*.ai',
-    '*.h',
-    '*.c',
-    '*.cpp',
-    '*.cc',
-    '*.mk',
-    '*.bmp',
-    '*.py',
-    '*.xml',
-    '*.html',
-    '*.js',
-    '*.json',
-    '*.txt',
-    '*.xtb'
-]
+# NOTE: PRUNING_EXCLUDE_PATTERNS is defined in utils/prune_binaries.py so that
+# "prune_binaries.py --audit" can share it
 
 # NOTE: Domain substitution path prefix exclusion has precedence over inclusion patterns
 # Paths to exclude by prefixes of the POSIX representation for domain substitution
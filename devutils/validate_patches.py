@@ -18,7 +18,12 @@ import json
 import logging
 import sys
 import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from types import SimpleNamespace
 
 sys.path.insert(0, str(Path(__file__).resolve().parent / 'third_party'))
 import unidiff
@@ -26,11 +31,40 @@ from unidiff.constants import LINE_TYPE_EMPTY, LINE_TYPE_NO_NEWLINE
 sys.path.pop(0)
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'utils'))
-from domain_substitution import TREE_ENCODINGS
 from _common import ENCODING, get_logger, get_chromium_version, parse_series, add_common_params
+from archive_index import load_index
+from _patch_bundle import PatchBundle, is_bundle
+from _patching import group_patches
 from patches import dry_run_check
 sys.path.pop(0)
 
+from patch_impact import (build_index, decode_file_lines, get_affected_hunks, get_changes,
+                          get_source, hash_file_lines, load_impact_index, read_patches,
+                          write_impact_index)
+
+
+class _HostThrottle:
+    """Pauses the requests to a host for all threads after it asked to retry later"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_times = dict()
+
+    def pause(self, host, seconds):
+        """Pauses the requests to host for seconds"""
+        with self._lock:
+            self._resume_times[host] = max(self._resume_times.get(host, 0),
+                                           time.monotonic() + seconds)
+
+    def wait(self, host):
+        """Waits until requests to host are no longer paused"""
+        with self._lock:
+            delay = self._resume_times.get(host, 0) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+_HOST_THROTTLE = _HostThrottle()
+
 try:
     import requests
     import requests.adapters
@@ -38,6 +72,17 @@ try:
 
     class _VerboseRetry(urllib3.util.Retry):
         """A more verbose version of HTTP Adatper about retries"""
+
+        # The host of the last request retried
+        host = None
+
+        def increment(self, *args, _pool=None, **kwargs): #pylint: disable=arguments-differ
+            """Keeps the host of the request, to pause other requests to it"""
+            new_retry = super().increment(*args, _pool=_pool, **kwargs)
+            if _pool is not None:
+                new_retry.host = _pool.host
+            return new_retry
+
         def sleep_for_retry(self, response=None):
             """Sleeps for Retry-After, and logs the sleep time"""
             if response:
@@ -46,6 +91,8 @@ try:
                     get_logger().info(
                         'Got HTTP status %s with Retry-After header. Retrying after %s seconds...',
                         response.status, retry_after)
+                    if self.host:
+                        _HOST_THROTTLE.pause(self.host, retry_after)
                 else:
                     get_logger().info(
                         'Could not find Retry-After header for HTTP response %s. Status reason: %s',
@@ -57,9 +104,10 @@ try:
             get_logger().info('Running HTTP request sleep backoff')
             super()._sleep_backoff()
 
-    def _get_requests_session():
+    def _get_requests_session(jobs=1):
         session = requests.Session()
         http_adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=max(jobs, requests.adapters.DEFAULT_POOLSIZE),
             max_retries=_VerboseRetry(total=10,
                                       read=10,
                                       connect=10,
@@ -71,13 +119,19 @@ try:
         return session
 except ImportError:
 
-    def _get_requests_session():
+    def _get_requests_session(jobs=1): #pylint: disable=unused-argument
         raise RuntimeError('The Python module "requests" is required for remote'
                            'file downloading. It can be installed from PyPI.')
 
 
 _ROOT_DIR = Path(__file__).resolve().parent.parent
 _SRC_PATH = Path('src')
+_CHROMIUM_REPO_URL = 'https://chromium.googlesource.com/chromium/src.git'
+# Repository URLs must contain this to be downloaded from
+_GITILES_DOMAIN = 'googlesource.com'
+
+# Serializes loading DEPS files, so each is downloaded once by concurrent downloads
+_DEPS_TREE_LOCK = threading.Lock()
 
 
 class _PatchValidationError(Exception):
@@ -144,10 +198,11 @@ def _download_googlesource_file(download_session, repo_url, version, relative_pa
     Returns the contents of the text file with path within the given
     googlesource.com repo as a string.
     """
-    if 'googlesource.com' not in repo_url:
-        raise ValueError('Repository URL is not a googlesource.com URL: {}'.format(repo_url))
+    if _GITILES_DOMAIN not in repo_url:
+        raise ValueError('Repository URL is not a {} URL: {}'.format(_GITILES_DOMAIN, repo_url))
     full_url = repo_url + '/+/{}/{}?format=TEXT'.format(version, str(relative_path))
     get_logger().debug('Downloading: %s', full_url)
+    _HOST_THROTTLE.wait(urllib.parse.urlsplit(full_url).hostname)
     response = download_session.get(full_url)
     if response.status_code == 404:
         raise _NotInRepoError()
@@ -206,15 +261,17 @@ def _process_deps_entries(deps_globals, child_deps_tree, child_path, deps_use_re
 
 def _get_child_deps_tree(download_session, current_deps_tree, child_path, deps_use_relative_paths):
     """Helper for _download_source_file"""
-    repo_url, version, child_deps_tree = current_deps_tree[child_path]
-    if isinstance(child_deps_tree, str):
-        # Load unloaded DEPS
-        deps_globals = _parse_deps(
-            _download_googlesource_file(download_session, repo_url, version, child_deps_tree))
-        child_deps_tree = dict()
-        current_deps_tree[child_path] = (repo_url, version, child_deps_tree)
-        deps_use_relative_paths = deps_globals.get('use_relative_paths', False)
-        _process_deps_entries(deps_globals, child_deps_tree, child_path, deps_use_relative_paths)
+    with _DEPS_TREE_LOCK:
+        repo_url, version, child_deps_tree = current_deps_tree[child_path]
+        if isinstance(child_deps_tree, str):
+            # Load unloaded DEPS
+            deps_globals = _parse_deps(
+                _download_googlesource_file(download_session, repo_url, version, child_deps_tree))
+            child_deps_tree = dict()
+            deps_use_relative_paths = deps_globals.get('use_relative_paths', False)
+            _process_deps_entries(deps_globals, child_deps_tree, child_path,
+                                  deps_use_relative_paths)
+            current_deps_tree[child_path] = (repo_url, version, child_deps_tree)
     return child_deps_tree, deps_use_relative_paths
 
 
@@ -273,23 +330,25 @@ class _FallbackRepoManager:
 
     def __init__(self):
         self._cache_gn_version = None
+        self._lock = threading.Lock()
 
     @property
     def gn_version(self):
         """
         Returns the version of the GN repo for the Chromium version used by this code
         """
-        if not self._cache_gn_version:
-            # Because there seems to be no reference to the logic for generating the
-            # chromium-browser-official tar file, it's possible that it is being generated
-            # by an internal script that manually injects the GN repository files.
-            # Therefore, assume that the GN version used in the chromium-browser-official tar
-            # files correspond to the latest commit in the master branch of the GN repository
-            # at the time of the tar file's generation. We can get an approximation for the
-            # generation time by using the last modification date of the tar file on
-            # Google's file server.
-            self._cache_gn_version = _get_gitiles_commit_before_date(
-                self._GN_REPO_URL, 'master', _get_last_chromium_modification())
+        with self._lock:
+            if not self._cache_gn_version:
+                # Because there seems to be no reference to the logic for generating the
+                # chromium-browser-official tar file, it's possible that it is being generated
+                # by an internal script that manually injects the GN repository files.
+                # Therefore, assume that the GN version used in the chromium-browser-official
+                # tar files correspond to the latest commit in the master branch of the GN
+                # repository at the time of the tar file's generation. We can get an
+                # approximation for the generation time by using the last modification date
+                # of the tar file on Google's file server.
+                self._cache_gn_version = _get_gitiles_commit_before_date(
+                    self._GN_REPO_URL, 'master', _get_last_chromium_modification())
         return self._cache_gn_version
 
     def get_fallback(self, current_relative_path, current_node, root_deps_tree):
@@ -393,19 +452,18 @@ def _initialize_deps_tree():
 
     download_session is an active requests.Session() object
     """
-    root_deps_tree = {
-        _SRC_PATH: ('https://chromium.googlesource.com/chromium/src.git', get_chromium_version(),
-                    'DEPS')
-    }
+    root_deps_tree = {_SRC_PATH: (_CHROMIUM_REPO_URL, get_chromium_version(), 'DEPS')}
     return root_deps_tree
 
 
-def _retrieve_remote_files(file_iter):
+def _retrieve_remote_files(file_iter, jobs=1):
     """
     Retrieves all file paths in file_iter from Google
 
     file_iter is an iterable of strings that are relative UNIX paths to
         files in the Chromium source.
+    jobs is the number of files to download concurrently. The downloads share the session
+        and the DEPS tree, so each DEPS file is downloaded once.
 
     Returns a dict of relative UNIX path strings to a list of lines in the file as strings
     """
@@ -427,26 +485,36 @@ def _retrieve_remote_files(file_iter):
     last_progress = 0
     file_count = 0
     fallback_repo_manager = _FallbackRepoManager()
-    with _get_requests_session() as download_session:
+    with _get_requests_session(jobs) as download_session, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
         download_session.stream = False # To ensure connection to Google can be reused
-        for file_path in file_iter:
-            if total_files:
+        futures = {
+            executor.submit(_download_source_file, download_session, root_deps_tree,
+                            fallback_repo_manager, file_path): file_path
+            for file_path in file_iter
+        }
+        try:
+            for future in as_completed(futures):
+                file_path = futures[future]
                 file_count += 1
-                current_progress = file_count * 100 // total_files // 5 * 5
-                if current_progress != last_progress:
-                    last_progress = current_progress
-                    logger.info('%d%% downloaded', current_progress)
-            else:
-                current_progress = file_count // 20 * 20
-                if current_progress != last_progress:
-                    last_progress = current_progress
-                    logger.info('%d files downloaded', current_progress)
-            try:
-                files[file_path] = _download_source_file(download_session, root_deps_tree,
-                                                         fallback_repo_manager,
-                                                         file_path).split('\n')
-            except _NotInRepoError:
-                get_logger().warning('Could not find "%s" remotely. Skipping...', file_path)
+                if total_files:
+                    current_progress = file_count * 100 // total_files // 5 * 5
+                    if current_progress != last_progress:
+                        last_progress = current_progress
+                        logger.info('%d%% downloaded', current_progress)
+                else:
+                    current_progress = file_count // 20 * 20
+                    if current_progress != last_progress:
+                        last_progress = current_progress
+                        logger.info('%d files downloaded', current_progress)
+                try:
+                    files[file_path] = future.result().split('\n')
+                except _NotInRepoError:
+                    get_logger().warning('Could not find "%s" remotely. Skipping...', file_path)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
     return files
 
 
@@ -463,18 +531,40 @@ def _retrieve_local_files(file_iter, source_dir):
     for file_path in file_iter:
         try:
             raw_content = (source_dir / file_path).read_bytes()
-        except FileNotFoundError:
+        except (FileNotFoundError, IsADirectoryError):
             get_logger().warning('Missing file from patches: %s', file_path)
             continue
-        for encoding in TREE_ENCODINGS:
-            try:
-                content = raw_content.decode(encoding)
-                break
-            except UnicodeDecodeError:
-                continue
-        if not content:
-            raise UnicodeDecodeError('Unable to decode with any encoding: %s' % file_path)
-        files[file_path] = content.split('\n')
+        files[file_path] = decode_file_lines(raw_content, file_path)
+    if not files:
+        get_logger().error('All files used by patches are missing!')
+    return files
+
+
+def _retrieve_archive_files(file_iter, archive_path):
+    """
+    Retrieves all file paths in file_iter from the source archive using its member index,
+    without unpacking it
+
+    file_iter is an iterable of strings that are relative UNIX paths to
+        files in the Chromium source.
+    archive_path is the pathlib.Path to the .tar or .tar.xz source archive.
+
+    Returns a dict of relative UNIX path strings to a list of lines in the file as strings
+    """
+    index = load_index(archive_path)
+    # Member paths to the paths of file_iter
+    present_files = dict()
+    for file_path in file_iter:
+        member_path = Path(file_path).as_posix()
+        if index.is_file(member_path):
+            present_files[member_path] = file_path
+        else:
+            get_logger().warning('Missing file from patches: %s', file_path)
+    files = dict()
+    # Members are read in the order of the archive
+    for member_path, raw_content in index.read_members(present_files):
+        file_path = present_files[member_path]
+        files[file_path] = decode_file_lines(raw_content, file_path)
     if not files:
         get_logger().error('All files used by patches are missing!')
     return files
@@ -590,19 +680,22 @@ def _load_all_patches(series_iter, patches_dir):
     Returns a tuple of the following:
     - boolean indicating success or failure of reading files
     - dict of relative UNIX path strings to unidiff.PatchSet
+
+    patches_dir is the pathlib.Path of the patches directory, or of a patch bundle
     """
     had_failure = False
     unidiff_dict = dict()
+    bundle = PatchBundle(patches_dir) if is_bundle(patches_dir) else None
     for relative_path in series_iter:
         if relative_path in unidiff_dict:
             continue
-        unidiff_dict[relative_path] = unidiff.PatchSet.from_filename(str(patches_dir /
-                                                                         relative_path),
-                                                                     encoding=ENCODING)
-        if not (patches_dir / relative_path).read_text(encoding=ENCODING).endswith('\n'):
+        patch_path = bundle.get_patch(relative_path) if bundle else patches_dir / relative_path
+        with patch_path.open(encoding=ENCODING) as patch_file:
+            patch_text = patch_file.read()
+        unidiff_dict[relative_path] = unidiff.PatchSet(patch_text)
+        if not patch_text.endswith('\n'):
             had_failure = True
-            get_logger().warning('Patch file does not end with newline: %s',
-                                 str(patches_dir / relative_path))
+            get_logger().warning('Patch file does not end with newline: %s', str(patch_path))
     return had_failure, unidiff_dict
 
 
@@ -619,6 +712,48 @@ def _get_required_files(patch_cache):
     return file_set
 
 
+def _hash_files_under_test(files_under_test):
+    """Returns a dict of relative UNIX paths to hashes of the files for the impact index"""
+    return {
+        file_path.as_posix(): hash_file_lines(file_lines)
+        for file_path, file_lines in files_under_test.items() if file_lines is not None
+    }
+
+
+def _get_affected_series(series_iter, patch_cache, patch_texts, impact_index, changes):
+    """
+    Returns the patches in series_iter affected by changes since impact_index was built,
+    with the other patches modifying the same files, in series order
+
+    changes is the changes of the source files from patch_impact.get_changes()
+    """
+    affected = get_affected_hunks(impact_index, changes, patch_texts)
+    series = list(dict.fromkeys(series_iter))
+    chains = group_patches(
+        [SimpleNamespace(paths=[x.path for x in patch_cache[name]]) for name in series])
+    selected = set()
+    for chain in chains:
+        if any(series[x] in affected for x in chain):
+            selected.update(series[x] for x in chain)
+    return tuple(x for x in series_iter if x in selected)
+
+
+def _select_affected_series(args, series_iterable, patch_cache, patch_texts, files_under_test):
+    """Helper for main to select the patches to validate with --only-affected"""
+    impact_index = load_impact_index(args.only_affected)
+    if args.old_source:
+        old_source = get_source(args.old_source)
+    else:
+        old_source = impact_index['files']
+    source_files = {x.as_posix(): y for x, y in files_under_test.items()}
+    changes = get_changes(impact_index, old_source, source_files)
+    affected_series = _get_affected_series(series_iterable, patch_cache, patch_texts,
+                                           impact_index, changes)
+    get_logger().info('Validating %d of %d patches affected since the impact index',
+                      len(affected_series), len(series_iterable))
+    return affected_series
+
+
 def _get_files_under_test(args, required_files, parser):
     """
     Helper for main to get files_under_test
@@ -627,8 +762,10 @@ def _get_files_under_test(args, required_files, parser):
     """
     if args.local:
         files_under_test = _retrieve_local_files(required_files, args.local)
+    elif args.archive:
+        files_under_test = _retrieve_archive_files(required_files, args.archive)
     else: # --remote and --cache-remote
-        files_under_test = _retrieve_remote_files(required_files)
+        files_under_test = _retrieve_remote_files(required_files, args.jobs)
         if args.cache_remote:
             for file_path, file_content in files_under_test.items():
                 if not (args.cache_remote / file_path).parent.exists():
@@ -639,7 +776,7 @@ def _get_files_under_test(args, required_files, parser):
     return files_under_test
 
 
-def main():
+def main(): #pylint: disable=too-many-branches
     """CLI Entrypoint"""
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-s',
@@ -651,9 +788,10 @@ def main():
     parser.add_argument('-p',
                         '--patches',
                         type=Path,
-                        metavar='DIRECTORY',
+                        metavar='PATH',
                         default='patches',
-                        help='The patches directory to read from. Default: %(default)s')
+                        help=('The patches directory or patch bundle to read from. The series of '
+                              'a bundle is used instead of --series. Default: %(default)s'))
     add_common_params(parser)
 
     file_source_group = parser.add_mutually_exclusive_group(required=True)
@@ -664,6 +802,13 @@ def main():
         metavar='DIRECTORY',
         help=
         'Use a local source tree. It must be UNMODIFIED, otherwise the results will not be valid.')
+    file_source_group.add_argument(
+        '-a',
+        '--archive',
+        type=Path,
+        metavar='FILE',
+        help=('Read the files from a .tar or .tar.xz source archive without unpacking it. '
+              'Its member index is built next to it if needed.'))
     file_source_group.add_argument(
         '-r',
         '--remote',
@@ -677,22 +822,57 @@ def main():
         type=Path,
         metavar='DIRECTORY',
         help='(For debugging) Store the required remote files in an empty local directory')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        metavar='NUM',
+        help='The number of files to download concurrently with --remote. Default: %(default)s')
+    parser.add_argument(
+        '--only-affected',
+        type=Path,
+        metavar='INDEX',
+        help=('Only validate the patches affected by changes to the patches or the source '
+              'files since the impact index INDEX was built (see patch_impact.py), with the '
+              'patches modifying the same files. INDEX is created or updated after passing '
+              'validation. Without --old-source, all patches modifying a changed file are '
+              'affected. All required files are still retrieved to find the changes, so this '
+              'saves little time with --remote.'))
+    parser.add_argument(
+        '--old-source',
+        type=Path,
+        metavar='PATH',
+        help=('With --only-affected, the source tree or patch_impact.py manifest INDEX was '
+              'built from. With a source tree, only patches with hunks overlapping the changed '
+              'lines are affected. Default: the file hashes in INDEX'))
     args = parser.parse_args()
+    if args.old_source and not args.only_affected:
+        parser.error('--old-source requires --only-affected')
     if args.cache_remote and not args.cache_remote.exists():
         if args.cache_remote.parent.exists():
             args.cache_remote.mkdir()
         else:
             parser.error('Parent of cache path {} does not exist'.format(args.cache_remote))
 
-    if not args.series.is_file():
-        parser.error('--series path is not a file or not found: {}'.format(args.series))
-    if not args.patches.is_dir():
-        parser.error('--patches path is not a directory or not found: {}'.format(args.patches))
-
-    series_iterable = tuple(parse_series(args.series))
+    if is_bundle(args.patches):
+        series_iterable = tuple(PatchBundle(args.patches).series)
+    else:
+        if not args.series.is_file():
+            parser.error('--series path is not a file or not found: {}'.format(args.series))
+        if not args.patches.is_dir():
+            parser.error('--patches path is not a directory or not found: {}'.format(
+                args.patches))
+        series_iterable = tuple(parse_series(args.series))
     had_failure, patch_cache = _load_all_patches(series_iterable, args.patches)
     required_files = _get_required_files(patch_cache)
     files_under_test = _get_files_under_test(args, required_files, parser)
+    if args.only_affected:
+        patch_texts = read_patches(args.patches, args.series)
+        file_hashes = _hash_files_under_test(files_under_test)
+        if args.only_affected.exists():
+            series_iterable = _select_affected_series(args, series_iterable, patch_cache,
+                                                      patch_texts, files_under_test)
     had_failure |= _test_patches(series_iterable, patch_cache, files_under_test)
     if had_failure:
         get_logger().error('***FAILED VALIDATION; SEE ABOVE***')
@@ -701,6 +881,8 @@ def main():
         parser.exit(status=1)
     else:
         get_logger().info('Passed validation (%d patches total)', len(series_iterable))
+        if args.only_affected:
+            write_impact_index(args.only_affected, build_index(patch_texts, file_hashes))
 
 
 if __name__ == '__main__':
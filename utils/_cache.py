@@ -0,0 +1,220 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Host-wide content-addressed cache of verified downloads
+"""
+
+import contextlib
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+from _common import ENCODING, get_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+# Multipliers of the size suffixes accepted by parse_size()
+_SIZE_SUFFIXES = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(value):
+    """
+    Returns the number of bytes of a size string, e.g. "500M" or "50G".
+
+    Raises ValueError if the size string is invalid.
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*([KMGT]?)i?B?\s*', value, re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: {}'.format(value))
+    return int(match.group(1)) * _SIZE_SUFFIXES[match.group(2).upper()]
+
+
+def get_cache_key(hash_pairs):
+    """
+    Returns the (hash_name, hash_hex) of the strongest hash in hash_pairs to key a download by,
+    or None if hash_pairs is empty.
+
+    The strongest hash is the one with the largest digest.
+    """
+    hash_pairs = sorted((hash_name, hash_hex.lower()) for hash_name, hash_hex in hash_pairs)
+    if not hash_pairs:
+        return None
+    return max(hash_pairs, key=lambda x: hashlib.new(x[0]).digest_size)
+
+
+class SharedCache:
+    """
+    Cache of verified downloads shared by all download caches on a host.
+
+    Objects are stored under objects/HASH_NAME/XX/HASH_HEX, keyed by the strongest expected hash
+    of each download, and placed into download caches as hardlinks. When a hardlink cannot
+    be created (e.g. across filesystems), the object is copied instead.
+
+    The index of object sizes and last use times is kept in index.json, and all changes
+    to the cache are serialized by a lock on the lock file. The modification times of objects
+    are not used to track their use since they are shared with their hardlinks.
+    """
+
+    _INDEX_NAME = 'index.json'
+    _LOCK_NAME = 'lock'
+    _OBJECTS_NAME = 'objects'
+
+    def __init__(self, root, size_budget=None):
+        """
+        root is the pathlib.Path to the directory of the cache. It is created if needed.
+        size_budget is the maximum number of bytes of objects to keep after adding objects,
+            or None to never evict objects when adding them.
+        """
+        self.root = root
+        self.size_budget = size_budget
+        (root / self._OBJECTS_NAME).mkdir(parents=True, exist_ok=True)
+
+    def _get_object_path(self, key):
+        hash_name, hash_hex = key
+        return self.root / self._OBJECTS_NAME / hash_name / hash_hex[:2] / hash_hex
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """Context manager holding the exclusive lock of the cache across processes"""
+        with (self.root / self._LOCK_NAME).open('a+b') as lock_file:
+            if fcntl is None:
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError as exc:
+                        # LK_LOCK gives up after 10 seconds
+                        if exc.errno != errno.EDEADLOCK:
+                            raise
+                try:
+                    yield
+                finally:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _read_index(self):
+        """Returns the dict of object key strings to their size and last use time"""
+        try:
+            with (self.root / self._INDEX_NAME).open(encoding=ENCODING) as index_file:
+                return json.load(index_file)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            get_logger().warning('Ignoring corrupt shared cache index in %s', self.root)
+            return {}
+
+    def _write_index(self, index):
+        index_path = self.root / self._INDEX_NAME
+        tmp_path = index_path.with_name(index_path.name + '.tmp')
+        with tmp_path.open('w', encoding=ENCODING) as index_file:
+            json.dump(index, index_file, indent=1, sort_keys=True)
+        tmp_path.replace(index_path)
+
+    @staticmethod
+    def _place(source_path, target_path):
+        """Hardlinks or copies source_path to the non-existent target_path atomically"""
+        try:
+            os.link(str(source_path), str(target_path))
+            return
+        except OSError as exc:
+            get_logger().debug('Could not hardlink %s (%s); copying instead', source_path, exc)
+        tmp_path = target_path.with_name(target_path.name + '.shared-tmp')
+        shutil.copyfile(str(source_path), str(tmp_path))
+        tmp_path.replace(target_path)
+
+    def _evict(self, index, size_budget):
+        """Removes the least recently used objects until they fit in size_budget"""
+        total_size = sum(entry['size'] for entry in index.values())
+        for key_str, entry in sorted(index.items(), key=lambda x: x[1]['last_used']):
+            if total_size <= size_budget:
+                break
+            object_path = self._get_object_path(key_str.split(':', 1))
+            get_logger().info('Evicting %s from shared cache', object_path.name)
+            with contextlib.suppress(FileNotFoundError):
+                object_path.unlink()
+            total_size -= entry['size']
+            del index[key_str]
+
+    def fetch(self, key, download_path):
+        """
+        Places the object of key at download_path, which must not exist.
+
+        Returns True if the object was placed; False if it is not in the cache.
+        """
+        object_path = self._get_object_path(key)
+        key_str = ':'.join(key)
+        with self._lock():
+            index = self._read_index()
+            if key_str not in index or not object_path.exists():
+                return False
+            self._place(object_path, download_path)
+            index[key_str]['last_used'] = time.time()
+            self._write_index(index)
+        return True
+
+    def store(self, key, download_path):
+        """
+        Adds the verified download at download_path as the object of key, if it is not in the
+        cache already, and evicts objects to fit the size budget.
+        """
+        object_path = self._get_object_path(key)
+        key_str = ':'.join(key)
+        with self._lock():
+            index = self._read_index()
+            if not object_path.exists():
+                object_path.parent.mkdir(parents=True, exist_ok=True)
+                self._place(download_path, object_path)
+            index[key_str] = {'size': object_path.stat().st_size, 'last_used': time.time()}
+            if self.size_budget is not None:
+                self._evict(index, self.size_budget)
+            self._write_index(index)
+
+    def collect_garbage(self, size_budget=None):
+        """
+        Removes objects missing from the index and index entries missing their objects,
+        and evicts the least recently used objects to fit size_budget if it is not None.
+
+        Evicted objects still hardlinked from download caches only free their space
+        once removed from those too.
+
+        Returns the total size in bytes of the objects left in the cache.
+        """
+        objects_root = self.root / self._OBJECTS_NAME
+        with self._lock():
+            index = self._read_index()
+            for key_str in list(index):
+                if not self._get_object_path(key_str.split(':', 1)).exists():
+                    get_logger().debug('Removing missing object from index: %s', key_str)
+                    del index[key_str]
+            for object_path in list(objects_root.glob('*/*/*')):
+                key_str = ':'.join((object_path.parent.parent.name, object_path.name))
+                if key_str not in index:
+                    get_logger().info('Removing unindexed file from shared cache: %s', object_path)
+                    object_path.unlink()
+            if size_budget is not None:
+                self._evict(index, size_budget)
+            self._write_index(index)
+            for directory in list(objects_root.glob('*/*')) + list(objects_root.glob('*')):
+                with contextlib.suppress(OSError):
+                    directory.rmdir()
+            return sum(entry['size'] for entry in index.values())
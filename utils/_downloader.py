@@ -0,0 +1,390 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Built-in HTTP downloader with connection pooling, resuming and segmented downloads
+"""
+
+import collections
+import contextlib
+import http.client
+import json
+import ssl
+import threading
+import time
+import urllib.error
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from _common import ENCODING, get_logger
+
+# Size of each read from a download response
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Maximum number of HTTP redirects to follow
+_MAX_REDIRECTS = 10
+# Timeout in seconds for blocking operations of HTTP connections
+HTTP_TIMEOUT = 60
+# Number of bytes requested from each mirror to measure its latency
+_PROBE_SIZE = 64 * 1024
+
+
+class HTTPConnectionPool:
+    """Thread-safe pool of keep-alive HTTP and HTTPS connections per host"""
+    def __init__(self, disable_ssl_verification=False, timeout=HTTP_TIMEOUT):
+        self._lock = threading.Lock()
+        self._idle_connections = collections.defaultdict(list)
+        self._timeout = timeout
+        if disable_ssl_verification:
+            self._ssl_context = ssl._create_unverified_context() #pylint: disable=protected-access
+        else:
+            self._ssl_context = ssl.create_default_context()
+
+    def _new_connection(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc,
+                                               timeout=self._timeout,
+                                               context=self._ssl_context)
+        if scheme == 'http':
+            return http.client.HTTPConnection(netloc, timeout=self._timeout)
+        raise ValueError('Unsupported URL scheme: {}'.format(scheme))
+
+    def _acquire(self, scheme, netloc):
+        """Returns a tuple of a connection and a boolean indicating if it was reused"""
+        with self._lock:
+            idle_connections = self._idle_connections[(scheme, netloc)]
+            if idle_connections:
+                return idle_connections.pop(), True
+        return self._new_connection(scheme, netloc), False
+
+    def _release(self, scheme, netloc, connection, response):
+        """Returns the connection to the pool if it can be reused; closes it otherwise"""
+        if response.will_close or not response.isclosed():
+            connection.close()
+            return
+        with self._lock:
+            self._idle_connections[(scheme, netloc)].append(connection)
+
+    def _send(self, split_url, method, headers):
+        """Sends a request, retrying once if a reused connection was closed by the server"""
+        target = split_url.path or '/'
+        if split_url.query:
+            target += '?' + split_url.query
+        connection, reused = self._acquire(split_url.scheme, split_url.netloc)
+        try:
+            connection.request(method, target, headers=headers)
+            return connection, connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            connection.close()
+            if not reused:
+                raise
+        connection = self._new_connection(split_url.scheme, split_url.netloc)
+        connection.request(method, target, headers=headers)
+        return connection, connection.getresponse()
+
+    @contextlib.contextmanager
+    def open(self, url, headers=None, method='GET'):
+        """
+        Context manager that sends a request to url and yields the http.client.HTTPResponse.
+        Redirects are followed. The connection is kept for reuse if the response was read
+        completely.
+        """
+        headers = {'Accept-Encoding': 'identity', **(headers or {})}
+        for _ in range(_MAX_REDIRECTS + 1):
+            split_url = urllib.parse.urlsplit(url)
+            connection, response = self._send(split_url, method, headers)
+            if response.status in (301, 302, 303, 307, 308):
+                response.read()
+                self._release(split_url.scheme, split_url.netloc, connection, response)
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                get_logger().debug('Redirected to %s', url)
+                continue
+            try:
+                yield response
+            except BaseException:
+                connection.close()
+                raise
+            self._release(split_url.scheme, split_url.netloc, connection, response)
+            return
+        raise urllib.error.URLError('Too many redirects for URL: {}'.format(url))
+
+    def close(self):
+        """Closes all idle connections"""
+        with self._lock:
+            for idle_connections in self._idle_connections.values():
+                for connection in idle_connections:
+                    connection.close()
+            self._idle_connections.clear()
+
+
+def feed_file(file_path, hasher, chunk_bytes=_DOWNLOAD_CHUNK_SIZE, progress=None):
+    """
+    Feeds the current content of file_path to hasher
+
+    progress is a callable to report (read_bytes, total_bytes) to, or None.
+    """
+    buffer = memoryview(bytearray(chunk_bytes))
+    total_size = -1
+    read_bytes = 0
+    if progress:
+        total_size = file_path.stat().st_size
+        progress(read_bytes, total_size)
+    with file_path.open('rb') as file_obj:
+        read_size = file_obj.readinto(buffer)
+        while read_size:
+            hasher.update(buffer[:read_size])
+            if progress:
+                read_bytes += read_size
+                progress(read_bytes, total_size)
+            read_size = file_obj.readinto(buffer)
+
+
+def download_file(url, file_path, connection_pool, progress=None, hasher=None): #pylint: disable=too-many-branches
+    """
+    Downloads url to file_path with connections from connection_pool.
+    If file_path already has content, the download is resumed with a Range request.
+
+    progress is a callable to report (downloaded_bytes, total_bytes) to, where total_bytes
+        is -1 if unknown, or None.
+    hasher is an object with an update() method that is fed all the bytes of the file, or None.
+    """
+    offset = file_path.stat().st_size if file_path.exists() else 0
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+    with connection_pool.open(url, headers) as response:
+        if response.status == 416 and offset:
+            # The partial file already has all the content
+            response.read()
+            if hasher:
+                feed_file(file_path, hasher)
+            return
+        if response.status == 206:
+            file_mode = 'ab'
+            if hasher:
+                feed_file(file_path, hasher)
+        elif response.status == 200:
+            if offset:
+                get_logger().debug('Server does not support resuming; restarting download')
+            offset = 0
+            file_mode = 'wb'
+        else:
+            response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, None)
+        total_size = -1
+        if response.length is not None:
+            total_size = offset + response.length
+        downloaded = offset
+        if progress:
+            progress(downloaded, total_size)
+        with file_path.open(file_mode) as file_obj:
+            # read1() returns the data received so far instead of waiting for a full chunk,
+            # so the partial file has all received data if the connection fails or stalls
+            chunk = response.read1(_DOWNLOAD_CHUNK_SIZE)
+            while chunk:
+                file_obj.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                downloaded += len(chunk)
+                if progress:
+                    progress(downloaded, total_size)
+                chunk = response.read1(_DOWNLOAD_CHUNK_SIZE)
+            # Mark the response as complete so the connection can be reused
+            response.read()
+        if total_size >= 0 and downloaded != total_size:
+            raise http.client.IncompleteRead(b'', total_size - downloaded)
+
+
+def _probe_latency(url, connection_pool, probe_bytes):
+    """Returns the seconds taken to receive the first probe_bytes of url"""
+    start_time = time.monotonic()
+    with connection_pool.open(url, {'Range': 'bytes=0-{}'.format(probe_bytes - 1)}) as response:
+        if response.status not in (200, 206):
+            response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, None)
+        # If the server ignores the range, the connection is closed with the rest unread
+        response.read(probe_bytes)
+    return time.monotonic() - start_time
+
+
+def rank_mirrors(urls, connection_pool, probe_bytes=_PROBE_SIZE):
+    """
+    Returns urls ordered by the time taken to receive their first probe_bytes.
+    All urls are probed concurrently. URLs that fail to respond are ordered last,
+    keeping their relative order.
+    """
+    def _probe(url):
+        try:
+            latency = _probe_latency(url, connection_pool, probe_bytes)
+        except (OSError, http.client.HTTPException) as exc:
+            get_logger().debug('Probing %s failed: %s', url, exc)
+            return float('inf')
+        get_logger().debug('Probed %s in %.3f seconds', url, latency)
+        return latency
+
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        latencies = list(executor.map(_probe, urls))
+    return [url for _, _, url in sorted(zip(latencies, range(len(urls)), urls))]
+
+
+def _probe_range_support(url, connection_pool):
+    """
+    Returns the size of the file at url if the server accepts byte range requests for it;
+    None otherwise.
+    """
+    with connection_pool.open(url, method='HEAD') as response:
+        response.read()
+        if response.status != 200:
+            return None
+        if (response.getheader('Accept-Ranges') or '').strip().lower() != 'bytes':
+            return None
+        content_length = response.getheader('Content-Length')
+    if not content_length or not content_length.isdigit():
+        return None
+    return int(content_length)
+
+
+class _SegmentState:
+    """
+    Tracks the completed byte ranges of a segmented download in a sidecar JSON file,
+    so an interrupted download only needs to fetch the incomplete segments.
+    """
+    def __init__(self, sidecar_path, file_size, ranges, completed=()):
+        self._sidecar_path = sidecar_path
+        self._lock = threading.Lock()
+        self.file_size = file_size
+        self.ranges = ranges
+        self.completed = set(completed)
+
+    @classmethod
+    def create(cls, sidecar_path, file_size, segments):
+        """Returns a new state splitting file_size bytes into segments byte ranges"""
+        segment_size = -(-file_size // segments)
+        return cls(sidecar_path, file_size,
+                   [(start, min(start + segment_size, file_size) - 1)
+                    for start in range(0, file_size, segment_size)])
+
+    @classmethod
+    def load(cls, sidecar_path):
+        """Returns the state stored in sidecar_path, or None if it is missing or invalid"""
+        try:
+            with sidecar_path.open(encoding=ENCODING) as sidecar_file:
+                sidecar = json.load(sidecar_file)
+            return cls(sidecar_path, sidecar['size'], list(map(tuple, sidecar['ranges'])),
+                       sidecar['completed'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self):
+        """Writes the state to the sidecar file"""
+        tmp_path = self._sidecar_path.with_name(self._sidecar_path.name + '.tmp')
+        with tmp_path.open('w', encoding=ENCODING) as sidecar_file:
+            json.dump(
+                {
+                    'size': self.file_size,
+                    'ranges': self.ranges,
+                    'completed': sorted(self.completed),
+                }, sidecar_file)
+        tmp_path.replace(self._sidecar_path)
+
+    def mark_completed(self, index):
+        """Records the segment at index as completed"""
+        with self._lock:
+            self.completed.add(index)
+            self.save()
+
+    @property
+    def completed_bytes(self):
+        """The number of bytes in completed segments"""
+        return sum(self.ranges[index][1] - self.ranges[index][0] + 1 for index in self.completed)
+
+    def remove(self):
+        """Removes the sidecar file"""
+        if self._sidecar_path.exists():
+            self._sidecar_path.unlink()
+
+
+def _download_segment(url, file_path, connection_pool, byte_range, progress_callback):
+    """Downloads the inclusive byte_range of url into the same range of file_path"""
+    start, end = byte_range
+    with connection_pool.open(url, {'Range': 'bytes={}-{}'.format(start, end)}) as response:
+        if response.status != 206:
+            response.read()
+            raise urllib.error.HTTPError(url, response.status, response.reason,
+                                         response.headers, None)
+        remaining = end - start + 1
+        with file_path.open('r+b') as file_obj:
+            file_obj.seek(start)
+            while remaining:
+                chunk = response.read(min(_DOWNLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise http.client.IncompleteRead(b'', remaining)
+                file_obj.write(chunk)
+                remaining -= len(chunk)
+                progress_callback(len(chunk))
+        response.read()
+
+
+def get_segments_sidecar(file_path):
+    """Returns the pathlib.Path to the segments sidecar of the partial download file_path"""
+    return file_path.with_name(file_path.name + '.segments')
+
+
+def download_file_segmented(url, file_path, connection_pool, progress, segments): #pylint: disable=too-many-locals
+    """
+    Downloads url to file_path as concurrent byte range requests.
+    Completed segments are tracked in a sidecar file next to file_path; if one exists,
+    only the incomplete segments it lists are downloaded.
+
+    progress is a callable to report (downloaded_bytes, total_bytes) to, or None.
+
+    Returns False without downloading if the server does not support byte ranges.
+    """
+    sidecar_path = get_segments_sidecar(file_path)
+    file_size = _probe_range_support(url, connection_pool)
+    if not file_size:
+        get_logger().debug('Server does not support byte ranges; using a single connection')
+        if sidecar_path.exists():
+            # The partial file has gaps, so it cannot be resumed without byte ranges
+            file_path.unlink()
+            sidecar_path.unlink()
+        return False
+    segment_state = _SegmentState.load(sidecar_path)
+    if segment_state and segment_state.file_size == file_size and file_path.exists():
+        get_logger().debug('Resuming %d of %d segments',
+                           len(segment_state.ranges) - len(segment_state.completed),
+                           len(segment_state.ranges))
+    else:
+        segment_state = _SegmentState.create(sidecar_path, file_size, segments)
+        # Preallocate the file so each segment can be written in place
+        with file_path.open('wb') as file_obj:
+            file_obj.truncate(file_size)
+        segment_state.save()
+
+    progress_lock = threading.Lock()
+    downloaded = [segment_state.completed_bytes]
+    if progress:
+        progress(downloaded[0], file_size)
+
+    def _progress_callback(byte_count):
+        with progress_lock:
+            downloaded[0] += byte_count
+            if progress:
+                progress(downloaded[0], file_size)
+
+    def _download_and_mark(index):
+        _download_segment(url, file_path, connection_pool, segment_state.ranges[index],
+                          _progress_callback)
+        segment_state.mark_completed(index)
+
+    pending = [
+        index for index in range(len(segment_state.ranges)) if index not in segment_state.completed
+    ]
+    with ThreadPoolExecutor(max_workers=max(segments, 1)) as executor:
+        for future in [executor.submit(_download_and_mark, index) for index in pending]:
+            future.result()
+    segment_state.remove()
+    return True
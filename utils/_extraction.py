@@ -6,14 +6,26 @@
 """
 Archive extraction utilities
 """
+# pylint: disable=too-many-lines
 
+import contextlib
+import functools
+import io
 import os
+import re
 import shutil
+import stat
 import subprocess
 import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path, PurePosixPath
 
 from _common import (USE_REGISTRY, PlatformEnum, ExtractorEnum, get_logger, get_running_platform)
+from _metrics import ProgressReader
+from _worktree import break_link
+from _xz import open_parallel_xz
+from _zstdtar import is_zstd_archive, open_zstd_tar, start_zstd_decompressor, zstd_module
 from prune_binaries import CONTINGENT_PATHS
 
 DEFAULT_EXTRACTORS = {
@@ -22,6 +34,56 @@ DEFAULT_EXTRACTORS = {
     ExtractorEnum.WINRAR: USE_REGISTRY,
 }
 
+# Options of BSD and GNU tar to decompress archives read from stdin, by archive suffix
+_TAR_STDIN_COMPRESSION_ARGS = {
+    '.tar': (),
+    '.gz': ('-z', ),
+    '.tgz': ('-z', ),
+    '.bz2': ('-j', ),
+    '.xz': ('-J', ),
+    '.zst': ('--zstd', ),
+    '.tzst': ('--zstd', ),
+}
+
+# Options of BSD and GNU tar to decompress archives read from stdin, by magic number.
+# Unlike archive files, tar does not detect the compression of stdin.
+_TAR_STDIN_MAGIC_ARGS = (
+    (b'\x1f\x8b', ('-z', )),
+    (b'BZh', ('-j', )),
+    (b'\xfd7zXZ\x00', ('-J', )),
+    (b'\x28\xb5\x2f\xfd', ('--zstd', )),
+)
+# Offset and magic number of the headers of uncompressed POSIX tar archives
+_USTAR_MAGIC_OFFSET = 257
+_USTAR_MAGIC = b'ustar'
+
+# Size of the chunks of archives written to extractors and read by the Python extractor
+# when their progress is reported
+_PROGRESS_CHUNK_SIZE = 262144
+
+# Commands decompressing stdin to stdout with multiple threads, by archive suffix.
+# The first command found is used.
+_PARALLEL_DECOMPRESSORS = {
+    '.gz': (('pigz', '-d', '-c'), ),
+    '.tgz': (('pigz', '-d', '-c'), ),
+    '.xz': (('pixz', '-d'), ('xz', '-d', '-c', '-T0')),
+    '.txz': (('pixz', '-d'), ('xz', '-d', '-c', '-T0')),
+    '.zst': (('zstd', '-d', '-c', '-T0'), ),
+    '.tzst': (('zstd', '-d', '-c', '-T0'), ),
+}
+
+# Number of threads writing files extracted by the Python tar extractor
+_WRITER_THREADS = 4
+# Maximum number of files read by the Python tar extractor waiting to be written
+_MAX_PENDING_WRITES = 64
+# Size of files streamed directly by the thread reading the archive, to limit memory use
+_INLINE_WRITE_SIZE = 8 * 1024 * 1024
+# Size of the chunks of files streamed from the archive
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# First version of XZ Utils that decompresses with multiple threads
+_XZ_PARALLEL_VERSION = (5, 4)
+
 
 def _find_7z_by_registry():
     """
@@ -68,6 +130,29 @@ def _find_extractor_by_cmd(extractor_cmd):
     return shutil.which(extractor_cmd)
 
 
+def _supports_parallel_decompression(binary):
+    """Returns True if the decompressor binary decompresses with multiple threads"""
+    if Path(binary).name.split('.')[0] != 'xz':
+        return True
+    # Older versions of xz accept -T0 but decompress with a single thread
+    result = subprocess.run((binary, '--version'), stdout=subprocess.PIPE, check=False)
+    match = re.search(rb'(\d+)\.(\d+)', result.stdout)
+    return bool(match) and tuple(map(int, match.groups())) >= _XZ_PARALLEL_VERSION
+
+
+@functools.lru_cache(maxsize=None)
+def get_parallel_decompressor(suffix):
+    """
+    Returns the command line of a parallel decompressor reading an archive with the
+    given suffix from stdin, or None if no parallel decompressor is available.
+    """
+    for cmd in _PARALLEL_DECOMPRESSORS.get(suffix, ()):
+        binary = shutil.which(cmd[0])
+        if binary and _supports_parallel_decompression(binary):
+            return (binary, *cmd[1:])
+    return None
+
+
 def _process_relative_to(unpack_root, relative_to):
     """
     For an extractor that doesn't support an automatic transform, move the extracted
@@ -116,20 +201,132 @@ def _extract_tar_with_7z(binary, archive_path, output_dir, relative_to, skip_unu
     _process_relative_to(output_dir, relative_to)
 
 
-def _extract_tar_with_tar(binary, archive_path, output_dir, relative_to, skip_unused, sysroot):
-    get_logger().debug('Using BSD or GNU tar extractor')
-    output_dir.mkdir(exist_ok=True)
-    cmd = (binary, '-xf', str(archive_path), '-C', str(output_dir))
+def _get_tar_exclude_args(relative_to, skip_unused, sysroot):
+    """Returns a tuple of tar options excluding unused paths if skip_unused is True"""
+    exclude_args = ()
     if skip_unused:
         for cpath in CONTINGENT_PATHS:
             if sysroot and f'{sysroot}-sysroot' in cpath:
                 continue
-            cmd += ('--exclude=%s/%s' % (str(relative_to), cpath[:-1]), )
+            exclude_args += ('--exclude=%s/%s' % (str(relative_to), cpath[:-1]), )
+    return exclude_args
+
+
+def _get_stdin_compression_args(archive_path):
+    """
+    Returns the tuple of tar options to decompress the archive at archive_path from stdin,
+    or None if its compression is unknown.
+    """
+    with archive_path.open('rb') as archive_file:
+        header = archive_file.read(_USTAR_MAGIC_OFFSET + len(_USTAR_MAGIC))
+    for magic, compression_args in _TAR_STDIN_MAGIC_ARGS:
+        if header.startswith(magic):
+            return compression_args
+    if header[_USTAR_MAGIC_OFFSET:] == _USTAR_MAGIC:
+        return ()
+    return None
+
+
+def _write_archive(archive_path, writer, progress):
+    """
+    Writes the archive at archive_path to the binary file object writer of a pipe and closes it.
+    Writing stops early if the reader of the pipe exits.
+
+    progress is a callable to report (written_bytes, total_bytes) to.
+    """
+    total_size = archive_path.stat().st_size
+    written_bytes = 0
+    try:
+        with archive_path.open('rb') as archive_file:
+            for chunk in iter(functools.partial(archive_file.read, _PROGRESS_CHUNK_SIZE), b''):
+                writer.write(chunk)
+                written_bytes += len(chunk)
+                progress(written_bytes, total_size)
+    except BrokenPipeError:
+        # The exit status of the reader tells why it stopped
+        pass
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            writer.close()
+
+
+def _run_tar_with_decompressor(binary,
+                               decompressor_cmd,
+                               archive_path,
+                               output_dir,
+                               exclude_args,
+                               progress=None):
+    """
+    Extracts archive_path with tar reading the output of decompressor_cmd through a pipe.
+
+    progress is a callable to report (read_bytes, total_bytes) of the archive to, or None.
+    The archive is written to the decompressor through a pipe to report its progress.
+
+    Returns True if the decompressor and tar succeeded; False otherwise.
+    """
+    cmd = (binary, '-x', '-f', '-', '-C', str(output_dir), *exclude_args)
+    get_logger().debug('Decompressor command line: %s', ' '.join(decompressor_cmd))
     get_logger().debug('tar command line: %s', ' '.join(cmd))
-    result = subprocess.run(cmd, check=False)
-    if result.returncode != 0:
-        get_logger().error('tar command returned %s', result.returncode)
-        raise Exception()
+    with contextlib.ExitStack() as stack:
+        if progress:
+            decompressor_stdin = subprocess.PIPE
+        else:
+            decompressor_stdin = stack.enter_context(archive_path.open('rb'))
+        decompressor = subprocess.Popen(decompressor_cmd,
+                                        stdin=decompressor_stdin,
+                                        stdout=subprocess.PIPE)
+        try:
+            tar_process = subprocess.Popen(cmd, stdin=decompressor.stdout)
+        finally:
+            # Only tar reads the pipe, so the decompressor fails if tar exits early
+            decompressor.stdout.close()
+        if progress:
+            _write_archive(archive_path, decompressor.stdin, progress)
+        tar_returncode = tar_process.wait()
+        decompressor_returncode = decompressor.wait()
+    if decompressor_returncode != 0:
+        get_logger().error('Decompressor command returned %s', decompressor_returncode)
+    if tar_returncode != 0:
+        get_logger().error('tar command returned %s', tar_returncode)
+    return decompressor_returncode == 0 and tar_returncode == 0
+
+
+def _extract_tar_with_tar(binary, #pylint: disable=too-many-arguments
+                          archive_path,
+                          output_dir,
+                          relative_to,
+                          skip_unused,
+                          sysroot,
+                          parallel=True,
+                          progress=None):
+    get_logger().debug('Using BSD or GNU tar extractor')
+    output_dir.mkdir(exist_ok=True)
+    exclude_args = _get_tar_exclude_args(relative_to, skip_unused, sysroot)
+    decompressor_cmd = None
+    if parallel:
+        decompressor_cmd = get_parallel_decompressor(archive_path.suffix)
+    compression_args = None
+    if decompressor_cmd is None and progress:
+        # Write the archive to tar through a pipe to report its progress
+        compression_args = _get_stdin_compression_args(archive_path)
+    if decompressor_cmd is not None:
+        if not _run_tar_with_decompressor(binary, decompressor_cmd, archive_path, output_dir,
+                                          exclude_args, progress):
+            raise Exception()
+    else:
+        if compression_args is None:
+            cmd = (binary, '-xf', str(archive_path), '-C', str(output_dir), *exclude_args)
+            get_logger().debug('tar command line: %s', ' '.join(cmd))
+            returncode = subprocess.run(cmd, check=False).returncode
+        else:
+            cmd = (binary, '-x', *compression_args, '-f', '-', '-C', str(output_dir), *exclude_args)
+            get_logger().debug('tar command line: %s', ' '.join(cmd))
+            tar_process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            _write_archive(archive_path, tar_process.stdin, progress)
+            returncode = tar_process.wait()
+        if returncode != 0:
+            get_logger().error('tar command returned %s', returncode)
+            raise Exception()
 
     # for gnu tar, the --transform option could be used. but to keep compatibility with
     # bsdtar on macos, we just do this ourselves
@@ -154,63 +351,399 @@ def _extract_tar_with_winrar(binary, archive_path, output_dir, relative_to, skip
     _process_relative_to(output_dir, relative_to)
 
 
-def _extract_tar_with_python(archive_path, output_dir, relative_to, skip_unused, sysroot):
+@contextlib.contextmanager
+def _open_tar_with_python(archive_path, progress=None):
+    """
+    Opens the tar archive at archive_path in stream mode and yields the tarfile.TarFile
+
+    progress is a callable to report (read_bytes, total_bytes) of the archive to, or None.
+    The progress of zstd archives decompressed by the zstd command is only reported at the end.
+    """
+    total_size = archive_path.stat().st_size
+    with contextlib.ExitStack() as stack:
+        xz_reader = None
+        if archive_path.suffix == '.xz':
+            # Decompress the blocks of multi-block archives concurrently
+            xz_reader = open_parallel_xz(archive_path, progress=progress)
+        if is_zstd_archive(archive_path.name) and not (progress and zstd_module):
+            tar_file_obj = open_zstd_tar(archive_path, 'r')
+        elif xz_reader is not None:
+            get_logger().debug('Decompressing xz blocks in parallel')
+            stack.enter_context(xz_reader)
+            tar_file_obj = tarfile.open(fileobj=xz_reader, mode='r|')
+        elif progress:
+            archive_file = stack.enter_context(
+                io.BufferedReader(ProgressReader(archive_path.open('rb'), total_size, progress),
+                                  _PROGRESS_CHUNK_SIZE))
+            compression = 'zst' if is_zstd_archive(archive_path.name) else archive_path.suffix[1:]
+            tar_file_obj = tarfile.open(fileobj=archive_file, mode='r|' + compression)
+        else:
+            tar_file_obj = tarfile.open(str(archive_path), 'r|%s' % archive_path.suffix[1:])
+        with tar_file_obj:
+            yield tar_file_obj
+    if progress:
+        # The end of the archive may be found before its padding is read
+        progress(total_size, total_size)
+
+
+def _extract_tar_with_python(archive_path,
+                             output_dir,
+                             relative_to,
+                             skip_unused,
+                             sysroot,
+                             progress=None):
     get_logger().debug('Using pure Python tar extractor')
+    with _open_tar_with_python(archive_path, progress) as tar_file_obj:
+        _extract_tar_members(tar_file_obj, output_dir, relative_to, skip_unused, sysroot)
 
-    class NoAppendList(list):
-        """Hack to workaround memory issues with large tar files"""
-        def append(self, obj):
-            pass
 
+@functools.lru_cache(maxsize=None)
+def _symlinks_supported():
+    """Returns True if the system supports symlinks; False otherwise"""
     # Simple hack to check if symlinks are supported
     try:
         os.symlink('', '')
     except FileNotFoundError:
         # Symlinks probably supported
-        symlink_supported = True
+        return True
     except OSError:
         # Symlinks probably not supported
         get_logger().info('System does not support symlinks. Ignoring them.')
-        symlink_supported = False
+        return False
     except BaseException:
         # Unexpected exception
         get_logger().exception('Unexpected exception during symlink support check.')
         raise
+    return True
+
+
+def _get_unused_regex(relative_to, skip_unused, sysroot):
+    """
+    Returns a compiled regex matching the names of unused tar members if skip_unused is True,
+    or None otherwise.
+    """
+    if not skip_unused:
+        return None
+    prefixes = [
+        str(relative_to) + '/' + cpath for cpath in CONTINGENT_PATHS
+        if not (sysroot and f'{sysroot}-sysroot' in cpath)
+    ]
+    if not prefixes:
+        return None
+    return re.compile('|'.join(map(re.escape, prefixes)))
+
+
+def _set_member_attributes(path, tarinfo):
+    """Sets the permissions and modification time of tarinfo to path"""
+    os.chmod(str(path), tarinfo.mode & 0o7777)
+    os.utime(str(path), (tarinfo.mtime, tarinfo.mtime))
+
+
+def _write_member_file(path, data, tarinfo):
+    """
+    Writes the data of the regular file member tarinfo to path
+
+    data is the bytes of the member, or the file object to stream them from.
+    """
+    if path.is_symlink():
+        path.unlink()
+    with path.open('wb') as member_file:
+        if isinstance(data, bytes):
+            member_file.write(data)
+        else:
+            shutil.copyfileobj(data, member_file, _STREAM_CHUNK_SIZE)
+    _set_member_attributes(path, tarinfo)
+
+
+def _replace_changed_file(path, member_stream, tarinfo):
+    """
+    Compares the existing file path with the data streamed from member_stream of the
+    regular file member tarinfo, which has the same size. If they differ, path is replaced
+    with a new file of the data, since member_stream cannot be read again.
+
+    Returns True if the file is unchanged; False if it was replaced.
+    """
+    with path.open('rb') as existing_file:
+        offset = 0
+        while True:
+            chunk = member_stream.read(_STREAM_CHUNK_SIZE)
+            if not chunk:
+                return True
+            if existing_file.read(len(chunk)) != chunk:
+                break
+            offset += len(chunk)
+        # Write a new file instead of modifying one that may be hardlinked
+        tmp_path = path.with_name(path.name + '.update')
+        with tmp_path.open('wb') as tmp_file:
+            existing_file.seek(0)
+            while offset > 0:
+                prefix = existing_file.read(min(offset, _STREAM_CHUNK_SIZE))
+                tmp_file.write(prefix)
+                offset -= len(prefix)
+            tmp_file.write(chunk)
+            shutil.copyfileobj(member_stream, tmp_file, _STREAM_CHUNK_SIZE)
+    _set_member_attributes(tmp_path, tarinfo)
+    os.replace(str(tmp_path), str(path))
+    return False
+
 
-    with tarfile.open(str(archive_path), 'r|%s' % archive_path.suffix[1:]) as tar_file_obj:
-        tar_file_obj.members = NoAppendList()
-        for tarinfo in tar_file_obj:
+class _FileWriterPool:
+    """
+    Writes files in a thread pool while the tar archive is read.
+
+    The number of files waiting to be written is bounded to limit memory use. Writes of
+    the same path are serialized so that later members of the archive replace earlier ones.
+    """
+    def __init__(self, write_file):
+        """write_file is the function called with the arguments of submit() to write a file"""
+        self._write_file = write_file
+        self._executor = ThreadPoolExecutor(max_workers=_WRITER_THREADS)
+        self._slots = threading.BoundedSemaphore(_MAX_PENDING_WRITES)
+        self._pending = {}
+
+    def wait_for(self, path):
+        """Waits for the pending write of path if any"""
+        future = self._pending.pop(path, None)
+        if future is not None:
+            future.result()
+
+    def submit(self, path, data, tarinfo):
+        """Queues writing data as the file member tarinfo to path"""
+        self.wait_for(path)
+        self._slots.acquire()
+        future = self._executor.submit(self._write_file, path, data, tarinfo)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending[path] = future
+        if len(self._pending) > 2 * _MAX_PENDING_WRITES:
+            # Forget finished writes, raising their exceptions if any
+            for done_path in [x for x, y in self._pending.items() if y.done()]:
+                self._pending.pop(done_path).result()
+
+    def close(self):
+        """Waits for all writes to finish. Raises the exception of the first failed write."""
+        try:
+            for future in self._pending.values():
+                future.result()
+        finally:
+            self._pending.clear()
+            self._executor.shutdown(wait=True)
+
+
+class _TarMemberExtractor:
+    """Extracts the members of a tar archive read in stream mode into a directory"""
+    def __init__(self, output_dir, relative_to):
+        self._output_dir = output_dir
+        self._relative_to = relative_to
+        self._created_dirs = set()
+        # Directories get their attributes after all files are extracted into them
+        self._directories = []
+        # Hardlinks are created after the files they link to are written
+        self._hardlinks = []
+        self._writer_pool = _FileWriterPool(self._write_file)
+
+    def _get_destination(self, name):
+        if self._relative_to is None:
+            return self._output_dir / PurePosixPath(name)
+        return self._output_dir / PurePosixPath(name).relative_to(self._relative_to)
+
+    def _make_dirs(self, path):
+        """Creates the directory path and its parents if they were not created already"""
+        if path in self._created_dirs:
+            return
+        path.mkdir(parents=True, exist_ok=True)
+        while path not in self._created_dirs and path != self._output_dir:
+            self._created_dirs.add(path)
+            path = path.parent
+
+    # Writes a regular file member to a path. Called from multiple threads.
+    _write_file = staticmethod(_write_member_file)
+
+    def extract(self, tar_file_obj, tarinfo):
+        """Extracts the current member tarinfo of tar_file_obj"""
+        destination = self._get_destination(tarinfo.name)
+        if tarinfo.isdir():
+            self._make_dirs(destination)
+            self._directories.append((destination, tarinfo))
+            return
+        self._make_dirs(destination.parent)
+        if tarinfo.isreg():
+            member_stream = tar_file_obj.extractfile(tarinfo)
+            if tarinfo.size > _INLINE_WRITE_SIZE:
+                # Large files are streamed instead of being read into memory
+                self._writer_pool.wait_for(destination)
+                self._write_file(destination, member_stream, tarinfo)
+            else:
+                self._writer_pool.submit(destination, member_stream.read(), tarinfo)
+        elif tarinfo.issym():
+            if not _symlinks_supported():
+                # If symlinks are not supported, it's safe to assume that symlinks
+                # aren't needed. The only situation where this happens is on Windows.
+                return
+            self._writer_pool.wait_for(destination)
+            if destination.is_symlink() or destination.exists():
+                destination.unlink()
+            os.symlink(tarinfo.linkname, str(destination))
+        elif tarinfo.islnk():
+            self._hardlinks.append((self._get_destination(tarinfo.linkname), destination))
+        else:
+            get_logger().debug('Skipping tar member of unsupported type: %s', tarinfo.name)
+
+    def _make_hardlinks(self):
+        for target, destination in self._hardlinks:
+            if not target.exists():
+                get_logger().warning('Skipping hardlink %s to missing %s', destination, target)
+                continue
+            if destination.is_symlink() or destination.exists():
+                destination.unlink()
+            try:
+                os.link(str(target), str(destination))
+            except OSError:
+                shutil.copy2(str(target), str(destination))
+
+    def close(self):
+        """Finishes the extraction once all members are extracted"""
+        self._writer_pool.close()
+        self._make_hardlinks()
+        for destination, tarinfo in sorted(self._directories, reverse=True):
+            _set_member_attributes(destination, tarinfo)
+
+    def abort(self):
+        """Waits for pending writes to stop after an error, ignoring their exceptions"""
+        try:
+            self._writer_pool.close()
+        except Exception: #pylint: disable=broad-except
+            pass
+
+
+class _TarMemberUpdater(_TarMemberExtractor):
+    """
+    Updates an existing directory to the members of a tar archive read in stream mode.
+
+    Only files whose size or content differ are written, so unchanged files keep their
+    modification times. Files that are not members are removed when closing.
+    """
+    def __init__(self, output_dir, relative_to, keep_paths):
+        """keep_paths is an iterable of pathlib.Path in output_dir to never remove"""
+        super().__init__(output_dir, relative_to)
+        self._keep_paths = set(map(str, keep_paths))
+        # Paths of all members, as strings to limit memory use
+        self._member_paths = set()
+        self._lock = threading.Lock()
+        self.counts = {'unchanged': 0, 'written': 0, 'removed': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def _write_file(self, path, data, tarinfo):
+        try:
+            stat_result = path.lstat()
+        except FileNotFoundError:
+            stat_result = None
+        if stat_result is not None and stat.S_ISREG(
+                stat_result.st_mode) and stat_result.st_size == tarinfo.size:
+            if isinstance(data, bytes):
+                with path.open('rb') as existing_file:
+                    unchanged = existing_file.read() == data
+            else:
+                unchanged = _replace_changed_file(path, data, tarinfo)
+                if not unchanged:
+                    self._count('written')
+                    return
+            if unchanged:
+                if (stat_result.st_mode ^ tarinfo.mode) & 0o111:
+                    # Files may be hardlinks of a pristine tree, so do not change them in place
+                    break_link(path)
+                    os.chmod(str(path), tarinfo.mode & 0o7777)
+                self._count('unchanged')
+                return
+        if stat_result is not None:
+            # Write a new file instead of modifying one that may be hardlinked
+            if stat.S_ISDIR(stat_result.st_mode):
+                shutil.rmtree(str(path))
+            else:
+                path.unlink()
+        _write_member_file(path, data, tarinfo)
+        self._count('written')
+
+    def extract(self, tar_file_obj, tarinfo):
+        destination = self._get_destination(tarinfo.name)
+        self._member_paths.add(str(destination))
+        if tarinfo.issym() and destination.is_symlink() and os.readlink(
+                str(destination)) == tarinfo.linkname:
+            self._count('unchanged')
+            return
+        super().extract(tar_file_obj, tarinfo)
+
+    def _remove_absent(self):
+        """Removes the files and then the empty directories that are not members"""
+        absent_dirs = []
+        for dir_path, dir_names, file_names in os.walk(str(self._output_dir)):
+            for name in list(dir_names):
+                path = os.path.join(dir_path, name)
+                if path in self._keep_paths or os.path.islink(path):
+                    # Symlinks to directories are removed like files
+                    dir_names.remove(name)
+                    if path not in self._keep_paths:
+                        file_names.append(name)
+                elif path not in self._member_paths:
+                    absent_dirs.append(path)
+            for name in file_names:
+                path = os.path.join(dir_path, name)
+                if path not in self._member_paths and path not in self._keep_paths:
+                    os.unlink(path)
+                    self._count('removed')
+        for path in reversed(absent_dirs):
             try:
-                if skip_unused and [
-                        cpath for cpath in CONTINGENT_PATHS
-                        if tarinfo.name.startswith(str(relative_to) + '/' + cpath)
-                        and not (sysroot and f'{sysroot}-sysroot' in cpath)
-                ]:
-                    continue
-                if relative_to is None:
-                    destination = output_dir / PurePosixPath(tarinfo.name)
-                else:
-                    destination = output_dir / PurePosixPath(tarinfo.name).relative_to(relative_to)
-                if tarinfo.issym() and not symlink_supported:
-                    # In this situation, TarFile.makelink() will try to create a copy of the
-                    # target. But this fails because TarFile.members is empty
-                    # But if symlinks are not supported, it's safe to assume that symlinks
-                    # aren't needed. The only situation where this happens is on Windows.
-                    continue
-                if tarinfo.islnk():
-                    # Derived from TarFile.extract()
-                    new_target = output_dir / PurePosixPath(
-                        tarinfo.linkname).relative_to(relative_to)
-                    tarinfo._link_target = new_target.as_posix() # pylint: disable=protected-access
-                if destination.is_symlink():
-                    destination.unlink()
-                tar_file_obj._extract_member(tarinfo, str(destination)) # pylint: disable=protected-access
-            except BaseException:
-                get_logger().exception('Exception thrown for tar member: %s', tarinfo.name)
-                raise
-
-
-def extract_tar_file(archive_path, output_dir, relative_to, skip_unused, sysroot, extractors=None):
+                os.rmdir(path)
+            except OSError:
+                # The directory is not empty because it contains kept paths
+                pass
+
+    def close(self):
+        super().close()
+        self._remove_absent()
+
+
+def _extract_tar_members(tar_file_obj,
+                         output_dir,
+                         relative_to,
+                         skip_unused,
+                         sysroot,
+                         member_extractor=None):
+    """
+    Extracts the members of the tarfile.TarFile tar_file_obj opened in stream mode.
+    member_extractor is the _TarMemberExtractor to use, if not a new one.
+    """
+    unused_regex = _get_unused_regex(relative_to, skip_unused, sysroot)
+    if member_extractor is None:
+        member_extractor = _TarMemberExtractor(output_dir, relative_to)
+    try:
+        tarinfo = tar_file_obj.next()
+        while tarinfo is not None:
+            # Reading a stream does not need the previous members, so avoid keeping
+            # the members of large archives in memory
+            tar_file_obj.members.clear()
+            if unused_regex is None or not unused_regex.match(tarinfo.name):
+                try:
+                    member_extractor.extract(tar_file_obj, tarinfo)
+                except BaseException:
+                    get_logger().exception('Exception thrown for tar member: %s', tarinfo.name)
+                    raise
+            tarinfo = tar_file_obj.next()
+    except BaseException:
+        member_extractor.abort()
+        raise
+    member_extractor.close()
+
+
+def extract_tar_file(archive_path,
+                     output_dir,
+                     relative_to,
+                     skip_unused,
+                     sysroot,
+                     extractors=None,
+                     progress=None):
     """
     Extract regular or compressed tar archive into the output directory.
 
@@ -221,12 +754,34 @@ def extract_tar_file(archive_path, output_dir, relative_to, skip_unused, sysroot
         root of the archive, or None if no path components should be stripped.
     extractors is a dictionary of PlatformEnum to a command or path to the
         extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip and WinRAR.
+    progress is a callable to report (read_bytes, total_bytes) of the archive to, or None.
+        The archive is written to tar or the parallel decompressor through a pipe to report
+        its progress. The progress of 7-Zip and WinRAR is not reported.
+
+    On UNIX, compressed archives are decompressed by a parallel decompressor (pigz, pixz,
+    xz 5.4 or newer, or zstd) piped into tar if one is available.
+    zstd-compressed archives are unpacked by tar if the zstd command is available,
+    and by the Python extractor otherwise. The Python extractor decompresses the blocks
+    of multi-block xz archives concurrently.
     """
     if extractors is None:
         extractors = DEFAULT_EXTRACTORS
 
     current_platform = get_running_platform()
-    if current_platform == PlatformEnum.WINDOWS:
+    if is_zstd_archive(archive_path.name):
+        # 7-Zip and WinRAR may not support zstd, and tar needs the zstd command
+        if current_platform == PlatformEnum.UNIX and shutil.which('zstd'):
+            tar_bin = _find_extractor_by_cmd(extractors.get(ExtractorEnum.TAR))
+            if tar_bin is not None:
+                _extract_tar_with_tar(tar_bin,
+                                      archive_path,
+                                      output_dir,
+                                      relative_to,
+                                      skip_unused,
+                                      sysroot,
+                                      progress=progress)
+                return
+    elif current_platform == PlatformEnum.WINDOWS:
         # Try to use 7-zip first
         sevenzip_cmd = extractors.get(ExtractorEnum.SEVENZIP)
         if sevenzip_cmd == USE_REGISTRY:
@@ -252,14 +807,196 @@ def extract_tar_file(archive_path, output_dir, relative_to, skip_unused, sysroot
         # NOTE: 7-zip isn't an option because it doesn't preserve file permissions
         tar_bin = _find_extractor_by_cmd(extractors.get(ExtractorEnum.TAR))
         if not tar_bin is None:
-            _extract_tar_with_tar(tar_bin, archive_path, output_dir, relative_to, skip_unused,
-                                  sysroot)
+            _extract_tar_with_tar(tar_bin,
+                                  archive_path,
+                                  output_dir,
+                                  relative_to,
+                                  skip_unused,
+                                  sysroot,
+                                  progress=progress)
             return
     else:
         # This is not a normal code path, so make it clear.
         raise NotImplementedError(current_platform)
     # Fallback to Python-based extractor on all platforms
-    _extract_tar_with_python(archive_path, output_dir, relative_to, skip_unused, sysroot)
+    _extract_tar_with_python(archive_path, output_dir, relative_to, skip_unused, sysroot, progress)
+
+
+def update_tar_file(archive_path,
+                    output_dir,
+                    relative_to,
+                    skip_unused,
+                    sysroot,
+                    keep_paths=(),
+                    progress=None):
+    """
+    Update an existing directory to the contents of a regular or compressed tar archive.
+
+    Each file is compared with its member by size and content, and only rewritten if it
+    differs, so unchanged files keep their modification times. Files and empty directories
+    in output_dir that are not in the archive are removed, except for keep_paths.
+    The archive is read by the Python extractor.
+
+    keep_paths is an iterable of pathlib.Path in output_dir to keep, e.g. the output
+        directories of other downloads or build outputs.
+    progress is a callable to report (read_bytes, total_bytes) of the archive to, or None.
+    The other arguments are the same as for extract_tar_file().
+
+    Returns a dict of the number of files 'unchanged', 'written' and 'removed'.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    member_updater = _TarMemberUpdater(output_dir, relative_to, keep_paths)
+    with _open_tar_with_python(archive_path, progress) as tar_file_obj:
+        _extract_tar_members(tar_file_obj, output_dir, relative_to, skip_unused, sysroot,
+                             member_updater)
+    return member_updater.counts
+
+
+class TarStreamExtractor: #pylint: disable=too-many-instance-attributes
+    """
+    Extracts a regular or compressed tar archive into a directory while its data is written.
+
+    On UNIX, archives with a known compression suffix are extracted by BSD or GNU tar reading
+    from a pipe; otherwise, the Python tar extractor reads from a pipe in a thread.
+    If the extractor fails before all data is written, further data is discarded and
+    the failure is raised by close().
+    """
+    def __init__(self, #pylint: disable=too-many-arguments
+                 archive_name,
+                 output_dir,
+                 relative_to,
+                 skip_unused,
+                 sysroot,
+                 extractors=None):
+        """
+        archive_name is the file name of the archive, to determine its compression.
+        The other arguments are the same as extract_tar_file().
+        """
+        if extractors is None:
+            extractors = DEFAULT_EXTRACTORS
+        self._output_dir = output_dir
+        self._relative_to = relative_to
+        self._process = None
+        self._decompressor = None
+        self._thread = None
+        self._error = None
+        self._broken = False
+        tar_bin = None
+        is_zstd = is_zstd_archive(archive_name)
+        compression_args = _TAR_STDIN_COMPRESSION_ARGS.get(Path(archive_name).suffix)
+        if get_running_platform() == PlatformEnum.UNIX and compression_args is not None and (
+                not is_zstd or shutil.which('zstd')):
+            tar_bin = _find_extractor_by_cmd(extractors.get(ExtractorEnum.TAR))
+        if tar_bin is None:
+            get_logger().debug('Using pure Python tar extractor on stream')
+            tar_mode = 'r|*'
+            if is_zstd and zstd_module is None:
+                # The zstd command decompresses the data for the Python extractor
+                self._decompressor = start_zstd_decompressor(stdin=subprocess.PIPE,
+                                                             stdout=subprocess.PIPE)
+                self._writer = self._decompressor.stdin
+                reader = self._decompressor.stdout
+                tar_mode = 'r|'
+            else:
+                read_fd, write_fd = os.pipe()
+                self._writer = os.fdopen(write_fd, 'wb')
+                reader = os.fdopen(read_fd, 'rb')
+                if is_zstd:
+                    tar_mode = 'r|zst'
+            self._thread = threading.Thread(target=self._extract_with_python,
+                                            args=(reader, tar_mode, skip_unused, sysroot),
+                                            daemon=True)
+            self._thread.start()
+        else:
+            get_logger().debug('Using BSD or GNU tar extractor on stream')
+            cmd = (tar_bin, '-x', *compression_args, '-f', '-', '-C', str(output_dir))
+            cmd += _get_tar_exclude_args(relative_to, skip_unused, sysroot)
+            get_logger().debug('tar command line: %s', ' '.join(cmd))
+            self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            self._writer = self._process.stdin
+
+    def _extract_with_python(self, reader, tar_mode, skip_unused, sysroot):
+        try:
+            with tarfile.open(fileobj=reader, mode=tar_mode) as tar_file_obj:
+                _extract_tar_members(tar_file_obj, self._output_dir, self._relative_to,
+                                     skip_unused, sysroot)
+            # Read the padding after the end of the archive, so the decompressor can finish
+            while reader.read(1 << 16):
+                pass
+        except BaseException as exc: #pylint: disable=broad-except
+            self._error = exc
+        finally:
+            # Unblock the writer if the archive ended or failed before the end of the data
+            reader.close()
+
+    def write(self, data):
+        """Writes the next data of the archive"""
+        if self._broken:
+            return
+        try:
+            self._writer.write(data)
+        except BrokenPipeError:
+            self._broken = True
+
+    def close(self):
+        """
+        Waits for the extraction of the written data to finish.
+
+        Raises an exception if the extraction failed.
+        """
+        try:
+            self._writer.close()
+        except BrokenPipeError:
+            pass
+        if self._process is not None:
+            if self._process.wait() != 0:
+                get_logger().error('tar command returned %s', self._process.returncode)
+                raise Exception()
+            _process_relative_to(self._output_dir, self._relative_to)
+        else:
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+            if self._decompressor is not None and self._decompressor.wait() != 0:
+                get_logger().error('zstd command returned %s', self._decompressor.returncode)
+                raise Exception()
+
+    def abort(self):
+        """Stops the extraction. The output directory may contain partially extracted files."""
+        if self._process is not None:
+            self._process.kill()
+        if self._decompressor is not None:
+            self._decompressor.kill()
+        try:
+            self._writer.close()
+        except BrokenPipeError:
+            pass
+        if self._process is not None:
+            self._process.wait()
+        else:
+            self._thread.join()
+        if self._decompressor is not None:
+            self._decompressor.wait()
+
+
+def move_tree(source_dir, target_dir):
+    """
+    Moves the content of the directory source_dir into target_dir, replacing existing files,
+    and removes source_dir. Both must be on the same file system.
+    """
+    if not target_dir.exists():
+        target_dir.parent.mkdir(parents=True, exist_ok=True)
+        source_dir.rename(target_dir)
+        return
+    for source_path in source_dir.iterdir():
+        target_path = target_dir / source_path.name
+        if target_path.is_dir() and not target_path.is_symlink():
+            if source_path.is_dir() and not source_path.is_symlink():
+                move_tree(source_path, target_path)
+                continue
+            shutil.rmtree(str(target_path))
+        os.replace(str(source_path), str(target_path))
+    source_dir.rmdir()
 
 
 def extract_with_7z(archive_path, output_dir, relative_to, skip_unused, sysroot, extractors=None):
@@ -0,0 +1,214 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Progress reporting and metrics of downloading, checking and unpacking
+"""
+
+import contextlib
+import io
+import json
+import threading
+import time
+
+from _common import ENCODING, get_logger
+
+# Minimum number of seconds between progress updates printed to the console
+_PRINT_INTERVAL = 0.5
+# Minimum number of seconds between progress events written to the metrics file
+_EVENT_INTERVAL = 5.0
+
+
+def format_size(size):
+    """Returns a human-readable string of size in bytes"""
+    if size < 1024:
+        return '{:d} B'.format(int(size))
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+    return '{:.1f} TiB'.format(size / 1024)
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+class MetricsRecorder:
+    """
+    Records the time spent and bytes processed per phase of each component.
+
+    Phases are logged when they end. If an output file is opened, phases and rate-limited
+    progress are also written to it as JSON lines, each an object with the keys "time"
+    (seconds since the epoch) and "event", and the fields of the event.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._output_file = None
+
+    def open(self, output_path):
+        """Appends events to the file at the pathlib.Path output_path"""
+        self.close()
+        self._output_file = output_path.open('a', encoding=ENCODING)
+
+    def close(self):
+        """Closes the output file if any"""
+        with self._lock:
+            if self._output_file is not None:
+                self._output_file.close()
+                self._output_file = None
+
+    def emit(self, event, **fields):
+        """Writes an event with fields to the output file if any"""
+        if self._output_file is None:
+            return
+        line = json.dumps({'time': round(time.time(), 3), 'event': event, **fields})
+        with self._lock:
+            if self._output_file is not None:
+                self._output_file.write(line + '\n')
+                self._output_file.flush()
+
+    @contextlib.contextmanager
+    def phase(self, phase, component):
+        """
+        Context manager measuring a phase (e.g. "download") of component.
+
+        Yields a dict to set the number of bytes processed by the phase in as "bytes".
+        """
+        self.emit('phase_start', phase=phase, component=component)
+        result = {}
+        status = 'error'
+        start_time = time.monotonic()
+        try:
+            yield result
+            status = 'ok'
+        finally:
+            seconds = time.monotonic() - start_time
+            fields = {'phase': phase, 'component': component, 'status': status}
+            fields['seconds'] = round(seconds, 3)
+            summary = _format_duration(seconds)
+            if result.get('bytes') is not None:
+                fields['bytes'] = result['bytes']
+                if seconds > 0:
+                    fields['bytes_per_second'] = round(result['bytes'] / seconds)
+                    summary += ', {}/s'.format(format_size(result['bytes'] / seconds))
+            self.emit('phase_end', **fields)
+            if status == 'ok':
+                get_logger().info('Finished %s of "%s" in %s', phase, component, summary)
+
+
+_METRICS = MetricsRecorder()
+
+
+def get_metrics():
+    """Gets the process-wide MetricsRecorder"""
+    return _METRICS
+
+
+class ProgressReporter: #pylint: disable=too-many-instance-attributes
+    """
+    Callable reporting the progress of a phase as (current_bytes, total_bytes), with its
+    throughput and estimated time remaining. total_bytes is -1 if unknown.
+
+    Console output and progress events are rate-limited. It is safe to call from
+    multiple threads.
+    """
+    def __init__(self, phase, component, show_progress=True):
+        self._phase = phase
+        self._component = component
+        self._show_progress = show_progress
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        # The first reported value, e.g. the size of a resumed download
+        self._start_bytes = None
+        self._current_bytes = None
+        self._last_print = None
+        self._last_event = None
+        self._max_len_printed = 0
+
+    def __call__(self, current_bytes, total_bytes=-1):
+        now = time.monotonic()
+        with self._lock:
+            if self._start_bytes is None:
+                self._start_bytes = current_bytes
+            self._current_bytes = current_bytes
+            done = 0 <= total_bytes <= current_bytes
+            print_due = self._last_print is None or now - self._last_print >= _PRINT_INTERVAL
+            event_due = self._last_event is None or now - self._last_event >= _EVENT_INTERVAL
+            if not (done or print_due or event_due):
+                return
+            elapsed = now - self._start_time
+            rate = (current_bytes - self._start_bytes) / elapsed if elapsed > 0 else 0
+            eta = None
+            if total_bytes >= 0 and rate > 0:
+                eta = (total_bytes - current_bytes) / rate
+            if self._show_progress and (done or print_due):
+                self._last_print = now
+                self._print(current_bytes, total_bytes, rate, eta)
+            if done or event_due:
+                self._last_event = now
+                get_metrics().emit('progress',
+                                   phase=self._phase,
+                                   component=self._component,
+                                   bytes=current_bytes,
+                                   total_bytes=total_bytes,
+                                   bytes_per_second=round(rate),
+                                   eta_seconds=None if eta is None else round(eta, 1))
+
+    def _print(self, current_bytes, total_bytes, rate, eta):
+        if total_bytes > 0:
+            status_line = 'Progress: {:.1%} of {}'.format(current_bytes / total_bytes,
+                                                         format_size(total_bytes))
+        else:
+            status_line = 'Progress: {} of unknown size'.format(format_size(current_bytes))
+        status_line += ', {}/s'.format(format_size(rate))
+        if eta is not None:
+            status_line += ', ETA {}'.format(_format_duration(eta))
+        print('\r' + status_line.ljust(self._max_len_printed), end='')
+        self._max_len_printed = len(status_line)
+
+    @property
+    def transferred_bytes(self):
+        """The number of bytes processed since the first report, or None if nothing was reported"""
+        if self._current_bytes is None:
+            return None
+        return self._current_bytes - self._start_bytes
+
+    def finish(self):
+        """Ends the progress line on the console if any was printed"""
+        with self._lock:
+            if self._last_print is not None:
+                print()
+                self._last_print = None
+
+
+class ProgressReader(io.RawIOBase):
+    """Readable binary file object reporting the bytes read from another one"""
+    def __init__(self, file_obj, total_bytes, progress):
+        """
+        file_obj is the binary file object to read. It is closed with the reader.
+        progress is a callable to report (read_bytes, total_bytes) to, like a ProgressReporter.
+        """
+        super().__init__()
+        self._file_obj = file_obj
+        self._total_bytes = total_bytes
+        self._progress = progress
+        self._read_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self._file_obj.readinto(buffer)
+        self._read_bytes += size
+        self._progress(self._read_bytes, self._total_bytes)
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._file_obj.close()
+        super().close()
@@ -0,0 +1,148 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Patch bundles: a series and its patches in a single file
+
+A bundle starts with BUNDLE_MAGIC, followed by the size of its header as an 8-byte
+big-endian integer and the header as JSON. The header lists the series and, for each
+patch, its name, the offset and size of its data after the header, and the paths of the
+files it modifies. The data of the patches follows the header.
+"""
+
+import io
+import json
+import struct
+from pathlib import PurePosixPath
+
+from _common import ENCODING
+from _patching import parse_patched_paths
+
+BUNDLE_MAGIC = b'ungoogled-patch-bundle\n'
+_HEADER_SIZE_FORMAT = '>Q'
+
+# Version of the bundle header format
+_BUNDLE_VERSION = 1
+
+
+def is_bundle(path):
+    """Returns True if the pathlib.Path path is a patch bundle"""
+    if not path.is_file():
+        return False
+    with path.open('rb') as bundle_file:
+        return bundle_file.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+
+
+def write_bundle(bundle_path, series, patch_data):
+    """
+    Writes a patch bundle
+
+    bundle_path is the pathlib.Path of the bundle to write
+    series is a list of the patch names in the order to apply them
+    patch_data is a dict of the patch names in series to the bytes of the patches
+    """
+    entries = {}
+    data = io.BytesIO()
+    for name in series:
+        if name in entries:
+            continue
+        content = patch_data[name]
+        patched_paths = parse_patched_paths(content.decode(ENCODING, 'replace').splitlines())
+        entries[name] = {
+            'offset': data.tell(),
+            'size': len(content),
+            'paths': sorted(set(patched_paths))
+        }
+        data.write(content)
+    header = json.dumps({
+        'version': _BUNDLE_VERSION,
+        'series': list(series),
+        'patches': entries
+    }).encode(ENCODING)
+    tmp_path = bundle_path.with_name(bundle_path.name + '.tmp')
+    with tmp_path.open('wb') as bundle_file:
+        bundle_file.write(BUNDLE_MAGIC)
+        bundle_file.write(struct.pack(_HEADER_SIZE_FORMAT, len(header)))
+        bundle_file.write(header)
+        bundle_file.write(data.getbuffer())
+    tmp_path.replace(bundle_path)
+
+
+class BundledPatch:
+    """A patch in a bundle, which can be read like the pathlib.Path of a patch file"""
+    def __init__(self, bundle, series_name):
+        self.series_name = series_name
+        self.name = PurePosixPath(series_name).name
+        self._bundle = bundle
+
+    def __str__(self):
+        return '{}:{}'.format(self._bundle.bundle_path, self.series_name)
+
+    @property
+    def paths(self):
+        """The relative paths of the files the patch modifies"""
+        return self._bundle.get_paths(self.series_name)
+
+    @staticmethod
+    def exists():
+        """Returns True, like pathlib.Path.exists()"""
+        return True
+
+    def read_bytes(self):
+        """Returns the data of the patch"""
+        return self._bundle.read_patch(self.series_name)
+
+    def open(self, mode='r', encoding=None, errors=None):
+        """Opens the patch for reading, like pathlib.Path.open()"""
+        if mode == 'rb':
+            return io.BytesIO(self.read_bytes())
+        if mode != 'r':
+            raise ValueError('Patches in bundles can only be read')
+        return io.TextIOWrapper(io.BytesIO(self.read_bytes()), encoding=encoding, errors=errors)
+
+
+class PatchBundle:
+    """
+    A patch bundle read from a file
+
+    The header is read when the bundle is opened, and the data of each patch
+    is read from its offset when needed.
+    """
+    def __init__(self, bundle_path):
+        """Raises ValueError if bundle_path is not a valid patch bundle"""
+        self.bundle_path = bundle_path
+        with bundle_path.open('rb') as bundle_file:
+            if bundle_file.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+                raise ValueError('Not a patch bundle: {}'.format(bundle_path))
+            size_data = bundle_file.read(struct.calcsize(_HEADER_SIZE_FORMAT))
+            if len(size_data) != struct.calcsize(_HEADER_SIZE_FORMAT):
+                raise ValueError('Truncated patch bundle: {}'.format(bundle_path))
+            header_size, = struct.unpack(_HEADER_SIZE_FORMAT, size_data)
+            header = json.loads(bundle_file.read(header_size).decode(ENCODING))
+            self._data_offset = bundle_file.tell()
+        if header.get('version') != _BUNDLE_VERSION:
+            raise ValueError('Unsupported patch bundle version: {}'.format(bundle_path))
+        self.series = header['series']
+        self._entries = header['patches']
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get_paths(self, name):
+        """Returns the relative paths of the files modified by the patch name"""
+        return self._entries[name]['paths']
+
+    def read_patch(self, name):
+        """Returns the bytes of the patch name. Raises KeyError if it is not in the bundle."""
+        entry = self._entries[name]
+        with self.bundle_path.open('rb') as bundle_file:
+            bundle_file.seek(self._data_offset + entry['offset'])
+            return bundle_file.read(entry['size'])
+
+    def get_patch(self, name):
+        """Returns the BundledPatch of the patch name"""
+        if name not in self._entries:
+            raise KeyError(name)
+        return BundledPatch(self, name)
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+The record of patches applied to a source tree
+
+The state directory in the root of the tree lists the applied patches in order, with
+the hashes of the files each patch modified as they were right after applying it, and
+keeps a copy of each applied patch so it can be reversed after the original is edited.
+"""
+
+import hashlib
+import json
+import shutil
+
+from _common import ENCODING
+
+# Name of the directory in the root of the tree with the applied state
+STATE_DIR = '.applied-patches'
+_STATE_FILE = 'state.json'
+_PATCHES_DIR = 'patches'
+
+# Version of the applied state format
+_STATE_VERSION = 1
+
+
+class PatchStateError(Exception):
+    """Raised when the applied state does not match the tree or the series"""
+
+
+def hash_file(path):
+    """Returns the SHA-256 hex digest of the file at the pathlib.Path path, or None if absent"""
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class AppliedState:
+    """
+    The patches applied to a source tree
+
+    entries is a list of dicts of the applied patches, in the order they were applied, with
+    the keys 'name' (the path relative to the patches directory), 'sha256' (the hash of the
+    patch) and 'files' (a dict of the relative paths of the files it modified to their hashes
+    after applying it, or None for removed files).
+    """
+    def __init__(self, tree_path):
+        self.tree_path = tree_path
+        self.state_dir = tree_path.resolve() / STATE_DIR
+        try:
+            with (self.state_dir / _STATE_FILE).open(encoding=ENCODING) as state_file:
+                record = json.load(state_file)
+        except FileNotFoundError:
+            record = {'version': _STATE_VERSION, 'patches': []}
+        except ValueError as exc:
+            raise PatchStateError('Invalid applied state in {}: {}'.format(self.state_dir,
+                                                                           exc)) from exc
+        if record.get('version') != _STATE_VERSION:
+            raise PatchStateError('Unsupported applied state version in {}'.format(self.state_dir))
+        self.entries = record['patches']
+
+    def get_patch_copy(self, name):
+        """Returns the pathlib.Path to the copy of the applied patch name"""
+        return self.state_dir / _PATCHES_DIR / name
+
+    def _save(self):
+        if not self.entries:
+            if self.state_dir.exists():
+                shutil.rmtree(str(self.state_dir))
+            return
+        self.state_dir.mkdir(exist_ok=True)
+        state_path = self.state_dir / _STATE_FILE
+        tmp_path = state_path.with_name(state_path.name + '.tmp')
+        with tmp_path.open('w', encoding=ENCODING) as state_file:
+            json.dump({'version': _STATE_VERSION, 'patches': self.entries}, state_file, indent=1)
+        tmp_path.replace(state_path)
+
+    def get_modified_files(self):
+        """
+        Returns a sorted list of the relative paths of files modified by applied patches
+        that were changed since, e.g. by editing them outside of the patches.
+        """
+        expected_hashes = {}
+        for entry in self.entries:
+            expected_hashes.update(entry['files'])
+        return sorted(relative_path for relative_path, file_hash in expected_hashes.items()
+                      if hash_file(self.tree_path / relative_path) != file_hash)
+
+    def push(self, name, patch_path, relative_paths):
+        """
+        Records the patch at patch_path as applied under name, after it modified the files
+        at relative_paths in the tree.
+        """
+        patch_data = patch_path.read_bytes()
+        patch_copy = self.get_patch_copy(name)
+        patch_copy.parent.mkdir(parents=True, exist_ok=True)
+        patch_copy.write_bytes(patch_data)
+        self.entries.append({
+            'name': name,
+            'sha256': hashlib.sha256(patch_data).hexdigest(),
+            'files': {
+                x: hash_file(self.tree_path / x)
+                for x in sorted(relative_paths)
+            },
+        })
+        self._save()
+
+    def pop(self, count):
+        """Removes the record of the last count applied patches, after they were reversed"""
+        for entry in self.entries[len(self.entries) - count:]:
+            self.get_patch_copy(entry['name']).unlink()
+        del self.entries[len(self.entries) - count:]
+        self._save()
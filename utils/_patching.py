@@ -0,0 +1,442 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+In-process application of unified diff patches
+
+Patches are parsed with the unidiff module vendored in devutils. All patches of a series
+are applied in memory, so each file is read and written once. Hunks must match like with
+"patch --ignore-whitespace" without fuzz: context and removed lines must match exactly
+except for blanks, but hunks may be found at an offset from their line numbers.
+"""
+
+import difflib
+import io
+import os
+import re
+import stat
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+
+from _common import ENCODING, get_logger
+from _worktree import break_link
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'devutils' / 'third_party'))
+try:
+    import unidiff
+    from unidiff.constants import LINE_TYPE_NO_NEWLINE
+except ImportError:
+    unidiff = None
+finally:
+    sys.path.pop(0)
+
+_BLANKS_REGEX = re.compile(rb'[ \t]+')
+_NEW_FILE_MODE_REGEX = re.compile(r'^new file mode ([0-7]+)')
+# Lines shown in hunk headers, like diff --show-c-function
+_FUNCTION_REGEX = re.compile(rb'^[A-Za-z_$]')
+_FUNCTION_LENGTH = 40
+_NO_NEWLINE_MARKER = b'\n\\ No newline at end of file\n'
+# Lines of context of refreshed patches
+_REFRESH_CONTEXT = 3
+
+
+class PatchApplicationError(Exception):
+    """Raised when patches cannot be applied in-process"""
+
+
+def _normalize_line(line):
+    """Returns line with blanks normalized like patch --ignore-whitespace"""
+    return _BLANKS_REGEX.sub(b' ', line.rstrip())
+
+
+def _split_lines(data):
+    """Returns the lines of data, keeping their line endings"""
+    lines = [line + b'\n' for line in data.split(b'\n')]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def _strip_path(file_name):
+    """Returns the relative path of a file name in a patch, like patch -p1"""
+    parts = PurePosixPath(file_name.split('\t', 1)[0].strip()).parts
+    if len(parts) < 2 or '..' in parts or parts[0] == '/':
+        raise PatchApplicationError('Unsupported file name in patch: {}'.format(file_name))
+    return str(PurePosixPath(*parts[1:]))
+
+
+def parse_patched_paths(patch_lines):
+    """Generates the relative paths of the files modified by the lines of a -p1 unified diff"""
+    for line in patch_lines:
+        if not line.startswith(('--- ', '+++ ')):
+            continue
+        file_path = line[4:].rstrip('\n').split('\t', 1)[0].strip()
+        if file_path != '/dev/null' and '/' in file_path:
+            yield file_path.split('/', 1)[1]
+
+
+def get_patched_paths(patch_path):
+    """
+    Generates the relative paths of the files modified by a -p1 unified diff
+
+    patch_path is a pathlib.Path, or a patch with the paths already parsed like BundledPatch
+    """
+    if hasattr(patch_path, 'paths'):
+        yield from patch_path.paths
+        return
+    with patch_path.open(encoding=ENCODING, errors='replace') as patch_file:
+        yield from parse_patched_paths(patch_file)
+
+
+def group_patches(patch_paths):
+    """
+    Groups patches into chains of patches modifying common files
+
+    patch_paths is a list of pathlib.Path to patch files, in the order to apply them
+
+    Returns a list of chains, each a list of indices into patch_paths in increasing order.
+    Chains do not modify common files, so they can be applied independently of each other.
+    """
+    # Union-find forest of patch indices, with the lowest index as the root
+    parents = list(range(len(patch_paths)))
+
+    def _find_root(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    file_patches = {}
+    for index, patch_path in enumerate(patch_paths):
+        for relative_path in get_patched_paths(patch_path):
+            root = _find_root(file_patches.setdefault(relative_path, index))
+            other_root = _find_root(index)
+            parents[max(root, other_root)] = min(root, other_root)
+    chains = {}
+    for index in range(len(patch_paths)):
+        chains.setdefault(_find_root(index), []).append(index)
+    return list(chains.values())
+
+
+def _parse_hunk(hunk, reverse):
+    """
+    Returns the line number of hunk, its lines to match as a list of bytes, and its
+    resulting lines as a list of bytes or indices into the lines to match.
+    """
+    source_lines = []
+    target_lines = []
+    last_lines = []
+    for line in hunk:
+        if line.line_type == LINE_TYPE_NO_NEWLINE:
+            if last_lines and last_lines[-1].endswith(b'\n'):
+                last_lines[-1] = last_lines[-1][:-1]
+            continue
+        value = line.value.encode(ENCODING)
+        is_added, is_removed = line.is_added, line.is_removed
+        if reverse:
+            is_added, is_removed = is_removed, is_added
+        if is_added:
+            last_lines = target_lines
+            target_lines.append(value)
+        elif is_removed:
+            last_lines = source_lines
+            source_lines.append(value)
+        elif line.is_context:
+            # Context lines are kept as they are in the file
+            last_lines = source_lines
+            target_lines.append(len(source_lines))
+            source_lines.append(value)
+    start = hunk.target_start if reverse else hunk.source_start
+    return start, source_lines, target_lines
+
+
+def _find_hunk(file_lines, source_lines, expected, cursor):
+    """
+    Returns the index of file_lines at or after cursor where source_lines match,
+    nearest to expected, or None if they do not match anywhere.
+    """
+    if not source_lines:
+        return expected if cursor <= expected <= len(file_lines) else None
+    normalized = [_normalize_line(x) for x in source_lines]
+    last_position = len(file_lines) - len(source_lines)
+    for distance in range(max(expected - cursor, last_position - expected) + 1):
+        # Like GNU patch, later positions are tried first
+        for position in (expected + distance, expected - distance):
+            if position < cursor or position > last_position:
+                continue
+            if all(
+                    _normalize_line(file_lines[position + index]) == line
+                    for index, line in enumerate(normalized)):
+                return position
+    return None
+
+
+def _apply_hunks(file_lines, patched_file, reverse, label): #pylint: disable=too-many-locals
+    """
+    Returns file_lines with the hunks of patched_file applied, and a list of
+    (hunk number, line number, offset) of the hunks found at an offset.
+    """
+    result = []
+    offsets = []
+    cursor = 0
+    offset = 0
+    for hunk_num, hunk in enumerate(patched_file, start=1):
+        start, source_lines, target_lines = _parse_hunk(hunk, reverse)
+        # Hunks without lines to match are inserted after their line number
+        expected = start - 1 if source_lines else start
+        position = _find_hunk(file_lines, source_lines, expected + offset, cursor)
+        if position is None:
+            raise PatchApplicationError('Hunk #{} does not apply to {}'.format(hunk_num, label))
+        if position != expected:
+            offsets.append((hunk_num, position + 1, position - expected))
+        offset = position - expected
+        result.extend(file_lines[cursor:position])
+        for line in target_lines:
+            result.append(file_lines[position + line] if isinstance(line, int) else line)
+        cursor = position + len(source_lines)
+    result.extend(file_lines[cursor:])
+    return result, offsets
+
+
+class _PatchedTree:
+    """The files of a source tree modified by patches, kept in memory until written"""
+    def __init__(self, tree_path):
+        self.tree_path = tree_path
+        # Dict of relative path to [original data, current lines, mode]. Data and lines
+        # are None for files that do not exist.
+        self._files = {}
+
+    def _get_file(self, relative_path):
+        if relative_path not in self._files:
+            try:
+                data = (self.tree_path / relative_path).read_bytes()
+                lines = _split_lines(data)
+            except FileNotFoundError:
+                data = None
+                lines = None
+            self._files[relative_path] = [data, lines, None]
+        return self._files[relative_path]
+
+    def apply(self, patched_file, reverse, patch_path):
+        """
+        Applies the unidiff.PatchedFile patched_file from patch_path in memory
+
+        Returns the relative path of the file, its lines before applying patched_file, and
+        the list of (hunk number, line number, offset) of the hunks found at an offset.
+        """
+        source_name, target_name = patched_file.source_file, patched_file.target_file
+        if reverse:
+            source_name, target_name = target_name, source_name
+        is_added = source_name == '/dev/null'
+        is_removed = target_name == '/dev/null'
+        if is_added and is_removed:
+            raise PatchApplicationError('Invalid file names in {}'.format(patch_path))
+        relative_path = _strip_path(source_name if is_removed else target_name)
+        if not is_added and not is_removed and _strip_path(source_name) != relative_path:
+            raise PatchApplicationError('Renamed files are not supported: {}'.format(
+                patched_file.path))
+        if not len(patched_file): #pylint: disable=len-as-condition
+            raise PatchApplicationError('{} has no hunks for {}'.format(
+                patch_path.name, relative_path))
+        label = '{} in {}'.format(relative_path, patch_path.name)
+        file_entry = self._get_file(relative_path)
+        old_lines = file_entry[1]
+        if is_added:
+            if file_entry[1]:
+                raise PatchApplicationError('{} already exists'.format(label))
+            file_entry[1] = []
+            for info_line in patched_file.patch_info or ():
+                match = _NEW_FILE_MODE_REGEX.match(info_line)
+                if match:
+                    file_entry[2] = int(match.group(1), 8)
+        elif file_entry[1] is None:
+            raise PatchApplicationError('{} does not exist'.format(label))
+        file_entry[1], offsets = _apply_hunks(file_entry[1], patched_file, reverse, label)
+        if is_removed:
+            if file_entry[1]:
+                raise PatchApplicationError('{} is not empty after removing it'.format(label))
+            file_entry[1] = None
+        return relative_path, old_lines, offsets
+
+    def get_lines(self, relative_path):
+        """Returns the current lines of the file, or None if it does not exist"""
+        return self._get_file(relative_path)[1]
+
+    def _remove_file(self, path):
+        path.unlink()
+        # Remove directories left empty, like GNU patch
+        parent = path.parent
+        while parent != self.tree_path and not any(parent.iterdir()):
+            parent.rmdir()
+            parent = parent.parent
+
+    def write(self):
+        """Writes the modified files to the tree, and returns the number of files written"""
+        count = 0
+        for relative_path, (data, lines, mode) in sorted(self._files.items()):
+            path = self.tree_path / relative_path
+            if lines is None:
+                if data is not None:
+                    self._remove_file(path)
+                    count += 1
+                continue
+            new_data = b''.join(lines)
+            if new_data == data:
+                continue
+            if data is None:
+                path.parent.mkdir(parents=True, exist_ok=True)
+            else:
+                # Do not modify the pristine tree the file may be hardlinked to
+                break_link(path)
+            path.write_bytes(new_data)
+            if mode is not None and mode & stat.S_IXUSR:
+                os.chmod(str(path),
+                         path.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            count += 1
+        return count
+
+
+def _apply_chain(patched_tree, chain, patch_count, reverse):
+    """Applies a chain of (patch number, pathlib.Path) in memory, logging their timings"""
+    logger = get_logger()
+    log_word = 'Reversed' if reverse else 'Applied'
+    for patch_num, patch_path in chain:
+        start_time = time.perf_counter()
+        try:
+            # Do not translate line endings of the patched lines
+            patch_set = unidiff.PatchSet(io.StringIO(patch_path.read_bytes().decode(ENCODING)))
+        except (UnicodeDecodeError, unidiff.UnidiffParseError) as exc:
+            raise PatchApplicationError('Could not parse {}: {}'.format(patch_path.name,
+                                                                        exc)) from exc
+        if not len(patch_set): #pylint: disable=len-as-condition
+            raise PatchApplicationError('{} has no files to patch'.format(patch_path.name))
+        for patched_file in patch_set:
+            patched_tree.apply(patched_file, reverse, patch_path)
+        logger.info('* %s %s (%s/%s) in %.3fs', log_word, patch_path.name, patch_num, patch_count,
+                    time.perf_counter() - start_time)
+
+
+def apply_patches_in_process(patch_paths, tree_path, reverse=False, jobs=1):
+    """
+    Applies or reverses patches in-process
+
+    patch_paths is a list of pathlib.Path to patch files, in the order to apply them
+    tree_path is the pathlib.Path of the source tree to patch
+    reverse is whether the patches should be reversed
+    jobs is the number of chains of patches from group_patches() to apply concurrently
+
+    The tree is only modified once all patches apply. Hardlinked files are replaced
+    with copies before writing, like with break_link().
+
+    Returns the number of files written.
+    Raises PatchApplicationError if the patches cannot be applied in-process, e.g. if a hunk
+    does not match without fuzz or a patch is not a plain unified diff.
+    """
+    if unidiff is None:
+        raise PatchApplicationError('Could not import unidiff from devutils/third_party')
+    numbered_paths = list(enumerate(patch_paths, start=1))
+    if jobs > 1:
+        chains = [[numbered_paths[x] for x in chain] for chain in group_patches(patch_paths)]
+    else:
+        chains = [numbered_paths]
+    # Chains modify different files, so they can share the tree
+    patched_tree = _PatchedTree(tree_path)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_apply_chain, patched_tree, chain, len(patch_paths), reverse)
+            for chain in chains
+        ]
+        for future in futures:
+            future.result()
+    return patched_tree.write()
+
+
+def _format_range(start, length):
+    """Returns the range of a hunk header of lines from index start, like diff -u"""
+    if length == 1:
+        return str(start + 1)
+    if not length:
+        return '{},0'.format(start)
+    return '{},{}'.format(start + 1, length)
+
+
+def _get_function(lines, index):
+    """Returns the last line before index that starts a function, like diff -p"""
+    for line in reversed(lines[:index]):
+        if _FUNCTION_REGEX.match(line):
+            return b' ' + line[:_FUNCTION_LENGTH].rstrip()
+    return b''
+
+
+def _diff_lines(relative_path, old_lines, new_lines): #pylint: disable=too-many-locals
+    """
+    Returns a -p1 unified diff from old_lines to new_lines of the file at relative_path as
+    bytes, like diff -u -p. old_lines or new_lines is None if the file is added or removed.
+    """
+    source_name = b'/dev/null' if old_lines is None else b'a/' + relative_path.encode(ENCODING)
+    target_name = b'/dev/null' if new_lines is None else b'b/' + relative_path.encode(ENCODING)
+    old_lines = old_lines or []
+    new_lines = new_lines or []
+    diff = [b'--- ' + source_name + b'\n', b'+++ ' + target_name + b'\n']
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for group in matcher.get_grouped_opcodes(_REFRESH_CONTEXT):
+        old_start, old_end = group[0][1], group[-1][2]
+        new_start, new_end = group[0][3], group[-1][4]
+        hunk_range = '@@ -{} +{} @@'.format(_format_range(old_start, old_end - old_start),
+                                            _format_range(new_start, new_end - new_start))
+        diff.append(hunk_range.encode(ENCODING) + _get_function(old_lines, old_start) + b'\n')
+        for tag, old_first, old_last, new_first, new_last in group:
+            if tag == 'equal':
+                diff.extend(b' ' + x for x in old_lines[old_first:old_last])
+                continue
+            diff.extend(b'-' + x for x in old_lines[old_first:old_last])
+            diff.extend(b'+' + x for x in new_lines[new_first:new_last])
+    # Only the last line of the old or new file may have no newline
+    return b''.join(x if x.endswith(b'\n') else x + _NO_NEWLINE_MARKER for x in diff)
+
+
+def refresh_patches_in_process(patch_paths, tree_path): #pylint: disable=too-many-locals
+    """
+    Refreshes patches against a source tree, like "quilt refresh" after each "quilt push"
+
+    patch_paths is a list of pathlib.Path to patch files, or patches like BundledPatch,
+        in the order to apply them
+    tree_path is the pathlib.Path of the unmodified source tree. It is not modified.
+
+    The patches are applied in memory, finding hunks at an offset like when applying
+    patches in-process. Each patch is regenerated from the files before and after applying
+    it, as a unified diff with 3 lines of context and a/ and b/ prefixes, keeping the text
+    before each file of the patch.
+
+    Generates a tuple of each patch and its refreshed bytes, in order.
+    Raises PatchApplicationError for the first patch that does not apply.
+    """
+    if unidiff is None:
+        raise PatchApplicationError('Could not import unidiff from devutils/third_party')
+    logger = get_logger()
+    patched_tree = _PatchedTree(tree_path)
+    for patch_num, patch_path in enumerate(patch_paths, start=1):
+        try:
+            patch_text = patch_path.read_bytes().decode(ENCODING)
+            patch_set = unidiff.PatchSet(io.StringIO(patch_text))
+        except (UnicodeDecodeError, unidiff.UnidiffParseError) as exc:
+            raise PatchApplicationError('Could not parse {}: {}'.format(patch_path.name,
+                                                                        exc)) from exc
+        if not len(patch_set): #pylint: disable=len-as-condition
+            raise PatchApplicationError('{} has no files to patch'.format(patch_path.name))
+        refreshed = []
+        for patched_file in patch_set:
+            relative_path, old_lines, offsets = patched_tree.apply(patched_file, False, patch_path)
+            for hunk_num, line_num, offset in offsets:
+                logger.info('%s: Hunk #%s of %s succeeded at %s (offset %s lines)', patch_path.name,
+                            hunk_num, relative_path, line_num, offset)
+            refreshed.extend(x.encode(ENCODING) for x in patched_file.patch_info or ())
+            refreshed.append(
+                _diff_lines(relative_path, old_lines, patched_tree.get_lines(relative_path)))
+        logger.debug('* Refreshed %s (%s/%s)', patch_path.name, patch_num, len(patch_paths))
+        yield patch_path, b''.join(refreshed)
@@ -0,0 +1,469 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Unpacking of retrieved downloads into the source tree
+"""
+
+import functools
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from _common import ExtractorEnum, get_logger
+from _extraction import TarStreamExtractor, extract_tar_file, extract_with_7z, \
+    extract_with_winrar, move_tree, update_tar_file
+from _metrics import ProgressReporter, get_metrics
+from _verification import HashMismatchError, MultiHasher, get_hash_pairs, hash_file, \
+    is_verified, remove_verified, write_verified
+from _worktree import clone_tree, mark_pristine, read_pristine_record, remove_pristine
+
+# Size of the chunks of archives read when verifying and unpacking them at once
+_VERIFY_CHUNK_SIZE = 262144
+
+# Paths in the output directory never removed when updating existing files,
+# i.e. the conventional build output directory of Chromium
+_UPDATE_KEEP_PATHS = ('out', )
+
+
+def get_strip_leading_dirs(download_properties):
+    """Returns the pathlib.Path of strip_leading_dirs of a download, or None if it is not set"""
+    if download_properties.strip_leading_dirs is None:
+        return None
+    return Path(download_properties.strip_leading_dirs)
+
+
+def _hash_download(download_name, download_path, hasher, phase, show_progress):
+    """Feeds the download to hasher, reporting its progress as phase"""
+    progress = ProgressReporter(phase, download_name, show_progress)
+    try:
+        hash_file(download_path, hasher, _VERIFY_CHUNK_SIZE, progress=progress)
+    finally:
+        progress.finish()
+
+
+def _verify_unpack_download(download_name, #pylint: disable=too-many-arguments
+                            download_properties,
+                            cache_dir,
+                            output_dir,
+                            skip_unused,
+                            sysroot,
+                            extractors,
+                            update_existing=False,
+                            show_progress=False):
+    """
+    Verifies the hashes of a download and unpacks it, reading tar archives only once.
+    The arguments are the same as for unpack_downloads(). Downloads updating existing
+    files are only verified.
+
+    Returns True if the download was unpacked; False if it still needs to be unpacked.
+    """
+    download_path = cache_dir / download_properties.download_filename
+    hash_pairs = list(get_hash_pairs(download_properties, cache_dir))
+    if is_verified(download_path, hash_pairs):
+        get_logger().info('Hashes for "%s" were already verified', download_name)
+        return False
+    remove_verified(download_path)
+    if (download_properties.extractor or ExtractorEnum.TAR) != ExtractorEnum.TAR or update_existing:
+        get_logger().info('Verifying hashes for "%s" ...', download_name)
+        hasher = MultiHasher(hash_pairs)
+        with get_metrics().phase('verify', download_name) as phase_result:
+            _hash_download(download_name, download_path, hasher, 'verify', show_progress)
+            hasher.verify(download_path)
+            phase_result['bytes'] = download_path.stat().st_size
+        write_verified(download_path, hash_pairs)
+        return False
+
+    def _feed(unpacking_hasher):
+        _hash_download(download_name, download_path, unpacking_hasher, 'verify-unpack',
+                       show_progress)
+
+    get_logger().info('Verifying and unpacking "%s" to %s ...', download_name,
+                      download_properties.output_path)
+    with get_metrics().phase('verify-unpack', download_name) as phase_result:
+        unpack_streamed(download_name, download_properties, download_path, output_dir, hash_pairs,
+                        _feed, skip_unused, sysroot, extractors)
+        phase_result['bytes'] = download_path.stat().st_size
+    return True
+
+
+def _unpack_download(download_name, #pylint: disable=too-many-arguments
+                     download_properties,
+                     cache_dir,
+                     output_dir,
+                     skip_unused,
+                     sysroot,
+                     extractors,
+                     verify=False,
+                     keep_paths=None,
+                     show_progress=False):
+    """
+    Unpacks a download. The arguments are the same as for unpack_downloads().
+
+    keep_paths is a list of pathlib.Path in the output path of the download to keep when
+    updating existing files, or None to unpack over existing files.
+    """
+    if verify and _verify_unpack_download(download_name, download_properties, cache_dir,
+                                          output_dir, skip_unused, sysroot, extractors,
+                                          keep_paths is not None, show_progress):
+        return
+    download_path = cache_dir / download_properties.download_filename
+    extractor_name = download_properties.extractor or ExtractorEnum.TAR
+    if keep_paths is not None:
+        if extractor_name == ExtractorEnum.TAR:
+            _update_download(download_name, download_properties, download_path, output_dir,
+                             skip_unused, sysroot, keep_paths, show_progress)
+            return
+        get_logger().warning('Cannot update existing files from "%s"; unpacking all files',
+                             download_name)
+    get_logger().info('Unpacking "%s" to %s ...', download_name, download_properties.output_path)
+    # Progress of unpacking is measured in archive bytes
+    progress = ProgressReporter('unpack', download_name, show_progress)
+    if extractor_name == ExtractorEnum.SEVENZIP:
+        extractor_func = extract_with_7z
+    elif extractor_name == ExtractorEnum.WINRAR:
+        extractor_func = extract_with_winrar
+    elif extractor_name == ExtractorEnum.TAR:
+        extractor_func = functools.partial(extract_tar_file, progress=progress)
+    else:
+        raise NotImplementedError(extractor_name)
+
+    with get_metrics().phase('unpack', download_name) as phase_result:
+        try:
+            extractor_func(archive_path=download_path,
+                           output_dir=output_dir / Path(download_properties.output_path),
+                           relative_to=get_strip_leading_dirs(download_properties),
+                           skip_unused=skip_unused,
+                           sysroot=sysroot,
+                           extractors=extractors)
+        finally:
+            progress.finish()
+        # Throughput of unpacking is measured in archive bytes
+        phase_result['bytes'] = download_path.stat().st_size
+
+
+def _update_download(download_name, #pylint: disable=too-many-arguments
+                     download_properties,
+                     download_path,
+                     output_dir,
+                     skip_unused,
+                     sysroot,
+                     keep_paths,
+                     show_progress):
+    """Updates the existing files of a tar archive download. See _unpack_download()."""
+    get_logger().info('Updating "%s" in %s ...', download_name, download_properties.output_path)
+    with get_metrics().phase('update', download_name) as phase_result:
+        progress = ProgressReporter('update', download_name, show_progress)
+        try:
+            counts = update_tar_file(archive_path=download_path,
+                                     output_dir=output_dir / Path(download_properties.output_path),
+                                     relative_to=get_strip_leading_dirs(download_properties),
+                                     skip_unused=skip_unused,
+                                     sysroot=sysroot,
+                                     keep_paths=keep_paths,
+                                     progress=progress)
+        finally:
+            progress.finish()
+        phase_result['bytes'] = download_path.stat().st_size
+    get_logger().info('Kept %d unchanged files, wrote %d files and removed %d files',
+                      counts['unchanged'], counts['written'], counts['removed'])
+
+
+def _get_keep_paths(download_info, output_dir, download_properties):
+    """
+    Returns the list of pathlib.Path to keep when updating the existing files of a download:
+    the output paths of other downloads within its output path, and _UPDATE_KEEP_PATHS.
+    """
+    output_parts = Path(download_properties.output_path).parts
+    keep_paths = []
+    for other_relative_path in (*(x.output_path for _, x in download_info.properties_iter()),
+                                *_UPDATE_KEEP_PATHS):
+        other_parts = Path(other_relative_path).parts
+        if len(other_parts) > len(output_parts) and other_parts[:len(output_parts)] == output_parts:
+            keep_paths.append(output_dir / Path(*other_parts))
+    return keep_paths
+
+
+def _group_overlapping_downloads(download_list):
+    """
+    Groups a list of (download_name, download_properties) into lists of downloads with
+    overlapping output paths, i.e. where one output path contains the other.
+
+    Downloads keep their order within each group, and groups are ordered by their first download.
+    """
+    groups = []
+    for index, (_, download_properties) in enumerate(download_list):
+        output_parts = Path(download_properties.output_path).parts
+        new_group = [index]
+        for group in list(groups):
+            if any(output_parts[:len(other_parts)] == other_parts
+                   or other_parts[:len(output_parts)] == output_parts
+                   for other_parts in (Path(download_list[x][1].output_path).parts
+                                       for x in group)):
+                groups.remove(group)
+                new_group = group + new_group
+        groups.append(sorted(new_group))
+    groups.sort()
+    return [[download_list[index] for index in group] for group in groups]
+
+
+def unpack_downloads(download_info, #pylint: disable=too-many-arguments,too-many-locals
+                     cache_dir,
+                     components,
+                     output_dir,
+                     skip_unused,
+                     sysroot,
+                     extractors=None,
+                     jobs=1,
+                     verify=False,
+                     update_existing=False,
+                     show_progress=False):
+    """
+    Unpack downloads in the downloads cache to output_dir. Assumes all downloads are retrieved.
+
+    download_info is the DownloadInfo of downloads to unpack.
+    cache_dir is the pathlib.Path directory containing the download cache
+    components is a list of component names to unpack, if not empty.
+    output_dir is the pathlib.Path directory to unpack the downloads to.
+    skip_unused is a boolean that determines if unused paths should be extracted.
+    sysroot is a string containing a sysroot to unpack if any.
+    extractors is a dictionary of PlatformEnum to a command or path to the
+        extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip and WinRAR.
+    jobs is the maximum number of downloads to unpack concurrently. Downloads with
+        overlapping output paths are always unpacked one after another, in order of their
+        output paths.
+    verify is a boolean indicating if the hashes of downloads should be verified first.
+        Tar archives are hashed and unpacked from a single read into a staging directory,
+        which is moved into the output path only if all hashes match. Downloads with
+        a verification sidecar from check_downloads() are not hashed again.
+    update_existing is a boolean indicating if existing files should be updated instead of
+        unpacking over them. Files of tar archives are only rewritten if their size or
+        content differ, and files absent from the archives are removed, except within the
+        output paths of other downloads and the build output directory "out".
+    show_progress is a boolean indicating if the progress of hashing and unpacking, in bytes
+        of the archives, is printed to the console. It is ignored when more than one download
+        is unpacked at a time. Tar archives unpacked by 7-Zip or WinRAR have no progress.
+
+    Raises HashMismatchError when the computed and expected hashes do not match.
+    May raise undetermined exceptions during archive unpacking.
+    """
+    download_list = [(download_name, download_properties)
+                     for download_name, download_properties in download_info.properties_iter()
+                     if not components or download_name in components]
+
+    def _unpack(download_name, download_properties, show_progress):
+        keep_paths = None
+        if update_existing:
+            keep_paths = _get_keep_paths(download_info, output_dir, download_properties)
+        _unpack_download(download_name, download_properties, cache_dir, output_dir, skip_unused,
+                         sysroot, extractors, verify, keep_paths, show_progress)
+
+    if jobs <= 1 or len(download_list) <= 1:
+        for download_name, download_properties in download_list:
+            _unpack(download_name, download_properties, show_progress)
+        return
+
+    def _unpack_group(group):
+        for download_name, download_properties in group:
+            # Progress lines of concurrent downloads would overwrite each other
+            _unpack(download_name, download_properties, False)
+
+    groups = _group_overlapping_downloads(download_list)
+    get_logger().debug('Unpacking %d groups of downloads with non-overlapping output paths',
+                       len(groups))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(_unpack_group, group) for group in groups]:
+            future.result()
+
+
+def _get_pristine_record(download_info, cache_dir, components, skip_unused, sysroot):
+    """Returns the pristine record describing the unpacked downloads"""
+    record_components = {}
+    for download_name, download_properties in download_info.properties_iter():
+        if components and download_name not in components:
+            continue
+        download_stat = (cache_dir / download_properties.download_filename).stat()
+        record_components[download_name] = {
+            'download_filename': download_properties.download_filename,
+            'output_path': download_properties.output_path,
+            'strip_leading_dirs': download_properties.strip_leading_dirs,
+            'hashes': {
+                hash_name: hash_hex
+                for hash_name, hash_hex in download_properties.hashes.items()
+                if hash_name != 'hash_url'
+            },
+            'size': download_stat.st_size,
+            'mtime_ns': download_stat.st_mtime_ns,
+        }
+    return {'components': record_components, 'skip_unused': skip_unused, 'sysroot': sysroot}
+
+
+def unpack_pristine(download_info, #pylint: disable=too-many-arguments
+                    cache_dir,
+                    components,
+                    pristine_dir,
+                    output_dir,
+                    skip_unused,
+                    sysroot,
+                    extractors=None,
+                    jobs=1,
+                    verify=False,
+                    show_progress=False):
+    """
+    Unpack downloads into the read-only pristine tree pristine_dir if it does not have them
+    already, and clone it to the working tree output_dir.
+
+    A pristine tree unpacked from other downloads or with other options is replaced.
+    output_dir must not exist or be empty. The other arguments are the same as for
+    unpack_downloads(), and jobs is also the number of files cloned concurrently.
+
+    Raises FileExistsError if pristine_dir is not a pristine tree and is not empty,
+    or if output_dir is not empty.
+    """
+    if output_dir.exists() and any(output_dir.iterdir()):
+        raise FileExistsError(output_dir)
+    record = _get_pristine_record(download_info, cache_dir, components, skip_unused, sysroot)
+    existing_record = read_pristine_record(pristine_dir)
+    if existing_record == record:
+        get_logger().info('Reusing pristine tree %s', pristine_dir)
+    else:
+        if existing_record is not None:
+            get_logger().info('Replacing outdated pristine tree %s', pristine_dir)
+            remove_pristine(pristine_dir)
+        elif pristine_dir.exists() and any(pristine_dir.iterdir()):
+            raise FileExistsError(pristine_dir)
+        pristine_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            unpack_downloads(download_info,
+                             cache_dir,
+                             components,
+                             pristine_dir,
+                             skip_unused,
+                             sysroot,
+                             extractors,
+                             jobs,
+                             verify,
+                             show_progress=show_progress)
+        except BaseException:
+            # Do not leave a partial tree that must be removed manually
+            remove_pristine(pristine_dir)
+            raise
+        mark_pristine(pristine_dir, record)
+    with get_metrics().phase('clone', str(output_dir)):
+        counts = clone_tree(pristine_dir, output_dir, jobs)
+    get_logger().info('Cloned %d files as reflinks, %d as hardlinks and %d as copies',
+                      counts['reflink'], counts['hardlink'], counts['copy'])
+
+
+class UnpackingHasher:
+    """
+    Feeds downloaded data to a MultiHasher and a TarStreamExtractor, so a download is hashed
+    and unpacked into a staging directory while it is downloaded.
+
+    Resetting it restarts the extraction in an empty staging directory.
+    """
+    def __init__(self, hasher, staging_dir, extractor_kwargs):
+        """extractor_kwargs are the arguments of TarStreamExtractor except output_dir"""
+        self.hasher = hasher
+        self._staging_dir = staging_dir
+        self._extractor_kwargs = extractor_kwargs
+        self._extractor = None
+        self.reset()
+
+    def reset(self):
+        """Discards all data fed so far"""
+        self.hasher.reset()
+        self.abort()
+        self._staging_dir.mkdir()
+        self._extractor = TarStreamExtractor(output_dir=self._staging_dir,
+                                             **self._extractor_kwargs)
+
+    def update(self, data):
+        """Feeds data to the hashers and the extractor"""
+        self.hasher.update(data)
+        self._extractor.write(data)
+
+    def close(self):
+        """Waits for the extraction to finish. Raises an exception if it failed."""
+        self._extractor.close()
+        self._extractor = None
+
+    def abort(self):
+        """Stops the extraction and removes the staging directory"""
+        if self._extractor is not None:
+            self._extractor.abort()
+            self._extractor = None
+        if self._staging_dir.exists():
+            shutil.rmtree(str(self._staging_dir))
+
+
+def _quarantine(unpacking_hasher, staging_dir, quarantine_path):
+    """Moves the unpacked files of a download that failed verification to quarantine_path"""
+    try:
+        unpacking_hasher.close()
+    except Exception: #pylint: disable=broad-except
+        # Keep whatever was unpacked
+        get_logger().debug('Unpacking of the quarantined download failed', exc_info=True)
+    if quarantine_path.exists():
+        shutil.rmtree(str(quarantine_path))
+    quarantine_path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(str(staging_dir), str(quarantine_path))
+    get_logger().warning('Moved unpacked files of the corrupt download to %s', quarantine_path)
+
+
+def unpack_streamed(download_name, #pylint: disable=too-many-arguments
+                    download_properties,
+                    download_path,
+                    output_dir,
+                    hash_pairs,
+                    feed,
+                    skip_unused,
+                    sysroot,
+                    extractors=None,
+                    quarantine_dir=None):
+    """
+    Hashes and unpacks the tar archive of a download from a single stream of its data.
+
+    The archive is unpacked into a staging directory in output_dir, which is moved into
+    the output path of the download only after all hashes match. The successful verification
+    is recorded for check_downloads().
+
+    download_path is the pathlib.Path to the archive in the downloads cache.
+    hash_pairs is a list of (hash_name, hash_hex) of the expected hashes.
+    feed is a callable writing the whole archive to the UnpackingHasher passed to it.
+    quarantine_dir is the pathlib.Path to move the unpacked files of downloads failing
+        verification to, or None to delete them.
+    The other arguments are the same as for unpack_downloads().
+
+    Raises HashMismatchError when the computed and expected hashes do not match.
+    May raise undetermined exceptions during archive unpacking.
+    """
+    # The staging directory is made in output_dir, which may not exist yet
+    output_dir.mkdir(parents=True, exist_ok=True)
+    staging_dir = output_dir / '.{}.unpacking'.format(download_name)
+    unpacking_hasher = UnpackingHasher(
+        MultiHasher(hash_pairs), staging_dir, {
+            'archive_name': download_properties.download_filename,
+            'relative_to': get_strip_leading_dirs(download_properties),
+            'skip_unused': skip_unused,
+            'sysroot': sysroot,
+            'extractors': extractors,
+        })
+    try:
+        feed(unpacking_hasher)
+        get_logger().info('Verifying hashes for "%s" ...', download_name)
+        unpacking_hasher.hasher.verify(download_path)
+        unpacking_hasher.close()
+    except HashMismatchError:
+        if quarantine_dir is None:
+            unpacking_hasher.abort()
+        else:
+            _quarantine(unpacking_hasher, staging_dir, quarantine_dir / download_name)
+        raise
+    except BaseException:
+        unpacking_hasher.abort()
+        raise
+    write_verified(download_path, hash_pairs)
+    move_tree(staging_dir, output_dir / Path(download_properties.output_path))
@@ -0,0 +1,158 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Hash verification of downloads and records of successful verifications
+"""
+
+import hashlib
+import json
+
+from _common import ENCODING, get_logger
+from _downloader import feed_file
+
+
+class HashMismatchError(BaseException):
+    """Exception for computed hashes not matching expected hashes"""
+
+
+class MultiHasher:
+    """Computes all expected hashes of a file over a single pass of its data"""
+    def __init__(self, hash_pairs):
+        """hash_pairs is an iterable of (hash_name, hash_hex) of the expected hashes"""
+        self._expected = [(hash_name, hash_hex.lower()) for hash_name, hash_hex in hash_pairs]
+        self.hashers = []
+        self.reset()
+
+    def reset(self):
+        """Discards all data fed to the hashers"""
+        self.hashers = [hashlib.new(hash_name) for hash_name, _ in self._expected]
+
+    def update(self, data):
+        """Feeds data to all hashers"""
+        for hasher in self.hashers:
+            hasher.update(data)
+
+    def verify(self, file_path):
+        """
+        Checks the computed hashes against the expected ones.
+
+        Raises HashMismatchError with file_path if any hash does not match.
+        """
+        for (hash_name, hash_hex), hasher in zip(self._expected, self.hashers):
+            get_logger().debug('Verifying %s hash...', hash_name)
+            if hasher.hexdigest().lower() != hash_hex:
+                raise HashMismatchError(file_path)
+
+
+def _chromium_hashes_generator(hashes_path):
+    with hashes_path.open(encoding=ENCODING) as hashes_file:
+        hash_lines = hashes_file.read().splitlines()
+    for hash_name, hash_hex, _ in map(lambda x: x.lower().split('  '), hash_lines):
+        if hash_name in hashlib.algorithms_available:
+            yield hash_name, hash_hex
+        else:
+            get_logger().warning('Skipping unknown hash algorithm: %s', hash_name)
+
+
+def get_hash_pairs(download_properties, cache_dir):
+    """
+    Generator of (hash_name, hash_hex) for the given download
+
+    Hashes from a hash_url are read from its file in the downloads cache at cache_dir.
+    """
+    for entry_type, entry_value in download_properties.hashes.items():
+        if entry_type == 'hash_url':
+            hash_processor, hash_filename, _ = entry_value
+            if hash_processor == 'chromium':
+                yield from _chromium_hashes_generator(cache_dir / hash_filename)
+            else:
+                raise ValueError('Unknown hash_url processor: %s' % hash_processor)
+        else:
+            yield entry_type, entry_value
+
+
+def _get_verified_sidecar(download_path):
+    """Returns the pathlib.Path to the verification sidecar of download_path"""
+    return download_path.with_name(download_path.name + '.verified')
+
+
+def _get_verified_record(download_path, hash_pairs):
+    """
+    Returns a dict of the verification record of download_path with its current stat values
+    and the expected hashes.
+    """
+    stat_result = download_path.stat()
+    return {
+        'size': stat_result.st_size,
+        'mtime_ns': stat_result.st_mtime_ns,
+        'inode': stat_result.st_ino,
+        'hashes': [[hash_name, hash_hex.lower()] for hash_name, hash_hex in hash_pairs],
+    }
+
+
+def is_verified(download_path, hash_pairs):
+    """
+    Returns True if the verification sidecar of download_path records a successful
+    verification against the same expected hashes, and the file has not changed since;
+    False otherwise.
+    """
+    try:
+        with _get_verified_sidecar(download_path).open(encoding=ENCODING) as sidecar_file:
+            return json.load(sidecar_file) == _get_verified_record(download_path, hash_pairs)
+    except (OSError, ValueError):
+        return False
+
+
+def write_verified(download_path, hash_pairs):
+    """Records a successful verification of download_path against hash_pairs in its sidecar"""
+    sidecar_path = _get_verified_sidecar(download_path)
+    tmp_path = sidecar_path.with_name(sidecar_path.name + '.tmp')
+    with tmp_path.open('w', encoding=ENCODING) as sidecar_file:
+        json.dump(_get_verified_record(download_path, hash_pairs), sidecar_file)
+    tmp_path.replace(sidecar_path)
+
+
+def remove_verified(download_path):
+    """Removes the verification sidecar of download_path if it exists"""
+    sidecar_path = _get_verified_sidecar(download_path)
+    if sidecar_path.exists():
+        sidecar_path.unlink()
+
+
+def hash_file(file_path, hasher, chunk_bytes, executor=None, progress=None):
+    """
+    Feeds the content of file_path to all hashers of the MultiHasher hasher
+    by reading the file once into reusable buffers.
+
+    executor is a concurrent.futures.Executor to run the hashers concurrently in, or None.
+    While the hashers process one buffer, the next chunk is read into the other buffer.
+    progress is a callable to report (read_bytes, total_bytes) to, or None.
+    """
+    if executor is None:
+        feed_file(file_path, hasher, chunk_bytes, progress)
+        return
+    buffers = (memoryview(bytearray(chunk_bytes)), memoryview(bytearray(chunk_bytes)))
+    pending = []
+    buffer_index = 0
+    read_bytes = 0
+    total_size = file_path.stat().st_size
+    if progress:
+        progress(read_bytes, total_size)
+    with file_path.open('rb') as file_obj:
+        read_size = file_obj.readinto(buffers[buffer_index])
+        while read_size:
+            # The hashers must consume chunks in order, so wait for the previous chunk
+            for future in pending:
+                future.result()
+            chunk = buffers[buffer_index][:read_size]
+            pending = [executor.submit(x.update, chunk) for x in hasher.hashers]
+            if progress:
+                read_bytes += read_size
+                progress(read_bytes, total_size)
+            buffer_index ^= 1
+            read_size = file_obj.readinto(buffers[buffer_index])
+        for future in pending:
+            future.result()
@@ -0,0 +1,187 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Pristine source trees and their working copies
+
+A pristine tree is unpacked once and made read-only. Working trees are cloned from it with
+reflinks where the file system supports them, and hardlinks otherwise, so files share
+their data with the pristine tree until they are modified. Tools modifying files in a
+working tree must call break_link() first, so hardlinked files are copied before writing.
+"""
+
+import errno
+import json
+import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from _common import ENCODING, get_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Name of the file in the root of a pristine tree recording how it was unpacked
+PRISTINE_RECORD = '.pristine.json'
+
+# ioctl request to clone the data of a file on Linux (from linux/fs.h)
+_FICLONE = getattr(fcntl, 'FICLONE', 0x40049409)
+
+# Errors of FICLONE meaning the file system cannot clone the file
+_REFLINK_UNSUPPORTED_ERRNOS = (errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                               errno.EOPNOTSUPP, errno.EXDEV)
+
+# Write permission bits removed from files of pristine trees
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+def read_pristine_record(tree):
+    """Returns the record of the pristine tree at the pathlib.Path tree, or None if it has none"""
+    try:
+        with (tree / PRISTINE_RECORD).open(encoding=ENCODING) as record_file:
+            return json.load(record_file)
+    except (OSError, ValueError):
+        return None
+
+
+def mark_pristine(tree, record):
+    """
+    Makes the files of tree read-only and writes record, a JSON-serializable object describing
+    the content of the tree, to its pristine record.
+
+    Files are only made read-only on platforms where read-only files can still be removed.
+    """
+    if os.name == 'posix':
+        for dir_path, _, file_names in os.walk(str(tree)):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                mode = os.lstat(file_path).st_mode
+                if stat.S_ISREG(mode) and mode & _WRITE_BITS:
+                    os.chmod(file_path, stat.S_IMODE(mode) & ~_WRITE_BITS)
+    with (tree / PRISTINE_RECORD).open('w', encoding=ENCODING) as record_file:
+        json.dump(record, record_file, indent=1, sort_keys=True)
+
+
+def remove_pristine(tree):
+    """Removes the pristine tree at the pathlib.Path tree"""
+    def _onerror(func, path, _):
+        # Read-only files cannot be removed on Windows
+        os.chmod(path, stat.S_IWRITE)
+        func(path)
+
+    shutil.rmtree(str(tree), onerror=_onerror)
+
+
+class _FileCloner: #pylint: disable=too-few-public-methods
+    """Clones files with reflinks if supported, hardlinks otherwise, and copies as a last resort"""
+    def __init__(self, use_reflinks=True):
+        self.use_reflinks = use_reflinks and fcntl is not None
+        self.use_hardlinks = True
+        self.counts = {'reflink': 0, 'hardlink': 0, 'copy': 0}
+        self._lock = threading.Lock()
+
+    def _reflink(self, source_path, target_path):
+        """Returns True if target_path was created as a reflink of source_path; False otherwise"""
+        with open(source_path, 'rb') as source_file, open(target_path, 'wb') as target_file:
+            try:
+                fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+                cloned = True
+            except OSError as exc:
+                if exc.errno not in _REFLINK_UNSUPPORTED_ERRNOS:
+                    raise
+                get_logger().debug('Reflinks are not supported (%s); using hardlinks', exc)
+                self.use_reflinks = False
+                cloned = False
+        if not cloned:
+            os.unlink(target_path)
+            return False
+        # Reflinks have their own metadata, so they can be writable
+        shutil.copystat(source_path, target_path)
+        os.chmod(target_path, os.stat(target_path).st_mode | stat.S_IWUSR)
+        return True
+
+    def clone(self, source_path, target_path):
+        """Clones the regular file source_path to the non-existent target_path"""
+        method = 'copy'
+        if self.use_reflinks and self._reflink(source_path, target_path):
+            method = 'reflink'
+        elif self.use_hardlinks:
+            try:
+                os.link(source_path, target_path)
+                method = 'hardlink'
+            except OSError as exc:
+                if exc.errno != errno.EMLINK:
+                    get_logger().debug('Hardlinks are not supported (%s); copying', exc)
+                    self.use_hardlinks = False
+        if method == 'copy':
+            shutil.copy2(source_path, target_path)
+        with self._lock:
+            self.counts[method] += 1
+
+
+def clone_tree(source_tree, target_tree, jobs=1, use_reflinks=True):
+    """
+    Creates the working tree target_tree as a clone of source_tree.
+
+    Regular files are cloned with reflinks (FICLONE) where supported, and with hardlinks
+    otherwise. Symlinks are recreated, and the pristine record is not cloned.
+
+    source_tree and target_tree are pathlib.Path. target_tree must not exist or be empty.
+    jobs is the number of files to clone concurrently.
+    use_reflinks is a boolean indicating if reflinks should be tried.
+
+    Returns a dict of the number of files cloned by each method ('reflink', 'hardlink', 'copy').
+    Raises FileExistsError if target_tree is not empty.
+    """
+    if target_tree.exists() and any(target_tree.iterdir()):
+        raise FileExistsError(target_tree)
+    target_tree.mkdir(parents=True, exist_ok=True)
+    file_pairs = []
+    for dir_path, dir_names, file_names in os.walk(str(source_tree)):
+        target_dir = os.path.join(str(target_tree), os.path.relpath(dir_path, str(source_tree)))
+        dir_name_set = set(dir_names)
+        for name in dir_names + file_names:
+            source_path = os.path.join(dir_path, name)
+            target_path = os.path.join(target_dir, name)
+            if os.path.islink(source_path):
+                os.symlink(os.readlink(source_path), target_path)
+            elif name in dir_name_set:
+                os.mkdir(target_path)
+            elif dir_path != str(source_tree) or name != PRISTINE_RECORD:
+                file_pairs.append((source_path, target_path))
+        # os.walk() does not follow symlinks to directories, which were recreated above
+        dir_names[:] = [x for x in dir_names if not os.path.islink(os.path.join(dir_path, x))]
+    cloner = _FileCloner(use_reflinks)
+    if file_pairs:
+        # Determine the supported clone method before cloning concurrently
+        cloner.clone(*file_pairs[0])
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for _ in executor.map(lambda x: cloner.clone(*x), file_pairs[1:]):
+            pass
+    return cloner.counts
+
+
+def break_link(path):
+    """
+    Makes the file at the pathlib.Path path writable and not shared with other paths,
+    so it can be modified without modifying the pristine tree it may be cloned from.
+
+    Hardlinked files are replaced with a copy. Reflinked files are copied on write
+    by the file system and only need write permission.
+    """
+    stat_result = path.lstat()
+    if not stat.S_ISREG(stat_result.st_mode):
+        return
+    if stat_result.st_nlink > 1:
+        tmp_path = path.with_name(path.name + '.break-link')
+        shutil.copy2(str(path), str(tmp_path))
+        os.chmod(str(tmp_path), stat_result.st_mode | stat.S_IWUSR)
+        os.replace(str(tmp_path), str(path))
+    elif not stat_result.st_mode & stat.S_IWUSR:
+        os.chmod(str(path), stat_result.st_mode | stat.S_IWUSR)
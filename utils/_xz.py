@@ -0,0 +1,269 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Random access to the blocks of xz files
+
+xz files consist of streams of independently compressed blocks, with an index of their
+sizes at the end of each stream. Files compressed by multiple threads have multiple blocks.
+See https://tukaani.org/xz/xz-file-format.txt
+"""
+
+import collections
+import io
+import lzma
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+XZ_MAGIC = b'\xfd7zXZ\x00'
+_FOOTER_MAGIC = b'YZ'
+# Size of stream headers and footers
+_HEADER_SIZE = 12
+
+# Maximum uncompressed size of blocks to decompress individually. Files with larger blocks,
+# like single-block files, should be decompressed sequentially instead.
+MAX_BLOCK_SIZE = 256 * 1024 * 1024
+
+# Maximum uncompressed size of the blocks decompressed ahead by ParallelXzReader
+_MAX_PENDING_SIZE = 512 * 1024 * 1024
+
+XzBlock = collections.namedtuple(
+    'XzBlock',
+    ('compressed_offset', 'unpadded_size', 'uncompressed_offset', 'uncompressed_size',
+     'stream_flags'))
+XzBlock.__doc__ = """
+A block of an xz file
+
+compressed_offset is the offset of the block header in the file.
+unpadded_size is the size of the block without its padding, as stored in the index.
+uncompressed_offset is the offset of the data of the block in the decompressed file.
+uncompressed_size is the size of the decompressed data of the block.
+stream_flags are the bytes of the flags of the stream containing the block.
+"""
+
+
+def _round_up(size):
+    return (size + 3) & ~3
+
+
+def get_padded_size(block):
+    """Returns the size of the block in the xz file"""
+    return _round_up(block.unpadded_size)
+
+
+def _decode_multibyte(data, pos):
+    """Returns the integer encoded at pos in data and the position after it"""
+    value = 0
+    for shift in range(0, 63, 7):
+        if pos >= len(data):
+            break
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+    raise ValueError('Invalid integer in xz index')
+
+
+def _encode_multibyte(value):
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _read_at(file_obj, offset, size):
+    file_obj.seek(offset)
+    data = file_obj.read(size)
+    if len(data) != size:
+        raise ValueError('Unexpected end of xz file')
+    return data
+
+
+def _read_stream_index(file_obj, end):
+    """
+    Returns the offset of the stream ending at end, its stream flags and a list of
+    (unpadded_size, uncompressed_size) of its blocks.
+    """
+    footer = _read_at(file_obj, end - _HEADER_SIZE, _HEADER_SIZE)
+    if footer[10:] != _FOOTER_MAGIC or struct.unpack('<I', footer[:4])[0] != zlib.crc32(
+            footer[4:10]):
+        raise ValueError('Invalid xz stream footer')
+    index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+    stream_flags = footer[8:10]
+    index_offset = end - _HEADER_SIZE - index_size
+    if index_offset < _HEADER_SIZE:
+        raise ValueError('Invalid xz index size')
+    index = _read_at(file_obj, index_offset, index_size)
+    if index[0] != 0 or struct.unpack('<I', index[-4:])[0] != zlib.crc32(index[:-4]):
+        raise ValueError('Invalid xz index')
+    record_count, pos = _decode_multibyte(index, 1)
+    records = []
+    for _ in range(record_count):
+        unpadded_size, pos = _decode_multibyte(index, pos)
+        uncompressed_size, pos = _decode_multibyte(index, pos)
+        records.append((unpadded_size, uncompressed_size))
+    stream_offset = index_offset - sum(_round_up(x[0]) for x in records) - _HEADER_SIZE
+    if stream_offset < 0:
+        raise ValueError('Invalid xz index sizes')
+    header = _read_at(file_obj, stream_offset, _HEADER_SIZE)
+    if header[:6] != XZ_MAGIC or header[6:8] != stream_flags:
+        raise ValueError('Invalid xz stream header')
+    return stream_offset, stream_flags, records
+
+
+def read_block_index(file_obj):
+    """
+    Returns a list of XzBlock of all blocks in the seekable binary file object of an xz file,
+    in order. Concatenated streams are supported.
+
+    Raises ValueError if the file is not a valid xz file.
+    """
+    end = file_obj.seek(0, os.SEEK_END)
+    streams = []
+    while end > 0:
+        # Skip stream padding
+        while end >= 4 and _read_at(file_obj, end - 4, 4) == b'\0\0\0\0':
+            end -= 4
+        if end < 2 * _HEADER_SIZE:
+            raise ValueError('Invalid xz file')
+        end, stream_flags, records = _read_stream_index(file_obj, end)
+        streams.append((end, stream_flags, records))
+    blocks = []
+    uncompressed_offset = 0
+    for stream_offset, stream_flags, records in reversed(streams):
+        compressed_offset = stream_offset + _HEADER_SIZE
+        for unpadded_size, uncompressed_size in records:
+            blocks.append(
+                XzBlock(compressed_offset, unpadded_size, uncompressed_offset, uncompressed_size,
+                        stream_flags))
+            compressed_offset += _round_up(unpadded_size)
+            uncompressed_offset += uncompressed_size
+    return blocks
+
+
+def read_block_data(file_obj, block):
+    """Returns the bytes of block, including its padding, from the binary file object"""
+    return _read_at(file_obj, block.compressed_offset, get_padded_size(block))
+
+
+def decompress_block(block, block_data):
+    """
+    Returns the decompressed data of block, given the bytes from read_block_data().
+
+    The block is decompressed as a single-block stream, so integrity checks still apply.
+    Decompression releases the GIL, so blocks can be decompressed by concurrent threads.
+
+    Raises lzma.LZMAError if the block is corrupt.
+    """
+    stream = io.BytesIO()
+    stream.write(XZ_MAGIC + block.stream_flags)
+    stream.write(struct.pack('<I', zlib.crc32(block.stream_flags)))
+    stream.write(block_data)
+    index = bytearray(b'\0' + _encode_multibyte(1))
+    index += _encode_multibyte(block.unpadded_size) + _encode_multibyte(block.uncompressed_size)
+    index += b'\0' * (_round_up(len(index)) - len(index))
+    index += struct.pack('<I', zlib.crc32(index))
+    stream.write(index)
+    footer = struct.pack('<I', len(index) // 4 - 1) + block.stream_flags
+    stream.write(struct.pack('<I', zlib.crc32(footer)) + footer + _FOOTER_MAGIC)
+    data = lzma.decompress(stream.getvalue(), format=lzma.FORMAT_XZ)
+    if len(data) != block.uncompressed_size:
+        raise lzma.LZMAError('Unexpected size of xz block data')
+    return data
+
+
+class ParallelXzReader(io.RawIOBase): #pylint: disable=too-many-instance-attributes
+    """
+    Readable binary file object of the decompressed data of an xz file, decompressing
+    its blocks ahead in a thread pool. The compressed blocks are read in the calling thread.
+    """
+    def __init__(self, file_obj, blocks, workers, progress=None):
+        """
+        file_obj is the binary file object of the xz file. It is closed with the reader.
+        blocks is the list of XzBlock of the file from read_block_index().
+        workers is the number of blocks to decompress concurrently.
+        progress is a callable to report (read_bytes, total_bytes) to, or None. The bytes
+            of a block are reported as read once its decompressed data is read.
+        """
+        super().__init__()
+        self._file_obj = file_obj
+        self._blocks = collections.deque(blocks)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._max_pending = workers * 2
+        self._progress = progress
+        self._total_size = os.fstat(file_obj.fileno()).st_size
+        # Deque of (uncompressed size, offset of the end of the block, Future of the data)
+        # of blocks in order
+        self._pending = collections.deque()
+        self._pending_size = 0
+        self._buffer = memoryview(b'')
+        self._submit_blocks()
+
+    def _submit_blocks(self):
+        while self._blocks and len(self._pending) < self._max_pending:
+            block = self._blocks[0]
+            if self._pending and self._pending_size + block.uncompressed_size > _MAX_PENDING_SIZE:
+                break
+            self._blocks.popleft()
+            future = self._executor.submit(decompress_block, block,
+                                           read_block_data(self._file_obj, block))
+            self._pending.append(
+                (block.uncompressed_size, block.compressed_offset + get_padded_size(block), future))
+            self._pending_size += block.uncompressed_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            if not self._pending:
+                return 0
+            block_size, block_end, future = self._pending.popleft()
+            self._pending_size -= block_size
+            self._buffer = memoryview(future.result())
+            if self._progress:
+                self._progress(block_end, self._total_size)
+            self._submit_blocks()
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            for _, _, future in self._pending:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._file_obj.close()
+        super().close()
+
+
+def open_parallel_xz(xz_path, workers=None, progress=None):
+    """
+    Opens the xz file at the pathlib.Path xz_path for decompressing its blocks concurrently.
+
+    workers is the number of blocks to decompress concurrently. Defaults to the CPU count.
+    progress is a callable to report (read_bytes, total_bytes) of the xz file to, or None.
+
+    Returns a ParallelXzReader, or None if the file has a single block, blocks larger than
+    MAX_BLOCK_SIZE, or an index that cannot be read.
+    """
+    file_obj = xz_path.open('rb')
+    try:
+        blocks = read_block_index(file_obj)
+    except ValueError:
+        blocks = []
+    except BaseException:
+        file_obj.close()
+        raise
+    if len(blocks) < 2 or max(x.uncompressed_size for x in blocks) > MAX_BLOCK_SIZE:
+        file_obj.close()
+        return None
+    return ParallelXzReader(file_obj, blocks, workers or os.cpu_count() or 1, progress)
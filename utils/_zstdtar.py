@@ -0,0 +1,124 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Zstandard-compressed tar archives
+
+The standard library zstd module is used when available (Python 3.14 or newer).
+Otherwise, data is piped through the zstd command.
+"""
+
+import contextlib
+import shutil
+import subprocess
+import tarfile
+
+from _common import get_logger
+
+try:
+    from compression import zstd as zstd_module
+except ImportError:
+    zstd_module = None
+
+# Suffixes of zstd-compressed tar archives
+ZSTD_SUFFIXES = ('.zst', '.tzst')
+
+
+def is_zstd_archive(archive_name):
+    """Returns True if the file name archive_name is a zstd-compressed archive"""
+    return any(str(archive_name).lower().endswith(x) for x in ZSTD_SUFFIXES)
+
+
+def _find_zstd():
+    """Returns the path to the zstd command. Raises FileNotFoundError if it is not found."""
+    zstd_bin = shutil.which('zstd')
+    if zstd_bin is None:
+        raise FileNotFoundError('Could not find zstd')
+    return zstd_bin
+
+
+def start_zstd_decompressor(**kwargs):
+    """
+    Starts a zstd command decompressing stdin to stdout.
+
+    kwargs are passed to subprocess.Popen
+    """
+    cmd = (_find_zstd(), '-d', '-c', '-q')
+    get_logger().debug('zstd command line: %s', ' '.join(cmd))
+    return subprocess.Popen(cmd, **kwargs)
+
+
+class _PipedTarFile(tarfile.TarFile):
+    """TarFile in stream mode over a pipe to or from a zstd command"""
+
+    process = None
+
+    def close(self):
+        if self.closed:
+            return
+        writing = self.mode != 'r'
+        super().close()
+        if writing:
+            self.process.stdin.close()
+        else:
+            # Read past the end of the archive so zstd can finish
+            while self.process.stdout.read(1 << 16):
+                pass
+            self.process.stdout.close()
+        if self.process.wait() != 0:
+            get_logger().error('zstd command returned %s', self.process.returncode)
+            raise OSError('zstd command failed for {}'.format(self.name))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            super().__exit__(exc_type, exc_value, traceback)
+            return
+        self.process.kill()
+        self.process.wait()
+        # The pipe to the killed command may be broken
+        with contextlib.suppress(OSError):
+            super().__exit__(exc_type, exc_value, traceback)
+
+
+def open_zstd_tar(archive_path, mode, level=None, tarinfo=tarfile.TarInfo):
+    """
+    Opens the zstd-compressed tar archive at the pathlib.Path archive_path for sequential
+    reading (mode 'r') or writing (mode 'w').
+
+    level is the zstd compression level for writing, or None for the default.
+    tarinfo is the TarInfo class to use.
+
+    Returns a tarfile.TarFile. Closing it raises OSError if the zstd command failed.
+    Raises FileNotFoundError if neither the zstd module nor the zstd command are available.
+    """
+    if mode not in ('r', 'w'):
+        raise ValueError('Unsupported mode: {}'.format(mode))
+    if zstd_module is not None:
+        kwargs = {}
+        if mode == 'w' and level is not None:
+            kwargs['level'] = level
+        return tarfile.open(str(archive_path), mode + ':zst', tarinfo=tarinfo, **kwargs)
+    if mode == 'r':
+        with archive_path.open('rb') as archive_file:
+            process = start_zstd_decompressor(stdin=archive_file, stdout=subprocess.PIPE)
+        fileobj = process.stdout
+    else:
+        cmd = [_find_zstd(), '-q', '-f', '-T0', '-o', str(archive_path)]
+        if level is not None:
+            cmd.append('-{}'.format(level))
+        get_logger().debug('zstd command line: %s', ' '.join(cmd))
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        fileobj = process.stdin
+    try:
+        tar_file = _PipedTarFile.open(name=str(archive_path),
+                                      fileobj=fileobj,
+                                      mode=mode + '|',
+                                      tarinfo=tarinfo)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    tar_file.process = process
+    return tar_file
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+"""
+Random access to the members of source archives without unpacking them
+
+The member index of a .tar or .tar.xz archive records the offset and size of each member
+in the tar data, and the block boundaries of xz archives. It is stored next to the archive,
+and rebuilt when the archive changes. Members of xz archives with multiple blocks, like
+archives compressed by multiple threads, are read by decompressing only the blocks
+containing them. Other archives are decompressed up to the last member read.
+"""
+
+import argparse
+import bisect
+import gzip
+import json
+import lzma
+import posixpath
+import sys
+import tarfile
+from pathlib import Path, PurePosixPath
+
+from _common import ENCODING, get_logger, add_common_params
+from _xz import MAX_BLOCK_SIZE, XzBlock, decompress_block, read_block_data, read_block_index
+
+# Version of the member index format
+_INDEX_VERSION = 1
+
+# Maximum number of symlinks followed when resolving a path
+_MAX_SYMLINKS = 16
+
+
+def get_index_path(archive_path):
+    """Returns the pathlib.Path to the member index of archive_path"""
+    return archive_path.with_name(archive_path.name + '.index')
+
+
+def _get_archive_record(archive_path):
+    stat_result = archive_path.stat()
+    return {'size': stat_result.st_size, 'mtime_ns': stat_result.st_mtime_ns}
+
+
+def _is_xz_archive(archive_path):
+    suffixes = archive_path.suffixes[-2:]
+    if suffixes == ['.tar', '.xz'] or suffixes[-1:] == ['.txz']:
+        return True
+    if suffixes[-1:] == ['.tar']:
+        return False
+    raise ValueError('Unsupported archive type (must be .tar or .tar.xz): {}'.format(archive_path))
+
+
+def _get_root(names):
+    """Returns the top-level directory containing all names, or None if there is none"""
+    root = None
+    for name in names:
+        top_level = name.split('/', 1)[0]
+        if root is None:
+            root = top_level
+        elif top_level != root:
+            return None
+    if root is None or all(name == root for name in names):
+        return None
+    return root
+
+
+def _strip_root(name, root):
+    if root is None:
+        return name
+    if name == root:
+        return ''
+    return name[len(root) + 1:]
+
+
+def _normalize_name(name):
+    return str(PurePosixPath(name.lstrip('/')))
+
+
+class ArchiveIndex:
+    """
+    The member index of a source archive
+
+    Member paths are relative to the top-level directory of the archive, if all
+    members are under the same one.
+    """
+    def __init__(self, archive_path, record):
+        self.archive_path = archive_path
+        self.root = record['root']
+        # Dict of member path to (offset of data, size, tar type, link name)
+        self._members = {name: tuple(value) for name, value in record['members'].items()}
+        self._blocks = [XzBlock(*block[:4], bytes.fromhex(block[4])) for block in record['blocks']]
+        self._block_offsets = [block.uncompressed_offset for block in self._blocks]
+        # Directories without a member, computed when needed
+        self._implied_dirs = None
+
+    def __contains__(self, path):
+        """Returns True if path is a member or a directory containing members"""
+        path = str(PurePosixPath(path))
+        if path in self._members:
+            return True
+        if self._implied_dirs is None:
+            self._implied_dirs = set()
+            for name in self._members:
+                self._implied_dirs.update(str(x) for x in PurePosixPath(name).parents)
+        return path in self._implied_dirs
+
+    def __iter__(self):
+        return iter(self._members)
+
+    def __len__(self):
+        return len(self._members)
+
+    def _resolve(self, path):
+        """Returns the path and entry of the regular file path refers to, following links"""
+        path = str(PurePosixPath(path))
+        for _ in range(_MAX_SYMLINKS):
+            entry = self._members.get(path)
+            if entry is None:
+                raise KeyError(path)
+            _, _, member_type, linkname = entry
+            if member_type == tarfile.SYMTYPE.decode():
+                path = posixpath.normpath(posixpath.join(posixpath.dirname(path), linkname))
+            elif member_type == tarfile.LNKTYPE.decode():
+                path = linkname
+            elif member_type.encode() in tarfile.REGULAR_TYPES:
+                return path, entry
+            else:
+                raise KeyError(path)
+        raise KeyError(path)
+
+    def is_file(self, path):
+        """Returns True if path is a regular file member, or a link resolving to one"""
+        try:
+            self._resolve(path)
+        except KeyError:
+            return False
+        return True
+
+    def read_members(self, paths):
+        """
+        Generates (path, data) of the regular files at paths, in the order of the archive.
+        Links are followed to the members containing the data.
+
+        Raises KeyError if a path is not a member or does not refer to a regular file.
+        """
+        targets = []
+        for path in paths:
+            _, (offset, size, _, _) = self._resolve(path)
+            targets.append((offset, size, str(PurePosixPath(path))))
+        targets.sort()
+        if not _is_xz_archive(self.archive_path):
+            with self.archive_path.open('rb') as archive_file:
+                for offset, size, path in targets:
+                    archive_file.seek(offset)
+                    yield path, archive_file.read(size)
+        elif self._blocks and max(x.uncompressed_size for x in self._blocks) <= MAX_BLOCK_SIZE:
+            yield from self._read_blocks(targets)
+        else:
+            with lzma.open(str(self.archive_path)) as archive_file:
+                # Seeking forward decompresses up to the offset
+                for offset, size, path in targets:
+                    archive_file.seek(offset)
+                    yield path, archive_file.read(size)
+
+    def _read_blocks(self, targets):
+        """Helper for read_members to read targets by decompressing only their blocks"""
+        decoded_blocks = {}
+        with self.archive_path.open('rb') as archive_file:
+            for offset, size, path in targets:
+                first = bisect.bisect_right(self._block_offsets, offset) - 1
+                last = max(bisect.bisect_left(self._block_offsets, offset + size) - 1, first)
+                # Targets are sorted, so blocks before the first are not needed anymore
+                for index in [x for x in decoded_blocks if x < first]:
+                    del decoded_blocks[index]
+                chunks = []
+                for index in range(first, last + 1):
+                    block = self._blocks[index]
+                    if index not in decoded_blocks:
+                        decoded_blocks[index] = decompress_block(
+                            block, read_block_data(archive_file, block))
+                    start = max(offset - block.uncompressed_offset, 0)
+                    chunks.append(decoded_blocks[index][start:offset + size -
+                                                        block.uncompressed_offset])
+                yield path, b''.join(chunks)
+
+
+def _read_tar_members(tar_stream):
+    """Returns a dict of member names to [offset of data, size, tar type, link name]"""
+    members = {}
+    with tarfile.open(fileobj=tar_stream, mode='r|') as tar_file:
+        while True:
+            tarinfo = tar_file.next()
+            if tarinfo is None:
+                break
+            # Do not keep all members in memory
+            tar_file.members.clear()
+            linkname = tarinfo.linkname
+            if tarinfo.islnk():
+                linkname = _normalize_name(linkname)
+            members[_normalize_name(tarinfo.name)] = [
+                tarinfo.offset_data, tarinfo.size,
+                tarinfo.type.decode(), linkname
+            ]
+    return members
+
+
+def build_index(archive_path):
+    """
+    Builds and stores the member index of the .tar or .tar.xz archive at archive_path.
+
+    Returns the ArchiveIndex.
+    Raises ValueError if the archive type is not supported.
+    """
+    record = {'version': _INDEX_VERSION, 'archive': _get_archive_record(archive_path)}
+    if _is_xz_archive(archive_path):
+        with archive_path.open('rb') as archive_file:
+            blocks = read_block_index(archive_file)
+        record['blocks'] = [[*block[:4], block.stream_flags.hex()] for block in blocks]
+        tar_stream = lzma.open(str(archive_path))
+    else:
+        record['blocks'] = []
+        tar_stream = archive_path.open('rb')
+    with tar_stream:
+        members = _read_tar_members(tar_stream)
+    root = _get_root(members)
+    record['root'] = root
+    record['members'] = {}
+    for name, (offset, size, member_type, linkname) in members.items():
+        if member_type == tarfile.LNKTYPE.decode():
+            linkname = _strip_root(linkname, root)
+        name = _strip_root(name, root)
+        if name:
+            record['members'][name] = [offset, size, member_type, linkname]
+    index_path = get_index_path(archive_path)
+    tmp_path = index_path.with_name(index_path.name + '.tmp')
+    with gzip.open(str(tmp_path), 'wt', encoding=ENCODING) as index_file:
+        json.dump(record, index_file)
+    tmp_path.replace(index_path)
+    return ArchiveIndex(archive_path, record)
+
+
+def load_index(archive_path):
+    """
+    Returns the ArchiveIndex of the .tar or .tar.xz archive at archive_path,
+    building it if it is missing or outdated.
+
+    Raises ValueError if the archive type is not supported.
+    """
+    try:
+        with gzip.open(str(get_index_path(archive_path)), 'rt', encoding=ENCODING) as index_file:
+            record = json.load(index_file)
+        if record['version'] == _INDEX_VERSION and record['archive'] == _get_archive_record(
+                archive_path):
+            return ArchiveIndex(archive_path, record)
+    except (OSError, ValueError, KeyError):
+        pass
+    get_logger().info('Building member index of %s ...', archive_path)
+    return build_index(archive_path)
+
+
+def _build_callback(args):
+    try:
+        index = build_index(args.archive)
+    except (ValueError, tarfile.TarError, lzma.LZMAError) as exc:
+        get_logger().error('Could not index %s: %s', args.archive, exc)
+        sys.exit(1)
+    get_logger().info('Indexed %d members of %s', len(index), args.archive)
+
+
+def _extract_callback(args):
+    try:
+        index = load_index(args.archive)
+        for path, data in index.read_members(args.paths):
+            output_path = args.output / path
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            output_path.write_bytes(data)
+    except KeyError as exc:
+        get_logger().error('Not a file in the archive: %s', exc)
+        sys.exit(1)
+    except (ValueError, tarfile.TarError, lzma.LZMAError) as exc:
+        get_logger().error('Could not read %s: %s', args.archive, exc)
+        sys.exit(1)
+
+
+def main():
+    """CLI Entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_common_params(parser)
+    subparsers = parser.add_subparsers(title='Member index actions', dest='action', required=True)
+
+    build_parser = subparsers.add_parser('build',
+                                         help='Build the member index of an archive',
+                                         description='(Re)builds the member index of an archive.')
+    build_parser.add_argument('archive', type=Path, help='The .tar or .tar.xz archive.')
+    build_parser.set_defaults(callback=_build_callback)
+
+    extract_parser = subparsers.add_parser(
+        'extract',
+        help='Extract files from an archive',
+        description=('Extracts files from an archive using its member index, which is built '
+                     'if needed. Paths are relative to the top-level directory of the archive.'))
+    extract_parser.add_argument('archive', type=Path, help='The .tar or .tar.xz archive.')
+    extract_parser.add_argument('output', type=Path, help='The directory to extract to.')
+    extract_parser.add_argument('paths', nargs='+', help='The files to extract.')
+    extract_parser.set_defaults(callback=_extract_callback)
+
+    args = parser.parse_args()
+    args.callback(args)
+
+
+if __name__ == '__main__':
+    main()
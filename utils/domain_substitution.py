@@ -14,7 +14,6 @@ import collections
 import contextlib
 import io
 import os
-import stat
 import re
 import tarfile
 import tempfile
@@ -22,6 +21,8 @@ import zlib
 
 from _extraction import extract_tar_file
 from _common import ENCODING, get_logger, add_common_params
+from _worktree import break_link
+from _zstdtar import is_zstd_archive, open_zstd_tar
 
 # Encodings to try on source tree files
 TREE_ENCODINGS = ('UTF-8', 'ISO-8859-1')
@@ -89,35 +90,31 @@ def _substitute_path(path, regex_iter):
     Raises FileNotFoundError if path does not exist.
     Raises UnicodeDecodeError if path's contents cannot be decoded.
     """
-    if not os.access(path, os.W_OK):
-        # If the patch cannot be written to, it cannot be opened for updating
-        print(str(path) + " cannot be opened for writing! Adding write permission...")
-        path.chmod(path.stat().st_mode | stat.S_IWUSR)
-    with path.open('r+b') as input_file:
-        original_content = input_file.read()
-        if not original_content:
-            return (None, None)
-        content = None
-        encoding = None
-        for encoding in TREE_ENCODINGS:
-            try:
-                content = original_content.decode(encoding)
-                break
-            except UnicodeDecodeError:
-                continue
-        if not content:
-            raise UnicodeDecodeError('Unable to decode with any encoding: %s' % path)
-        file_subs = 0
-        for regex_pair in regex_iter:
-            content, sub_count = regex_pair.pattern.subn(regex_pair.replacement, content)
-            file_subs += sub_count
-        if file_subs > 0:
-            substituted_content = content.encode(encoding)
-            input_file.seek(0)
-            input_file.write(content.encode(encoding))
-            input_file.truncate()
-            return (zlib.crc32(substituted_content), original_content)
+    original_content = path.read_bytes()
+    if not original_content:
         return (None, None)
+    content = None
+    encoding = None
+    for encoding in TREE_ENCODINGS:
+        try:
+            content = original_content.decode(encoding)
+            break
+        except UnicodeDecodeError:
+            continue
+    if not content:
+        raise UnicodeDecodeError('Unable to decode with any encoding: %s' % path)
+    file_subs = 0
+    for regex_pair in regex_iter:
+        content, sub_count = regex_pair.pattern.subn(regex_pair.replacement, content)
+        file_subs += sub_count
+    if file_subs > 0:
+        substituted_content = content.encode(encoding)
+        # Copy on write if the file shares its data with a pristine tree. This also adds
+        # write permission if needed.
+        break_link(path)
+        path.write_bytes(substituted_content)
+        return (zlib.crc32(substituted_content), original_content)
+    return (None, None)
 
 
 def _validate_file_index(index_file, resolved_tree, cache_index_files):
@@ -173,13 +170,15 @@ def _update_timestamp(path: os.PathLike, set_new: bool) -> None:
     try:
         yield
     finally:
+        # Hardlinks share their timestamps with a pristine tree
+        break_link(Path(path))
         os.utime(path, ns=new_timestamp)
 
 
 # Public Methods
 
 
-def apply_substitution(regex_path, files_path, source_tree, domainsub_cache):
+def apply_substitution(regex_path, files_path, source_tree, domainsub_cache): #pylint: disable=too-many-branches
     """
     Substitute domains in source_tree with files and substitutions,
         and save the pre-domain substitution archive to presubdom_archive.
@@ -206,8 +205,15 @@ def apply_substitution(regex_path, files_path, source_tree, domainsub_cache):
     resolved_tree = source_tree.resolve()
     regex_pairs = DomainRegexList(regex_path).regex_pairs
     fileindex_content = io.BytesIO()
-    with tarfile.open(str(domainsub_cache), 'w:%s' % domainsub_cache.suffix[1:],
-                      compresslevel=1) if domainsub_cache else open(os.devnull, 'w') as cache_tar:
+    if not domainsub_cache:
+        cache_tar = open(os.devnull, 'w')
+    elif is_zstd_archive(domainsub_cache.name):
+        cache_tar = open_zstd_tar(domainsub_cache, 'w', level=1)
+    else:
+        cache_tar = tarfile.open(str(domainsub_cache),
+                                 'w:%s' % domainsub_cache.suffix[1:],
+                                 compresslevel=1)
+    with cache_tar:
         for relative_path in filter(len, files_path.read_text().splitlines()):
             if _INDEX_HASH_DELIMITER in relative_path:
                 if domainsub_cache:
@@ -11,17 +11,24 @@ Module for the downloading, checking, and unpacking of necessary files into the
 import argparse
 import configparser
 import enum
-import hashlib
+import functools
+import http.client
 import shutil
-import ssl
 import subprocess
 import sys
-import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from _cache import SharedCache, get_cache_key, parse_size
 from _common import ENCODING, USE_REGISTRY, ExtractorEnum, PlatformEnum, \
     get_logger, get_chromium_version, get_running_platform, add_common_params
-from _extraction import extract_tar_file, extract_with_7z, extract_with_winrar
+from _downloader import HTTP_TIMEOUT, HTTPConnectionPool, download_file, \
+    download_file_segmented, get_segments_sidecar, rank_mirrors
+from _metrics import ProgressReporter, get_metrics
+from _unpacking import unpack_downloads, unpack_pristine, unpack_streamed
+from _verification import HashMismatchError, MultiHasher, get_hash_pairs, hash_file, \
+    is_verified, remove_verified, write_verified
+from _worktree import clone_tree
 
 sys.path.insert(0, str(Path(__file__).parent / 'third_party'))
 import schema #pylint: disable=wrong-import-position, wrong-import-order
@@ -35,10 +42,6 @@ class HashesURLEnum(str, enum.Enum):
     CHROMIUM = 'chromium'
 
 
-class HashMismatchError(BaseException):
-    """Exception for computed hashes not matching expected hashes"""
-
-
 class DownloadInfo: #pylint: disable=too-few-public-methods
     """Representation of an downloads.ini file for downloading files"""
 
@@ -48,6 +51,7 @@ class DownloadInfo: #pylint: disable=too-few-public-methods
     _optional_keys = (
         'version',
         'strip_leading_dirs',
+        'mirror_urls',
     )
     _passthrough_properties = (*_nonempty_keys, *_optional_keys, 'extractor', 'output_path')
     _ini_vars = {
@@ -85,6 +89,12 @@ class DownloadInfo: #pylint: disable=too-few-public-methods
             download has a hash URL"""
             return 'hash_url' in self._section_dict
 
+        def get_mirror_urls(self):
+            """
+            Returns a list of the URLs of mirrors of the download, which are
+            whitespace-separated in the mirror_urls option"""
+            return (self._section_dict.get('mirror_urls', fallback=None) or '').split()
+
         def __getattr__(self, name):
             if name in self._passthrough_properties:
                 return self._section_dict.get(name, fallback=None)
@@ -160,115 +170,166 @@ class DownloadInfo: #pylint: disable=too-few-public-methods
                 raise KeyError('"{}" has no section "{}"'.format(type(self).__name__, name))
 
 
-class _UrlRetrieveReportHook: #pylint: disable=too-few-public-methods
-    """Hook for urllib.request.urlretrieve to log progress information to console"""
-    def __init__(self):
-        self._max_len_printed = 0
-        self._last_percentage = None
-
-    def __call__(self, block_count, block_size, total_size):
-        # Use total_blocks to handle case total_size < block_size
-        # total_blocks is ceiling of total_size / block_size
-        # Ceiling division from: https://stackoverflow.com/a/17511341
-        total_blocks = -(-total_size // block_size)
-        if total_blocks > 0:
-            # Do not needlessly update the console. Since the console is
-            # updated synchronously, we don't want updating the console to
-            # bottleneck downloading. Thus, only refresh the output when the
-            # displayed value should change.
-            percentage = round(block_count / total_blocks, ndigits=3)
-            if percentage == self._last_percentage:
-                return
-            self._last_percentage = percentage
-            print('\r' + ' ' * self._max_len_printed, end='')
-            status_line = 'Progress: {:.1%} of {:,d} B'.format(percentage, total_size)
-        else:
-            downloaded_estimate = block_count * block_size
-            status_line = 'Progress: {:,d} B of unknown size'.format(downloaded_estimate)
-        self._max_len_printed = len(status_line)
-        print('\r' + status_line, end='')
-
-
-def _download_via_urllib(url, file_path, show_progress, disable_ssl_verification):
-    reporthook = None
-    if show_progress:
-        reporthook = _UrlRetrieveReportHook()
-    if disable_ssl_verification:
-        # TODO: Remove this or properly implement disabling SSL certificate verification
-        orig_https_context = ssl._create_default_https_context #pylint: disable=protected-access
-        ssl._create_default_https_context = ssl._create_unverified_context #pylint: disable=protected-access
-    try:
-        urllib.request.urlretrieve(url, str(file_path), reporthook=reporthook)
-    finally:
-        # Try to reduce damage of hack by reverting original HTTPS context ASAP
-        if disable_ssl_verification:
-            ssl._create_default_https_context = orig_https_context #pylint: disable=protected-access
-    if show_progress:
-        print()
+def _download_from_url(tmp_file_path, url, progress, connection_pool, segments, hasher):
+    """
+    Downloads url to the partial download file tmp_file_path, resuming it if possible.
 
+    Returns True if hasher was fed the whole file; False otherwise.
+    """
+    if tmp_file_path.exists():
+        get_logger().debug('Resuming downloading URL %s ...', url)
+    else:
+        get_logger().debug('Downloading URL %s ...', url)
 
-def _download_if_needed(file_path, url, show_progress, disable_ssl_verification):
+    if connection_pool is None:
+        get_logger().debug('Using curl')
+        subprocess.run(['curl', '-fL', '-o', str(tmp_file_path), '-C', '-', url], check=True)
+        return False
+    get_logger().debug('Using built-in downloader')
+    # A partial file without a segments sidecar is resumed with a single connection,
+    # and a partial file with one is always resumed per segment.
+    if get_segments_sidecar(tmp_file_path).exists():
+        use_segments = True
+    else:
+        use_segments = segments > 1 and not tmp_file_path.exists()
+    if use_segments and download_file_segmented(url, tmp_file_path, connection_pool,
+                                                progress, segments):
+        return False
+    download_file(url, tmp_file_path, connection_pool, progress, hasher)
+    return hasher is not None
+
+
+def _download_if_needed(file_path,
+                        url,
+                        progress,
+                        connection_pool=None,
+                        segments=1,
+                        hasher=None,
+                        mirror_urls=()):
     """
     Downloads a file from url to the specified path file_path if necessary.
 
-    If show_progress is True, download progress is printed to the console.
+    progress is the ProgressReporter of the built-in downloader, or None.
+    connection_pool is the HTTPConnectionPool for the built-in downloader,
+        or None to download with curl.
+    segments is the number of byte ranges to download concurrently with the built-in
+        downloader. Servers without byte range support are downloaded with one connection.
+    hasher is a MultiHasher to feed the downloaded bytes to, or None.
+        It is only used when the file is downloaded by a single stream of the built-in
+        downloader.
+    mirror_urls is a sequence of URLs of mirrors of url. With the built-in downloader,
+        url and the mirrors are tried in order of their latency; with curl, in the given order.
+        A download that fails or stalls is resumed from the next URL.
+
+    Returns True if hasher was fed the whole file; False otherwise.
     """
     if file_path.exists():
         get_logger().info('%s already exists. Skipping download.', file_path)
-        return
+        return False
 
     # File name for partially download file
     tmp_file_path = file_path.with_name(file_path.name + '.partial')
 
-    if tmp_file_path.exists():
-        get_logger().debug('Resuming downloading URL %s ...', url)
-    else:
-        get_logger().debug('Downloading URL %s ...', url)
+    urls = [url, *mirror_urls]
+    if len(urls) > 1 and connection_pool is not None:
+        urls = rank_mirrors(urls, connection_pool)
+        get_logger().debug('Mirrors in order of latency: %s', ', '.join(urls))
 
     # Perform download
-    if shutil.which('curl'):
-        get_logger().debug('Using curl')
+    for index, current_url in enumerate(urls):
         try:
-            subprocess.run(['curl', '-fL', '-o', str(tmp_file_path), '-C', '-', url], check=True)
-        except subprocess.CalledProcessError as exc:
-            get_logger().error('curl failed. Re-run the download command to resume downloading.')
-            raise exc
-    else:
-        get_logger().debug('Using urllib')
-        _download_via_urllib(url, tmp_file_path, show_progress, disable_ssl_verification)
+            hashed = _download_from_url(tmp_file_path, current_url, progress,
+                                        connection_pool, segments, hasher)
+            break
+        except (OSError, http.client.HTTPException, subprocess.CalledProcessError) as exc:
+            if index + 1 == len(urls):
+                get_logger().error('Download of %s failed. Re-run the download command to resume '
+                                   'downloading.', current_url)
+                raise
+            get_logger().warning('Download of %s failed (%s). Resuming from %s', current_url, exc,
+                                 urls[index + 1])
+            if hasher is not None:
+                # The next attempt feeds the hasher from the start of the file
+                hasher.reset()
 
     # Download complete; rename file
     tmp_file_path.rename(file_path)
+    return hashed
 
 
-def _chromium_hashes_generator(hashes_path):
-    with hashes_path.open(encoding=ENCODING) as hashes_file:
-        hash_lines = hashes_file.read().splitlines()
-    for hash_name, hash_hex, _ in map(lambda x: x.lower().split('  '), hash_lines):
-        if hash_name in hashlib.algorithms_available:
-            yield hash_name, hash_hex
-        else:
-            get_logger().warning('Skipping unknown hash algorithm: %s', hash_name)
-
-
-def _get_hash_pairs(download_properties, cache_dir):
-    """Generator of (hash_name, hash_hex) for the given download"""
-    for entry_type, entry_value in download_properties.hashes.items():
-        if entry_type == 'hash_url':
-            hash_processor, hash_filename, _ = entry_value
-            if hash_processor == 'chromium':
-                yield from _chromium_hashes_generator(cache_dir / hash_filename)
-            else:
-                raise ValueError('Unknown hash_url processor: %s' % hash_processor)
-        else:
-            yield entry_type, entry_value
-
+def _retrieve_download(download_name, #pylint: disable=too-many-arguments,too-many-locals
+                       download_properties,
+                       cache_dir,
+                       show_progress,
+                       connection_pool,
+                       segments,
+                       verify_hashes,
+                       shared_cache):
+    """
+    Retrieves the files of a single download into the downloads cache
 
-def retrieve_downloads(download_info,
+    Returns True if the download was verified while downloading or placed from the
+    shared cache; False otherwise.
+    Raises HashMismatchError if the verification while downloading fails.
+    """
+    if download_properties.has_hash_url():
+        get_logger().info('Downloading hashes for "%s"', download_name)
+        _, hash_filename, hash_url = download_properties.hashes['hash_url']
+        _download_if_needed(cache_dir / hash_filename, hash_url, None, connection_pool)
+    download_path = cache_dir / download_properties.download_filename
+    hash_pairs = None
+    if verify_hashes or shared_cache is not None:
+        hash_pairs = list(get_hash_pairs(download_properties, cache_dir))
+    cache_key = None
+    if shared_cache is not None:
+        cache_key = get_cache_key(hash_pairs)
+        if cache_key and not download_path.exists() and shared_cache.fetch(
+                cache_key, download_path):
+            # Objects of the shared cache were verified when they were added
+            get_logger().info('Placed "%s" from shared cache', download_name)
+            write_verified(download_path, hash_pairs)
+            return True
+    if download_path.exists():
+        get_logger().info('%s already exists. Skipping download.', download_path)
+        return False
+    get_logger().info('Downloading "%s" to "%s" ...', download_name,
+                      download_properties.download_filename)
+    hasher = None
+    if verify_hashes:
+        hasher = MultiHasher(hash_pairs)
+    with get_metrics().phase('download', download_name) as phase_result:
+        progress = ProgressReporter('download', download_name, show_progress)
+        try:
+            hashed = _download_if_needed(download_path, download_properties.url, progress,
+                                         connection_pool, segments, hasher,
+                                         download_properties.get_mirror_urls())
+        finally:
+            progress.finish()
+        # Resumed data is not counted, except by curl which does not report progress
+        phase_result['bytes'] = progress.transferred_bytes
+        if phase_result['bytes'] is None:
+            phase_result['bytes'] = download_path.stat().st_size
+        if hashed:
+            get_logger().info('Verifying hashes for "%s" ...', download_name)
+            remove_verified(download_path)
+            hasher.verify(download_path)
+            write_verified(download_path, hash_pairs)
+    if hashed and cache_key:
+        shared_cache.store(cache_key, download_path)
+    return hashed
+
+
+def retrieve_downloads(download_info, #pylint: disable=too-many-arguments,too-many-locals,too-many-branches
                        cache_dir,
                        components,
                        show_progress,
-                       disable_ssl_verification=False):
+                       disable_ssl_verification=False,
+                       jobs=1,
+                       use_curl=False,
+                       segments=1,
+                       verify_hashes=False,
+                       shared_cache=None,
+                       stall_timeout=HTTP_TIMEOUT):
     """
     Retrieve downloads into the downloads cache.
 
@@ -276,110 +337,211 @@ def retrieve_downloads(download_info,
     cache_dir is the pathlib.Path to the downloads cache.
     components is a list of component names to download, if not empty.
     show_progress is a boolean indicating if download progress is printed to the console.
+        It is ignored when more than one download runs at a time.
     disable_ssl_verification is a boolean indicating if certificate verification
         should be disabled for downloads using HTTPS.
+    jobs is the maximum number of downloads to run concurrently.
+    use_curl is a boolean indicating if curl should be used instead of the built-in downloader.
+    segments is the number of byte ranges of each download to fetch concurrently
+        with the built-in downloader.
+    verify_hashes is a boolean indicating if hashes should be computed while downloading,
+        so check_downloads() does not need to read the new files again.
+    shared_cache is the SharedCache to place downloads from before downloading them,
+        and to add downloads verified while downloading to, or None.
+    stall_timeout is the number of seconds a connection of the built-in downloader may wait
+        for data before the download fails, or is resumed from the next mirror if any.
+
+    Returns a set of the names of downloads that were verified while downloading
+    or placed from the shared cache.
 
     Raises FileNotFoundError if the downloads path does not exist.
     Raises NotADirectoryError if the downloads path is not a directory.
+    Raises HashMismatchError if the verification while downloading fails.
     """
     if not cache_dir.exists():
         raise FileNotFoundError(cache_dir)
     if not cache_dir.is_dir():
         raise NotADirectoryError(cache_dir)
-    for download_name, download_properties in download_info.properties_iter():
-        if components and not download_name in components:
-            continue
-        get_logger().info('Downloading "%s" to "%s" ...', download_name,
-                          download_properties.download_filename)
-        download_path = cache_dir / download_properties.download_filename
-        _download_if_needed(download_path, download_properties.url, show_progress,
-                            disable_ssl_verification)
-        if download_properties.has_hash_url():
-            get_logger().info('Downloading hashes for "%s"', download_name)
-            _, hash_filename, hash_url = download_properties.hashes['hash_url']
-            _download_if_needed(cache_dir / hash_filename, hash_url, show_progress,
-                                disable_ssl_verification)
-
-
-def check_downloads(download_info, cache_dir, components, chunk_bytes=262144):
+    if use_curl:
+        if not shutil.which('curl'):
+            raise FileNotFoundError('Could not find curl')
+        if segments > 1:
+            get_logger().warning('Segmented downloads are not supported with curl. Ignoring.')
+        connection_pool = None
+    else:
+        connection_pool = HTTPConnectionPool(disable_ssl_verification, stall_timeout)
+    download_list = [(download_name, download_properties)
+                     for download_name, download_properties in download_info.properties_iter()
+                     if not components or download_name in components]
+    verified = set()
+    try:
+        if jobs > 1 and len(download_list) > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [(download_name,
+                            executor.submit(_retrieve_download, download_name, download_properties,
+                                            cache_dir, False, connection_pool, segments,
+                                            verify_hashes, shared_cache))
+                           for download_name, download_properties in download_list]
+                for download_name, future in futures:
+                    if future.result():
+                        verified.add(download_name)
+        else:
+            for download_name, download_properties in download_list:
+                if _retrieve_download(download_name, download_properties, cache_dir,
+                                      show_progress, connection_pool, segments, verify_hashes,
+                                      shared_cache):
+                    verified.add(download_name)
+    finally:
+        if connection_pool is not None:
+            connection_pool.close()
+    return verified
+
+
+def check_downloads(download_info, #pylint: disable=too-many-arguments,too-many-locals
+                    cache_dir,
+                    components,
+                    chunk_bytes=262144,
+                    hash_threads=1,
+                    force_verify=False,
+                    shared_cache=None,
+                    show_progress=False):
     """
     Check integrity of the downloads cache.
 
+    Successful verifications are recorded in a sidecar file next to each download with the
+    file's size, modification time and inode, and the expected hashes. A download is not
+    hashed again while all of these are unchanged.
+
     download_info is the DownloadInfo of downloads to unpack.
     cache_dir is the pathlib.Path to the downloads cache.
     chunk_bytes is the size for each chunk which need to read.
     components is a list of component names to check, if not empty.
+    hash_threads is the number of threads computing the hashes of a file. If it is more than 1,
+        the hashes are computed concurrently while the next chunk of the file is read.
+    force_verify is a boolean indicating if downloads should be hashed regardless of
+        their verification sidecars.
+    shared_cache is the SharedCache to add verified downloads to, or None.
+    show_progress is a boolean indicating if hashing progress is printed to the console.
 
     Raises source_retrieval.HashMismatchError when the computed and expected hashes do not match.
     """
-    logger = get_logger()
-    for download_name, download_properties in download_info.properties_iter():
-        if components and not download_name in components:
-            continue
-        get_logger().info('Verifying hashes for "%s" ...', download_name)
-
-        download_path = cache_dir / download_properties.download_filename
-        for hash_name, hash_hex in _get_hash_pairs(download_properties, cache_dir):
-            logger.info('Verifying %s hash...', hash_name)
-            hasher = hashlib.new(hash_name)
-            with download_path.open('rb') as file_obj:
-                # Read file in chunks. Default is 262144 bytes.
-                chunk = file_obj.read(chunk_bytes)
-                while chunk:
-                    hasher.update(chunk)
-                    chunk = file_obj.read(chunk_bytes)
-            if not hasher.hexdigest().lower() == hash_hex.lower():
-                raise HashMismatchError(download_path)
-
-
-def unpack_downloads(download_info,
-                     cache_dir,
-                     components,
-                     output_dir,
-                     skip_unused,
-                     sysroot,
-                     extractors=None):
+    executor = ThreadPoolExecutor(max_workers=hash_threads) if hash_threads > 1 else None
+    try:
+        for download_name, download_properties in download_info.properties_iter():
+            if components and not download_name in components:
+                continue
+            download_path = cache_dir / download_properties.download_filename
+            hash_pairs = list(get_hash_pairs(download_properties, cache_dir))
+            if not force_verify and is_verified(download_path, hash_pairs):
+                get_logger().info('Hashes for "%s" were already verified', download_name)
+            else:
+                get_logger().info('Verifying hashes for "%s" ...', download_name)
+                remove_verified(download_path)
+                hasher = MultiHasher(hash_pairs)
+                with get_metrics().phase('verify', download_name) as phase_result:
+                    progress = ProgressReporter('verify', download_name, show_progress)
+                    try:
+                        # Read the file once for all hashes. Default chunk size is 262144 bytes.
+                        hash_file(download_path, hasher, chunk_bytes, executor, progress)
+                    finally:
+                        progress.finish()
+                    hasher.verify(download_path)
+                    phase_result['bytes'] = download_path.stat().st_size
+                write_verified(download_path, hash_pairs)
+            cache_key = get_cache_key(hash_pairs)
+            if shared_cache is not None and cache_key:
+                shared_cache.store(cache_key, download_path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def _can_fetch_unpack(download_path, download_properties):
+    """Returns True if the download can be unpacked while it is downloaded; False otherwise"""
+    if download_path.exists() or (download_properties.extractor
+                                  or ExtractorEnum.TAR) != ExtractorEnum.TAR:
+        return False
+    # A partial segmented download is not resumed as a single stream
+    return not get_segments_sidecar(download_path.with_name(download_path.name +
+                                                            '.partial')).exists()
+
+
+def _fetch_streamed(download_name, #pylint: disable=too-many-arguments
+                    download_properties,
+                    download_path,
+                    connection_pool,
+                    show_progress,
+                    unpacking_hasher):
+    """Downloads a download while feeding it to the UnpackingHasher unpacking_hasher"""
+    progress = ProgressReporter('fetch-unpack', download_name, show_progress)
+    try:
+        _download_if_needed(download_path, download_properties.url, progress, connection_pool, 1,
+                            unpacking_hasher, download_properties.get_mirror_urls())
+    finally:
+        progress.finish()
+
+
+def fetch_unpack_downloads(download_info, #pylint: disable=too-many-arguments,too-many-locals
+                           cache_dir,
+                           components,
+                           output_dir,
+                           skip_unused,
+                           sysroot,
+                           extractors=None,
+                           show_progress=True,
+                           disable_ssl_verification=False,
+                           quarantine_dir=None):
     """
-    Unpack downloads in the downloads cache to output_dir. Assumes all downloads are retrieved.
+    Retrieve downloads into the downloads cache and unpack them to output_dir while
+    they are downloaded.
 
-    download_info is the DownloadInfo of downloads to unpack.
-    cache_dir is the pathlib.Path directory containing the download cache
-    components is a list of component names to unpack, if not empty.
-    output_dir is the pathlib.Path directory to unpack the downloads to.
-    skip_unused is a boolean that determines if unused paths should be extracted.
-    sysroot is a string containing a sysroot to unpack if any.
-    extractors is a dictionary of PlatformEnum to a command or path to the
-        extractor binary. Defaults to 'tar' for tar, and '_use_registry' for 7-Zip and WinRAR.
+    Each tar archive is hashed and unpacked from the same stream as it is written to the
+    downloads cache. It is unpacked into a staging directory in output_dir, which is moved
+    into the output path of the download after the hashes are verified. Downloads already
+    in the cache or using other extractors are retrieved, checked and unpacked in turn.
 
+    quarantine_dir is the pathlib.Path to move the unpacked files of downloads failing
+        verification to, or None to delete them.
+    The other arguments are the same as for retrieve_downloads() and unpack_downloads().
+
+    Raises HashMismatchError when the computed and expected hashes do not match.
     May raise undetermined exceptions during archive unpacking.
     """
-    for download_name, download_properties in download_info.properties_iter():
-        if components and not download_name in components:
-            continue
-        download_path = cache_dir / download_properties.download_filename
-        get_logger().info('Unpacking "%s" to %s ...', download_name,
-                          download_properties.output_path)
-        extractor_name = download_properties.extractor or ExtractorEnum.TAR
-        if extractor_name == ExtractorEnum.SEVENZIP:
-            extractor_func = extract_with_7z
-        elif extractor_name == ExtractorEnum.WINRAR:
-            extractor_func = extract_with_winrar
-        elif extractor_name == ExtractorEnum.TAR:
-            extractor_func = extract_tar_file
-        else:
-            raise NotImplementedError(extractor_name)
-
-        if download_properties.strip_leading_dirs is None:
-            strip_leading_dirs_path = None
-        else:
-            strip_leading_dirs_path = Path(download_properties.strip_leading_dirs)
-
-        extractor_func(archive_path=download_path,
-                       output_dir=output_dir / Path(download_properties.output_path),
-                       relative_to=strip_leading_dirs_path,
-                       skip_unused=skip_unused,
-                       sysroot=sysroot,
-                       extractors=extractors)
+    connection_pool = HTTPConnectionPool(disable_ssl_verification)
+    try:
+        for download_name, download_properties in download_info.properties_iter():
+            if components and not download_name in components:
+                continue
+            download_path = cache_dir / download_properties.download_filename
+            if not _can_fetch_unpack(download_path, download_properties):
+                _retrieve_download(download_name, download_properties, cache_dir, show_progress,
+                                   connection_pool, 1, False, None)
+                check_downloads(download_info,
+                                cache_dir, [download_name],
+                                show_progress=show_progress)
+                unpack_downloads(download_info,
+                                 cache_dir, [download_name],
+                                 output_dir,
+                                 skip_unused,
+                                 sysroot,
+                                 extractors,
+                                 show_progress=show_progress)
+                continue
+            if download_properties.has_hash_url():
+                _, hash_filename, hash_url = download_properties.hashes['hash_url']
+                _download_if_needed(cache_dir / hash_filename, hash_url, None, connection_pool)
+            get_logger().info('Downloading and unpacking "%s" to %s ...', download_name,
+                              download_properties.output_path)
+            with get_metrics().phase('fetch-unpack', download_name) as phase_result:
+                unpack_streamed(
+                    download_name, download_properties, download_path, output_dir,
+                    list(get_hash_pairs(download_properties, cache_dir)),
+                    functools.partial(_fetch_streamed, download_name, download_properties,
+                                      download_path, connection_pool, show_progress),
+                    skip_unused, sysroot, extractors, quarantine_dir)
+                phase_result['bytes'] = download_path.stat().st_size
+    finally:
+        connection_pool.close()
 
 
 def _add_common_args(parser):
@@ -394,30 +556,142 @@ def _add_common_args(parser):
                         type=Path,
                         required=True,
                         help='Path to the directory to cache downloads.')
+    parser.add_argument('--metrics-json',
+                        type=Path,
+                        metavar='PATH',
+                        help=('Append progress and the time taken by each phase of each component '
+                              'to PATH as JSON lines.'))
+
+
+def _get_shared_cache(args):
+    if args.shared_cache is None:
+        return None
+    return SharedCache(args.shared_cache, args.shared_cache_size)
+
+
+def _open_metrics(args):
+    if args.metrics_json is not None:
+        get_metrics().open(args.metrics_json)
 
 
 def _retrieve_callback(args):
+    _open_metrics(args)
     info = DownloadInfo(args.ini)
     info.check_sections_exist(args.components)
-    retrieve_downloads(info, args.cache, args.components, args.show_progress,
-                       args.disable_ssl_verification)
+    shared_cache = _get_shared_cache(args)
     try:
-        check_downloads(info, args.cache, args.components)
+        verified = retrieve_downloads(info, args.cache, args.components, args.show_progress,
+                                      args.disable_ssl_verification, args.jobs, args.use_curl,
+                                      args.segments, args.verify_during_download, shared_cache,
+                                      args.stall_timeout)
+        unverified = [name for name in info if name not in verified]
+        if args.components:
+            unverified = [name for name in unverified if name in args.components]
+        if unverified:
+            check_downloads(info,
+                            args.cache,
+                            unverified,
+                            hash_threads=args.hash_threads,
+                            force_verify=args.force_verify,
+                            shared_cache=shared_cache,
+                            show_progress=args.show_progress)
     except HashMismatchError as exc:
         get_logger().error('File checksum does not match: %s', exc)
         sys.exit(1)
 
 
-def _unpack_callback(args):
-    extractors = {
+def _cache_gc_callback(args):
+    total_size = SharedCache(args.shared_cache).collect_garbage(args.max_size)
+    get_logger().info('Shared cache size: %d B', total_size)
+
+
+def _get_extractors(args):
+    return {
         ExtractorEnum.SEVENZIP: args.sevenz_path,
         ExtractorEnum.WINRAR: args.winrar_path,
         ExtractorEnum.TAR: args.tar_path,
     }
+
+
+def _unpack_callback(args):
+    _open_metrics(args)
+    info = DownloadInfo(args.ini)
+    info.check_sections_exist(args.components)
+    try:
+        if args.pristine is None:
+            unpack_downloads(info, args.cache, args.components, args.output, args.skip_unused,
+                             args.sysroot, _get_extractors(args), args.jobs, args.verify,
+                             args.update_existing, args.show_progress)
+        else:
+            unpack_pristine(info, args.cache, args.components, args.pristine, args.output,
+                            args.skip_unused, args.sysroot, _get_extractors(args), args.jobs,
+                            args.verify, args.show_progress)
+    except HashMismatchError as exc:
+        get_logger().error('File checksum does not match: %s', exc)
+        sys.exit(1)
+    except FileExistsError as exc:
+        get_logger().error('Directory is not empty: %s', exc)
+        sys.exit(1)
+    except OSError as exc:
+        get_logger().error('Could not unpack downloads: %s', exc)
+        sys.exit(1)
+
+
+def _clone_tree_callback(args):
+    try:
+        counts = clone_tree(args.pristine, args.output, args.jobs, args.use_reflinks)
+    except FileExistsError as exc:
+        get_logger().error('Directory is not empty: %s', exc)
+        sys.exit(1)
+    get_logger().info('Cloned %d files as reflinks, %d as hardlinks and %d as copies',
+                      counts['reflink'], counts['hardlink'], counts['copy'])
+
+
+def _fetch_unpack_callback(args):
+    _open_metrics(args)
     info = DownloadInfo(args.ini)
     info.check_sections_exist(args.components)
-    unpack_downloads(info, args.cache, args.components, args.output, args.skip_unused, args.sysroot,
-                     extractors)
+    try:
+        fetch_unpack_downloads(info, args.cache, args.components, args.output, args.skip_unused,
+                               args.sysroot, _get_extractors(args), args.show_progress,
+                               args.disable_ssl_verification, args.quarantine)
+    except HashMismatchError as exc:
+        get_logger().error('File checksum does not match: %s', exc)
+        sys.exit(1)
+    except OSError as exc:
+        get_logger().error('Could not retrieve or unpack downloads: %s', exc)
+        sys.exit(1)
+
+
+def _default_extractor_path(name):
+    return USE_REGISTRY if get_running_platform() == PlatformEnum.WINDOWS else name
+
+
+def _add_unpack_args(parser):
+    parser.add_argument('--tar-path',
+                        default='tar',
+                        help=('(Linux and macOS only) Command or path to the BSD or GNU tar '
+                              'binary for extraction. Default: %(default)s'))
+    parser.add_argument(
+        '--7z-path',
+        dest='sevenz_path',
+        default=_default_extractor_path('7z'),
+        help=('Command or path to 7-Zip\'s "7z" binary. If "_use_registry" is '
+              'specified, determine the path from the registry. Default: %(default)s'))
+    parser.add_argument(
+        '--winrar-path',
+        dest='winrar_path',
+        default=USE_REGISTRY,
+        help=('Command or path to WinRAR\'s "winrar" binary. If "_use_registry" is '
+              'specified, determine the path from the registry. Default: %(default)s'))
+    parser.add_argument('output', type=Path, help='The directory to unpack to.')
+    parser.add_argument('--skip-unused',
+                        action='store_true',
+                        help='Skip extraction of unused directories (CONTINGENT_PATHS).')
+    parser.add_argument('--sysroot',
+                        choices=('amd64', 'i386'),
+                        help=('Extracts the sysroot for the given architecture '
+                              'when --skip-unused is set.'))
 
 
 def main():
@@ -431,9 +705,10 @@ def main():
         'retrieve',
         help='Retrieve and check download files',
         description=('Retrieves and checks downloads without unpacking. '
-                     'The downloader will attempt to use CLI command "curl". '
-                     'If it is not present, Python\'s urllib will be used. However, only '
-                     'the CLI-based downloaders can be resumed if the download is aborted.'))
+                     'The built-in downloader reuses connections to each host and resumes '
+                     'aborted downloads. Components with "mirror_urls" are downloaded from the '
+                     'mirror with the lowest latency, and resumed from the next one if it fails. '
+                     'The CLI command "curl" can be used instead with --use-curl.'))
     _add_common_args(retrieve_parser)
     retrieve_parser.add_argument('--components',
                                  nargs='+',
@@ -447,10 +722,79 @@ def main():
         '--disable-ssl-verification',
         action='store_true',
         help='Disables certification verification for downloads using HTTPS.')
+    retrieve_parser.add_argument('-j',
+                                 '--jobs',
+                                 type=int,
+                                 default=1,
+                                 metavar='NUM',
+                                 help=('The number of components to download concurrently. '
+                                       'Default: %(default)s'))
+    retrieve_parser.add_argument('--use-curl',
+                                 action='store_true',
+                                 help='Download with the CLI command "curl".')
+    retrieve_parser.add_argument(
+        '--segments',
+        type=int,
+        default=1,
+        metavar='NUM',
+        help=('The number of byte ranges of each file to download concurrently. '
+              'Interrupted segmented downloads resume per segment. '
+              'Not supported with --use-curl. Default: %(default)s'))
+    retrieve_parser.add_argument(
+        '--stall-timeout',
+        type=float,
+        default=HTTP_TIMEOUT,
+        metavar='SECONDS',
+        help=('The number of seconds to wait for data before a download fails, or is resumed '
+              'from the next mirror of the component\'s "mirror_urls" if any. '
+              'Not supported with --use-curl. Default: %(default)s'))
+    retrieve_parser.add_argument(
+        '--verify-during-download',
+        action='store_true',
+        help=('Compute hashes while downloading so new files do not need to be read again. '
+              'Not supported with --use-curl or --segments.'))
+    retrieve_parser.add_argument('--hash-threads',
+                                 type=int,
+                                 default=1,
+                                 metavar='NUM',
+                                 help=('The number of threads to compute the hashes of each '
+                                       'file with. Default: %(default)s'))
+    retrieve_parser.add_argument(
+        '--force-verify',
+        action='store_true',
+        help=('Hash all downloads, even those recorded as verified and unchanged since. '
+              'Verifications are recorded in a ".verified" file next to each download.'))
+    retrieve_parser.add_argument(
+        '--shared-cache',
+        type=Path,
+        metavar='DIR',
+        help=('Host-wide cache of verified downloads shared by download caches. Downloads are '
+              'placed from it as hardlinks, and verified downloads are added to it.'))
+    retrieve_parser.add_argument(
+        '--shared-cache-size',
+        type=parse_size,
+        metavar='SIZE',
+        help=('Evict the least recently used downloads from the shared cache to keep it under '
+              'SIZE (e.g. "50G") after adding downloads. Default: no limit'))
     retrieve_parser.set_defaults(callback=_retrieve_callback)
 
-    def _default_extractor_path(name):
-        return USE_REGISTRY if get_running_platform() == PlatformEnum.WINDOWS else name
+    # cache-gc
+    cache_gc_parser = subparsers.add_parser(
+        'cache-gc',
+        help='Clean up the shared downloads cache',
+        description=('Removes stale entries of the shared downloads cache and evicts the least '
+                     'recently used downloads to fit a size budget.'))
+    cache_gc_parser.add_argument('--shared-cache',
+                                 type=Path,
+                                 required=True,
+                                 metavar='DIR',
+                                 help='Path to the shared downloads cache.')
+    cache_gc_parser.add_argument('--max-size',
+                                 type=parse_size,
+                                 metavar='SIZE',
+                                 help=('Evict downloads until the cache is under SIZE '
+                                       '(e.g. "50G"). Default: no eviction'))
+    cache_gc_parser.set_defaults(callback=_cache_gc_callback)
 
     # unpack
     unpack_parser = subparsers.add_parser(
@@ -462,32 +806,98 @@ def main():
                                nargs='+',
                                metavar='COMP',
                                help='Unpack only these components. Default: all')
-    unpack_parser.add_argument('--tar-path',
-                               default='tar',
-                               help=('(Linux and macOS only) Command or path to the BSD or GNU tar '
-                                     'binary for extraction. Default: %(default)s'))
+    unpack_parser.add_argument('--hide-progress-bar',
+                               action='store_false',
+                               dest='show_progress',
+                               help=('Hide the unpacking progress. It is not shown when more '
+                                     'than one component is unpacked at a time.'))
+    _add_unpack_args(unpack_parser)
+    unpack_parser.add_argument('-j',
+                               '--jobs',
+                               type=int,
+                               default=1,
+                               metavar='NUM',
+                               help=('The number of components to unpack concurrently. '
+                                     'Components with overlapping output paths are unpacked '
+                                     'one after another. Default: %(default)s'))
     unpack_parser.add_argument(
-        '--7z-path',
-        dest='sevenz_path',
-        default=_default_extractor_path('7z'),
-        help=('Command or path to 7-Zip\'s "7z" binary. If "_use_registry" is '
-              'specified, determine the path from the registry. Default: %(default)s'))
-    unpack_parser.add_argument(
-        '--winrar-path',
-        dest='winrar_path',
-        default=USE_REGISTRY,
-        help=('Command or path to WinRAR\'s "winrar" binary. If "_use_registry" is '
-              'specified, determine the path from the registry. Default: %(default)s'))
-    unpack_parser.add_argument('output', type=Path, help='The directory to unpack to.')
-    unpack_parser.add_argument('--skip-unused',
-                               action='store_true',
-                               help='Skip extraction of unused directories (CONTINGENT_PATHS).')
-    unpack_parser.add_argument('--sysroot',
-                               choices=('amd64', 'i386'),
-                               help=('Extracts the sysroot for the given architecture '
-                                     'when --skip-unused is set.'))
+        '--verify',
+        action='store_true',
+        help=('Verify the hashes of downloads not yet verified by the check command. Tar archives '
+              'are read once for hashing and unpacking, and their files are only moved into '
+              'place if all hashes match.'))
+    unpack_mode_group = unpack_parser.add_mutually_exclusive_group()
+    unpack_mode_group.add_argument(
+        '--pristine',
+        type=Path,
+        metavar='DIR',
+        help=('Unpack into the read-only pristine tree DIR, unless it already contains the '
+              'downloads, and clone it to the output directory like the clone-tree command.'))
+    unpack_mode_group.add_argument(
+        '--update-existing',
+        action='store_true',
+        help=('Update an existing tree, e.g. to a new version: only rewrite files whose size or '
+              'content differ, so unchanged files keep their modification times, and remove '
+              'files absent from the archives. The output paths of other components and the '
+              'build output directory "out" are kept. Tar archives are read by the Python '
+              'extractor in this mode.'))
     unpack_parser.set_defaults(callback=_unpack_callback)
 
+    # clone-tree
+    clone_tree_parser = subparsers.add_parser(
+        'clone-tree',
+        help='Create a working tree from a pristine tree',
+        description=('Creates a working tree from a pristine tree created by unpack --pristine. '
+                     'Files are cloned with reflinks where the file system supports them, and '
+                     'hardlinks otherwise. The utilities modifying files copy hardlinked files '
+                     'before writing them, so the pristine tree is never modified.'))
+    clone_tree_parser.add_argument('pristine', type=Path, help='The pristine tree.')
+    clone_tree_parser.add_argument('output',
+                                   type=Path,
+                                   help='The directory to create. It must not exist or be empty.')
+    clone_tree_parser.add_argument('-j',
+                                   '--jobs',
+                                   type=int,
+                                   default=4,
+                                   metavar='NUM',
+                                   help='The number of files to clone concurrently. '
+                                   'Default: %(default)s')
+    clone_tree_parser.add_argument('--no-reflinks',
+                                   action='store_false',
+                                   dest='use_reflinks',
+                                   help='Use hardlinks even if reflinks are supported.')
+    clone_tree_parser.set_defaults(callback=_clone_tree_callback)
+
+    # fetch-unpack
+    fetch_unpack_parser = subparsers.add_parser(
+        'fetch-unpack',
+        help='Retrieve, check and unpack download files at once',
+        description=('Retrieves downloads and unpacks tar archives while they are downloaded. '
+                     'Each archive is hashed and unpacked from the downloaded data as it is '
+                     'written to the cache, into a staging directory in the output directory. '
+                     'The unpacked files are moved into place once the hashes are verified.'))
+    _add_common_args(fetch_unpack_parser)
+    fetch_unpack_parser.add_argument('--components',
+                                     nargs='+',
+                                     metavar='COMP',
+                                     help='Retrieve and unpack only these components. Default: all')
+    fetch_unpack_parser.add_argument('--hide-progress-bar',
+                                     action='store_false',
+                                     dest='show_progress',
+                                     help='Hide the download progress.')
+    fetch_unpack_parser.add_argument(
+        '--disable-ssl-verification',
+        action='store_true',
+        help='Disables certification verification for downloads using HTTPS.')
+    fetch_unpack_parser.add_argument(
+        '--quarantine',
+        type=Path,
+        metavar='DIR',
+        help=('Move the unpacked files of downloads failing verification to DIR/COMPONENT '
+              'instead of deleting them.'))
+    _add_unpack_args(fetch_unpack_parser)
+    fetch_unpack_parser.set_defaults(callback=_fetch_unpack_callback)
+
     args = parser.parse_args()
     args.callback(args)
 
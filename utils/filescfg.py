@@ -17,6 +17,7 @@ import zipfile
 from pathlib import Path
 
 from _common import get_logger, add_common_params
+from _zstdtar import is_zstd_archive, open_zstd_tar
 
 
 def filescfg_generator(cfg_path, build_outputs, cpu_arch, excluded_files=None):
@@ -106,7 +107,10 @@ def _get_archive_writer(output_path, timestamp=None):
             tarinfo_class = TarInfoFixedTimestamp
         else:
             tarinfo_class = tarfile.TarInfo
-        output_archive = tarfile.open(str(output_path), tar_mode, tarinfo=tarinfo_class)
+        if is_zstd_archive(output_path.name):
+            output_archive = open_zstd_tar(output_path, 'w', tarinfo=tarinfo_class)
+        else:
+            output_archive = tarfile.open(str(output_path), tar_mode, tarinfo=tarinfo_class)
         add_func = lambda in_path, arc_path: output_archive.add(str(in_path), str(arc_path))
     else:
         raise ValueError('Unknown archive extension with name: %s' % output_path.name)
@@ -199,7 +203,7 @@ def main():
         required=True,
         help=('The output path for the archive. The type of archive is selected'
               ' by the file extension. Currently supported types: .zip and'
-              ' .tar.{gz,bz2,xz}'))
+              ' .tar.{gz,bz2,xz,zst}'))
     archive_parser.add_argument(
         '-i',
         '--include',
@@ -10,9 +10,17 @@ import argparse
 import os
 import shutil
 import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from _common import get_logger, parse_series, add_common_params
+from _common import ENCODING, get_logger, parse_series, add_common_params
+from _patch_bundle import PatchBundle, is_bundle, write_bundle
+from _patch_state import STATE_DIR, AppliedState, PatchStateError, hash_file
+from _patching import (PatchApplicationError, apply_patches_in_process, get_patched_paths,
+                       group_patches, refresh_patches_in_process)
+from _worktree import break_link
 
 
 def _find_patch_from_env():
@@ -103,7 +111,58 @@ def dry_run_check(patch_path, tree_path, patch_bin_path=None):
     return result.returncode, result.stdout, result.stderr
 
 
-def apply_patches(patch_path_iter, tree_path, reverse=False, patch_bin_path=None):
+def _break_patched_links(patch_path, tree_path):
+    """Breaks links of files in tree_path modified by patch_path, so patch copies on write"""
+    for relative_path in set(get_patched_paths(patch_path)):
+        file_path = tree_path / relative_path
+        if file_path.is_file():
+            break_link(file_path)
+
+
+def _apply_chain_with_gnu_patch(chain, patch_count, tree_path, reverse, patch_bin_path,
+                                capture_output):
+    """Applies a chain of (patch number, pathlib.Path) with GNU patch, logging their timings"""
+    logger = get_logger()
+    for patch_num, patch_path in chain:
+        # The patch is read from stdin, so patches in bundles do not need to be extracted
+        cmd = [
+            str(patch_bin_path), '-p1', '--ignore-whitespace', '-d',
+            str(tree_path), '--no-backup-if-mismatch'
+        ]
+        if reverse:
+            cmd.append('--reverse')
+            log_word = 'Reversed'
+        else:
+            cmd.append('--forward')
+            log_word = 'Applied'
+        logger.debug(' '.join(cmd))
+        start_time = time.perf_counter()
+        _break_patched_links(patch_path, tree_path)
+        if capture_output:
+            # Keep the output of concurrent patches together
+            result = subprocess.run(cmd,
+                                    input=patch_path.read_bytes(),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    check=False)
+            if result.stdout:
+                logger.info('%s:\n%s', patch_path.name,
+                            result.stdout.decode(ENCODING, 'replace').rstrip())
+        else:
+            result = subprocess.run(cmd, input=patch_path.read_bytes(), check=False)
+        if result.returncode:
+            logger.error('* Failed to apply %s (%s/%s)', patch_path.name, patch_num, patch_count)
+            raise subprocess.CalledProcessError(result.returncode, cmd)
+        logger.info('* %s %s (%s/%s) in %.3fs', log_word, patch_path.name, patch_num, patch_count,
+                    time.perf_counter() - start_time)
+
+
+def apply_patches(patch_path_iter,
+                  tree_path,
+                  reverse=False,
+                  patch_bin_path=None,
+                  in_process=True,
+                  jobs=1):
     """
     Applies or reverses a list of patches
 
@@ -112,34 +171,58 @@ def apply_patches(patch_path_iter, tree_path, reverse=False, patch_bin_path=None
     reverse is whether the patches should be reversed
     patch_bin_path is the pathlib.Path of the patch binary, or None to find it automatically
         See find_and_check_patch() for logic to find "patch"
+    in_process is whether to try applying the patches in-process before using GNU patch.
+        Patches are only applied with GNU patch if they cannot be applied in-process,
+        e.g. if they need fuzz.
+    jobs is the number of chains of patches to apply concurrently. Patches modifying common
+        files are chained in series order, so the result is the same as applying them serially.
+
+    Files modified by the patches are first replaced with copies if they are hardlinks,
+    e.g. of a pristine tree.
 
     Raises ValueError if the patch binary could not be found.
     """
     patch_paths = list(patch_path_iter)
-    patch_bin_path = find_and_check_patch(patch_bin_path=patch_bin_path)
     if reverse:
         patch_paths.reverse()
 
     logger = get_logger()
-    for patch_path, patch_num in zip(patch_paths, range(1, len(patch_paths) + 1)):
-        cmd = [
-            str(patch_bin_path), '-p1', '--ignore-whitespace', '-i',
-            str(patch_path), '-d',
-            str(tree_path), '--no-backup-if-mismatch'
+    if in_process:
+        try:
+            apply_patches_in_process(patch_paths, tree_path, reverse=reverse, jobs=jobs)
+            return
+        except PatchApplicationError as exc:
+            logger.warning('Could not apply patches in-process (%s); using GNU patch', exc)
+
+    patch_bin_path = find_and_check_patch(patch_bin_path=patch_bin_path)
+    numbered_paths = list(enumerate(patch_paths, start=1))
+    if jobs > 1:
+        chains = [[numbered_paths[x] for x in chain] for chain in group_patches(patch_paths)]
+        logger.info('Applying %s patches in %s independent chains', len(patch_paths), len(chains))
+    else:
+        chains = [numbered_paths]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(_apply_chain_with_gnu_patch, chain, len(patch_paths), tree_path,
+                            reverse, patch_bin_path, jobs > 1) for chain in chains
         ]
-        if reverse:
-            cmd.append('--reverse')
-            log_word = 'Reversing'
-        else:
-            cmd.append('--forward')
-            log_word = 'Applying'
-        logger.info('* %s %s (%s/%s)', log_word, patch_path.name, patch_num, len(patch_paths))
-        logger.debug(' '.join(cmd))
-        subprocess.run(cmd, check=True)
+        for future in futures:
+            future.result()
 
 
 def generate_patches_from_series(patches_dir, resolve=False):
-    """Generates pathlib.Path for patches from a directory in GNU Quilt format"""
+    """
+    Generates the patches from a directory in GNU Quilt format, or a patch bundle
+
+    If resolve is False, the names of the patches in the series are generated as pathlib.Path.
+    Otherwise, the resolved pathlib.Path to each patch, or the BundledPatch of each patch
+    of a bundle, is generated.
+    """
+    if is_bundle(patches_dir):
+        bundle = PatchBundle(patches_dir)
+        for name in bundle.series:
+            yield bundle.get_patch(name) if resolve else Path(name)
+        return
     for patch_path in parse_series(patches_dir / 'series'):
         if resolve:
             yield (patches_dir / patch_path).resolve()
@@ -147,31 +230,155 @@ def generate_patches_from_series(patches_dir, resolve=False):
             yield patch_path
 
 
+def _check_unmodified(state):
+    """Raises PatchStateError if files modified by applied patches were changed since"""
+    modified_files = state.get_modified_files()
+    if modified_files:
+        raise PatchStateError('Files were modified since the patches were applied: {}'.format(
+            ', '.join(modified_files)))
+
+
+def _get_unchanged_count(state, series_names, patches_dir):
+    """Returns the number of applied patches matching the start of the series"""
+    for index, entry in enumerate(state.entries):
+        if (index >= len(series_names) or entry['name'] != series_names[index]
+                or entry['sha256'] != hash_file(patches_dir / entry['name'])):
+            return index
+    return len(state.entries)
+
+
+def pop_patches(tree_path, count, force=False, patch_bin_path=None, in_process=True):
+    """
+    Reverses the last count patches applied by push_patches() to tree_path
+
+    The copies of the patches made when they were applied are reversed, so patches can be
+    popped after editing them. force is whether to pop patches even if files they modified
+    were changed since. patch_bin_path and in_process are like in apply_patches().
+
+    Raises PatchStateError if files were changed since the patches were applied.
+    """
+    state = AppliedState(tree_path)
+    if not force:
+        _check_unmodified(state)
+    count = min(count, len(state.entries))
+    if count:
+        apply_patches([state.get_patch_copy(x['name']) for x in state.entries[-count:]],
+                      tree_path,
+                      reverse=True,
+                      patch_bin_path=patch_bin_path,
+                      in_process=in_process)
+        state.pop(count)
+
+
+def push_patches(patches_dir, tree_path, count, force=False, patch_bin_path=None, in_process=True):
+    """
+    Makes the first count patches of the series in patches_dir the patches applied to tree_path
+
+    Only the difference to the applied state of the tree is applied: applied patches after
+    count are reversed, and the missing ones are applied and recorded one at a time. Applied
+    patches that were edited or reordered since are reversed and applied again, along with
+    the patches after them. force and the other arguments are like in pop_patches().
+
+    Returns the number of patches reversed and the number of patches applied.
+    Raises PatchStateError if files were changed since the patches were applied.
+    """
+    series_names = list(generate_patches_from_series(patches_dir))
+    state = AppliedState(tree_path)
+    if not force:
+        _check_unmodified(state)
+    keep_count = min(_get_unchanged_count(state, series_names, patches_dir), count)
+    pop_count = len(state.entries) - keep_count
+    pop_patches(tree_path, pop_count, True, patch_bin_path, in_process)
+    state = AppliedState(tree_path)
+    for name in series_names[keep_count:count]:
+        patch_path = (patches_dir / name).resolve()
+        apply_patches([patch_path], tree_path, patch_bin_path=patch_bin_path, in_process=in_process)
+        state.push(name, patch_path, set(get_patched_paths(patch_path)))
+    return pop_count, max(count - keep_count, 0)
+
+
+def refresh_patches(patches_dir, tree_path):
+    """
+    Refreshes the patches of a series against an unmodified source tree
+
+    patches_dir is the pathlib.Path of the patches directory or patch bundle
+    tree_path is the pathlib.Path of the source tree. It is only read.
+
+    Patches are applied in memory in series order, and rewritten with 3 lines of context
+    and a/ and b/ prefixes. Patches that no longer apply must be resolved by hand, e.g. with
+    push; the patches before them are still refreshed.
+
+    Returns the number of patches rewritten.
+    Raises PatchStateError if patches are applied to the tree.
+    Raises PatchApplicationError for the first patch that does not apply.
+    """
+    if AppliedState(tree_path).entries:
+        raise PatchStateError('Patches are applied to {}; pop them first'.format(tree_path))
+    bundle = PatchBundle(patches_dir) if is_bundle(patches_dir) else None
+    patch_paths = list(generate_patches_from_series(patches_dir, resolve=True))
+    refreshed_data = {}
+    try:
+        for patch_path, patch_data in refresh_patches_in_process(patch_paths, tree_path):
+            if patch_data == patch_path.read_bytes():
+                continue
+            get_logger().info('* Refreshed %s', patch_path.name)
+            if bundle:
+                refreshed_data[patch_path.series_name] = patch_data
+            else:
+                patch_path.write_bytes(patch_data)
+                refreshed_data[patch_path] = patch_data
+    finally:
+        if bundle and refreshed_data:
+            patch_data = {name: bundle.read_patch(name) for name in bundle.series}
+            patch_data.update(refreshed_data)
+            write_bundle(patches_dir, bundle.series, patch_data)
+    return len(refreshed_data)
+
+
 def _copy_files(path_iter, source, destination):
     """Copy files from source to destination with relative paths from path_iter"""
+    bundle = PatchBundle(source) if is_bundle(source) else None
     for path in path_iter:
         (destination / path).parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(str(source / path), str(destination / path))
+        if bundle:
+            (destination / path).write_bytes(bundle.read_patch(str(path)))
+        else:
+            shutil.copy2(str(source / path), str(destination / path))
 
 
-def merge_patches(source_iter, destination, prepend=False):
+def _read_patches(patches_dir):
+    """Returns a dict of the series names of the patches in patches_dir to their data"""
+    return {
+        str(name): patch.read_bytes()
+        for name, patch in zip(generate_patches_from_series(patches_dir),
+                               generate_patches_from_series(patches_dir, resolve=True))
+    }
+
+
+def merge_patches(source_iter, destination, prepend=False, bundle=False):
     """
-    Merges GNU quilt-formatted patches directories from sources into destination
+    Merges GNU quilt-formatted patches directories or patch bundles from sources
+    into destination
 
     destination must not already exist, unless prepend is True. If prepend is True, then
     the source patches will be prepended to the destination.
+    If bundle is True, destination is a patch bundle instead of a directory.
     """
     series = []
     known_paths = set()
     if destination.exists():
         if prepend:
-            if not (destination / 'series').exists():
+            if bundle != is_bundle(destination):
+                raise FileExistsError('destination is not a patch {}: {}'.format(
+                    'bundle' if bundle else 'directory', destination))
+            if not bundle and not (destination / 'series').exists():
                 raise FileNotFoundError(
                     'Could not find series file in existing destination: {}'.format(destination /
                                                                                     'series'))
             known_paths.update(generate_patches_from_series(destination))
         else:
             raise FileExistsError('destination already exists: {}'.format(destination))
+    patch_data = {}
     for source_dir in source_iter:
         patch_paths = tuple(generate_patches_from_series(source_dir))
         patch_intersection = known_paths.intersection(patch_paths)
@@ -180,34 +387,144 @@ def merge_patches(source_iter, destination, prepend=False):
                 'Patches from {} have conflicting paths with other sources: {}'.format(
                     source_dir, patch_intersection))
         series.extend(patch_paths)
-        _copy_files(patch_paths, source_dir, destination)
+        if bundle:
+            patch_data.update(_read_patches(source_dir))
+        else:
+            _copy_files(patch_paths, source_dir, destination)
+    if bundle:
+        if prepend and destination.exists():
+            series.extend(generate_patches_from_series(destination))
+            patch_data.update(_read_patches(destination))
+        write_bundle(destination, [str(x) for x in series], patch_data)
+        return
     if prepend and (destination / 'series').exists():
         series.extend(generate_patches_from_series(destination))
     with (destination / 'series').open('w') as series_file:
         series_file.write('\n'.join(map(str, series)))
 
 
+def _get_patch_bin_path(args, parser_error):
+    if args.patch_bin is None:
+        return None
+    patch_bin_path = Path(args.patch_bin)
+    if not patch_bin_path.exists():
+        patch_bin_path = shutil.which(args.patch_bin)
+        if patch_bin_path:
+            patch_bin_path = Path(patch_bin_path)
+        else:
+            parser_error(f'--patch-bin "{args.patch_bin}" is not a command or path to executable.')
+    return patch_bin_path
+
+
 def _apply_callback(args, parser_error):
     logger = get_logger()
-    patch_bin_path = None
-    if args.patch_bin is not None:
-        patch_bin_path = Path(args.patch_bin)
-        if not patch_bin_path.exists():
-            patch_bin_path = shutil.which(args.patch_bin)
-            if patch_bin_path:
-                patch_bin_path = Path(patch_bin_path)
-            else:
-                parser_error(
-                    f'--patch-bin "{args.patch_bin}" is not a command or path to executable.')
+    patch_bin_path = _get_patch_bin_path(args, parser_error)
     for patch_dir in args.patches:
         logger.info('Applying patches from %s', patch_dir)
         apply_patches(generate_patches_from_series(patch_dir, resolve=True),
                       args.target,
-                      patch_bin_path=patch_bin_path)
+                      patch_bin_path=patch_bin_path,
+                      in_process=not args.gnu_patch,
+                      jobs=args.jobs)
+
+
+def _log_top_patch(tree_path):
+    entries = AppliedState(tree_path).entries
+    if entries:
+        get_logger().info('Now at patch %s (%s applied)', entries[-1]['name'], len(entries))
+    else:
+        get_logger().info('No patches applied')
+
+
+def _push_callback(args, parser_error):
+    if is_bundle(args.patches):
+        parser_error('Patch bundles cannot be pushed; use a patches directory instead')
+    series_names = list(generate_patches_from_series(args.patches))
+    try:
+        if args.all:
+            count = len(series_names)
+        elif args.name:
+            if args.name not in series_names:
+                parser_error('Patch is not in the series: {}'.format(args.name))
+            count = series_names.index(args.name) + 1
+        else:
+            count = len(AppliedState(args.target).entries) + 1
+            if count > len(series_names):
+                parser_error('All patches are applied')
+        if not args.goto:
+            # Only goto reverses patches after the given one
+            count = max(count, len(AppliedState(args.target).entries))
+        popped, pushed = push_patches(args.patches, args.target, count, args.force,
+                                      _get_patch_bin_path(args, parser_error), not args.gnu_patch)
+    except PatchStateError as exc:
+        get_logger().error('%s', exc)
+        sys.exit(1)
+    get_logger().info('Reversed %s and applied %s patches', popped, pushed)
+    _log_top_patch(args.target)
+
+
+def _pop_callback(args, parser_error):
+    try:
+        applied_names = [x['name'] for x in AppliedState(args.target).entries]
+        if not applied_names:
+            parser_error('No patches are applied')
+        if args.all:
+            count = len(applied_names)
+        elif args.name:
+            if args.name not in applied_names:
+                parser_error('Patch is not applied: {}'.format(args.name))
+            count = len(applied_names) - applied_names.index(args.name) - 1
+        else:
+            count = 1
+        pop_patches(args.target, count, args.force, _get_patch_bin_path(args, parser_error),
+                    not args.gnu_patch)
+    except PatchStateError as exc:
+        get_logger().error('%s', exc)
+        sys.exit(1)
+    _log_top_patch(args.target)
+
+
+def _refresh_callback(args, _):
+    try:
+        count = refresh_patches(args.patches, args.target)
+    except PatchStateError as exc:
+        get_logger().error('%s', exc)
+        sys.exit(1)
+    except PatchApplicationError as exc:
+        get_logger().error('%s', exc)
+        get_logger().error('The patches before it were refreshed. Resolve it with push, '
+                           'then refresh again.')
+        sys.exit(1)
+    get_logger().info('Refreshed %s patches', count)
 
 
 def _merge_callback(args, _):
-    merge_patches(args.source, args.destination, args.prepend)
+    merge_patches(args.source, args.destination, args.prepend, args.bundle)
+
+
+def _bundle_callback(args, _):
+    merge_patches([args.patches], args.output, bundle=True)
+    get_logger().info('Bundled %s patches into %s', len(PatchBundle(args.output).series),
+                      args.output)
+
+
+def _add_patch_bin_params(parser):
+    parser.add_argument('--patch-bin',
+                        help='The GNU patch command to use. Omit to find it automatically.')
+    parser.add_argument(
+        '--gnu-patch',
+        action='store_true',
+        help=('Apply patches with GNU patch only. By default, patches are applied in-process, '
+              'and GNU patch is only used if they need fuzz or are not plain unified diffs.'))
+
+
+def _add_state_params(parser):
+    _add_patch_bin_params(parser)
+    parser.add_argument('-f',
+                        '--force',
+                        action='store_true',
+                        help=('Proceed even if files modified by the applied patches were '
+                              'changed since they were applied.'))
 
 
 def main():
@@ -218,16 +535,80 @@ def main():
 
     apply_parser = subparsers.add_parser(
         'apply', help='Applies patches (in GNU Quilt format) to the specified source tree')
-    apply_parser.add_argument('--patch-bin',
-                              help='The GNU patch command to use. Omit to find it automatically.')
+    _add_patch_bin_params(apply_parser)
+    apply_parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        metavar='NUM',
+        help=('The number of independent chains of patches to apply concurrently. Patches '
+              'modifying common files are applied in series order. Default: %(default)s'))
     apply_parser.add_argument('target', type=Path, help='The directory tree to apply patches onto.')
     apply_parser.add_argument(
         'patches',
         type=Path,
         nargs='+',
-        help='The directories containing patches to apply. They must be in GNU quilt format')
+        help=('The directories containing patches to apply. They must be in GNU quilt format, '
+              'or patch bundles'))
     apply_parser.set_defaults(callback=_apply_callback)
 
+    push_parser = subparsers.add_parser(
+        'push',
+        help='Applies the next patches of a series, recording them in the applied state',
+        description=('Applies patches of a series up to the given patch, or the next patch. '
+                     'The applied patches and the hashes of the files they modified are '
+                     'recorded in the {} directory of the tree. Applied patches that were '
+                     'edited since are reversed and applied again, with the patches after '
+                     'them.').format(STATE_DIR))
+    _add_state_params(push_parser)
+    push_parser.add_argument('-a', '--all', action='store_true', help='Apply all patches.')
+    push_parser.add_argument('target', type=Path, help='The directory tree to apply patches onto.')
+    push_parser.add_argument('patches',
+                             type=Path,
+                             help='The directory containing patches in GNU quilt format.')
+    push_parser.add_argument('name',
+                             nargs='?',
+                             help='The last patch to apply, as listed in the series file.')
+    push_parser.set_defaults(callback=_push_callback, goto=False)
+
+    pop_parser = subparsers.add_parser(
+        'pop',
+        help='Reverses the last applied patches',
+        description=('Reverses applied patches until the given patch is the last applied, '
+                     'or the last applied patch.'))
+    _add_state_params(pop_parser)
+    pop_parser.add_argument('-a', '--all', action='store_true', help='Reverse all patches.')
+    pop_parser.add_argument('target', type=Path, help='The directory tree to reverse patches of.')
+    pop_parser.add_argument('name', nargs='?', help='The patch to keep as the last applied.')
+    pop_parser.set_defaults(callback=_pop_callback)
+
+    goto_parser = subparsers.add_parser(
+        'goto',
+        help='Applies or reverses patches until the given patch is the last applied',
+        description='Like push, but also reverses patches after the given patch.')
+    _add_state_params(goto_parser)
+    goto_parser.add_argument('target', type=Path, help='The directory tree to patch.')
+    goto_parser.add_argument('patches',
+                             type=Path,
+                             help='The directory containing patches in GNU quilt format.')
+    goto_parser.add_argument('name', help='The patch to make the last applied.')
+    goto_parser.set_defaults(callback=_push_callback, goto=True, all=False)
+
+    refresh_parser = subparsers.add_parser(
+        'refresh',
+        help='Regenerates the patches of a series against a source tree',
+        description=('Applies the patches of a series in memory, finding hunks that moved by '
+                     'their context, and rewrites the patches that changed with 3 lines of '
+                     'context and a/ and b/ prefixes. Stops at the first patch that does not '
+                     'apply. The source tree is not modified.'))
+    refresh_parser.add_argument('target', type=Path, help='The unmodified source tree.')
+    refresh_parser.add_argument(
+        'patches',
+        type=Path,
+        help='The directory containing patches in GNU quilt format, or a patch bundle.')
+    refresh_parser.set_defaults(callback=_refresh_callback)
+
     merge_parser = subparsers.add_parser('merge',
                                          help='Merges patches directories in GNU quilt format')
     merge_parser.add_argument(
@@ -244,12 +625,27 @@ def main():
     merge_parser.add_argument('source',
                               type=Path,
                               nargs='+',
-                              help='The GNU quilt patches to merge.')
+                              help='The GNU quilt patches or patch bundles to merge.')
+    merge_parser.add_argument('--bundle',
+                              action='store_true',
+                              help='Write the merged patches to a patch bundle file.')
     merge_parser.set_defaults(callback=_merge_callback)
 
+    bundle_parser = subparsers.add_parser(
+        'bundle',
+        help='Packs a series and its patches into a patch bundle',
+        description=('Packs a series and its patches into a single file, with a header '
+                     'indexing the patches and the files they modify. Bundles can be used '
+                     'in place of patches directories by apply and merge, and by devutils.'))
+    bundle_parser.add_argument('patches',
+                               type=Path,
+                               help='The directory containing patches in GNU quilt format.')
+    bundle_parser.add_argument('output', type=Path, help='The patch bundle file to write.')
+    bundle_parser.set_defaults(callback=_bundle_callback)
+
     args = parser.parse_args()
     if 'callback' not in args:
-        parser.error('Must specify subcommand apply or merge')
+        parser.error('Must specify subcommand apply, push, pop, goto, refresh, merge or bundle')
     args.callback(args, parser.error)
 
 
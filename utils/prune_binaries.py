@@ -7,13 +7,17 @@
 """Prune binaries from the source tree"""
 
 import argparse
+import collections
 import itertools
 import sys
 import os
 import stat
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from _common import ENCODING, get_logger, add_common_params
+from _worktree import break_link
 
 # List of paths to prune if they exist, excluded from domain_substitution and pruning lists
 # These allow the lists to be compatible between cloned and tarball sources
@@ -53,6 +57,86 @@ CONTINGENT_PATHS = (
     'tools/perf/page_sets/maps_perf_test/dataset/',
 )
 
+# pathlib.Path.match() paths to exclude from binary pruning
+# Used by devutils/update_lists.py and the audit of pruned source trees
+PRUNING_EXCLUDE_PATTERNS = [
+    'chrome/common/win/eventlog_messages.mc', # TODO: False positive textfile
+    # Exclusions for DOM distiller (contains model data only)
+    'components/dom_distiller/core/data/distillable_page_model_new.bin',
+    'components/dom_distiller/core/data/long_page_model.bin',
+    # Exclusions for GeoLanguage data
+    # Details: https://docs.google.com/document/d/18WqVHz5F9vaUiE32E8Ge6QHmku2QSJKvlqB9JjnIM-g/edit
+    # Introduced with: https://chromium.googlesource.com/chromium/src/+/6647da61
+    'components/language/content/browser/ulp_language_code_locator/geolanguage-data_rank0.bin',
+    'components/language/content/browser/ulp_language_code_locator/geolanguage-data_rank1.bin',
+    'components/language/content/browser/ulp_language_code_locator/geolanguage-data_rank2.bin',
+    # Exclusion for required prebuilt object for Windows arm64 builds
+    'third_party/crashpad/crashpad/util/misc/capture_context_win_arm64.obj',
+    'third_party/icu/common/icudtl.dat', # Exclusion for ICU data
+    # Exclusion for Android
+    'build/android/chromium-debug.keystore',
+    'third_party/icu/android/icudtl.dat',
+    'third_party/icu/common/icudtb.dat',
+    # Exclusion for rollup v4.0+
+    'third_party/node/node_modules/@rollup/wasm-node/dist/wasm-node/bindings_wasm_bg.wasm',
+    # Exclusion for performance tracing
+    'third_party/perfetto/src/trace_processor/importers/proto/atoms.descriptor',
+    # Exclusions for safe file extensions
+    '*.avif',
+    '*.ttf',
+    '*.png',
+    '*.jpg',
+    '*.webp',
+    '*.gif',
+    '*.ico',
+    '*.mp3',
+    '*.wav',
+    '*.flac',
+    '*.icns',
+    '*.woff',
+    '*.woff2',
+    '*makefile',
+    '*.profdata',
+    '*.xcf',
+    '*.cur',
+    '*.pdf',
+    '*.ai',
+    '*.h',
+    '*.c',
+    '*.cpp',
+    '*.cc',
+    '*.mk',
+    '*.bmp',
+    '*.py',
+    '*.xml',
+    '*.html',
+    '*.js',
+    '*.json',
+    '*.txt',
+    '*.xtb'
+]
+
+# Magic numbers of executables, shared objects, object files and archives
+_BINARY_SIGNATURES = (
+    (b'\x7fELF', 'ELF'),
+    (b'\xfe\xed\xfa\xce', 'Mach-O'),
+    (b'\xce\xfa\xed\xfe', 'Mach-O'),
+    (b'\xfe\xed\xfa\xcf', 'Mach-O'),
+    (b'\xcf\xfa\xed\xfe', 'Mach-O'),
+    (b'\xca\xfe\xba\xbe', 'Mach-O universal or Java class'),
+    (b'!<arch>\n', 'ar'),
+    (b'\x00asm', 'wasm'),
+    (b'PK\x03\x04', 'jar/zip'),
+)
+# PE files start with a DOS header, whose e_lfanew field is the offset of the PE signature
+_DOS_MAGIC = b'MZ'
+_DOS_HEADER = struct.Struct('<60xI')
+_PE_SIGNATURE = b'PE\0\0'
+_SIGNATURE_SIZE = max(_DOS_HEADER.size, *(len(magic) for magic, _ in _BINARY_SIGNATURES))
+
+# Directory names that are never audited
+_AUDIT_SKIP_DIRS = ('.git', '__pycache__', 'uc_staging')
+
 
 def prune_files(unpack_root, prune_list):
     """
@@ -67,9 +151,9 @@ def prune_files(unpack_root, prune_list):
         try:
             file_path.unlink()
         # read-only files can't be deleted on Windows
-        # so remove the flag and try again.
+        # so remove the flag and try again. Hardlinks share the flag, so break them first.
         except PermissionError:
-            os.chmod(file_path, stat.S_IWRITE)
+            break_link(file_path)
             file_path.unlink()
         except FileNotFoundError:
             unremovable_files.add(Path(relative_file).as_posix())
@@ -119,6 +203,99 @@ def prune_dirs(unpack_root, keep_contingent_paths, sysroot):
             _prune_path(unpack_root / cpath)
 
 
+def _sniff_binary_format(path):
+    """
+    Returns the name of the binary format detected from the first bytes of path,
+    or None if the header does not match any known format.
+
+    path is a string path to the file to check.
+    """
+    try:
+        with open(path, 'rb') as file_obj:
+            header = file_obj.read(_SIGNATURE_SIZE)
+            if header.startswith(_DOS_MAGIC) and len(header) >= _DOS_HEADER.size:
+                pe_offset, = _DOS_HEADER.unpack_from(header)
+                file_obj.seek(pe_offset)
+                if file_obj.read(len(_PE_SIGNATURE)) == _PE_SIGNATURE:
+                    return 'PE'
+    except OSError:
+        get_logger().exception('Could not read file header: %s', path)
+        return None
+    for magic, format_name in _BINARY_SIGNATURES:
+        if header.startswith(magic):
+            return format_name
+    return None
+
+
+def _is_audit_excluded(relative_posix):
+    """Returns True if the POSIX relative path is exempt from the audit; False otherwise"""
+    if any(relative_posix.startswith(cpath) for cpath in CONTINGENT_PATHS):
+        return True
+    lowered_path = Path(relative_posix.lower())
+    return any(map(lowered_path.match, PRUNING_EXCLUDE_PATTERNS))
+
+
+def _audit_file_generator(unpack_root):
+    """
+    Generator of (path, relative POSIX path) for the regular files to audit under unpack_root
+    """
+    for dirpath, dirnames, filenames in os.walk(str(unpack_root)):
+        dirnames[:] = [name for name in dirnames if name not in _AUDIT_SKIP_DIRS]
+        relative_dir = Path(dirpath).relative_to(unpack_root).as_posix()
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if os.path.islink(path):
+                continue
+            if relative_dir == '.':
+                relative_posix = filename
+            else:
+                relative_posix = '{}/{}'.format(relative_dir, filename)
+            if _is_audit_excluded(relative_posix):
+                continue
+            yield path, relative_posix
+
+
+def audit_files(unpack_root, jobs=None):
+    """
+    Detect executables, shared objects, object files and archives under unpack_root
+    by their magic numbers. Only the header of each file is read.
+
+    unpack_root is a pathlib.Path to the directory to audit
+    jobs is the number of threads reading file headers, or None for the default
+
+    Returns a sorted list of (relative POSIX path, format name) tuples.
+    """
+    paths, relative_paths = [], []
+    for path, relative_posix in _audit_file_generator(unpack_root):
+        paths.append(path)
+        relative_paths.append(relative_posix)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        formats = executor.map(_sniff_binary_format, paths)
+        return sorted((relative_posix, format_name)
+                      for relative_posix, format_name in zip(relative_paths, formats)
+                      if format_name)
+
+
+def _audit_callback(args):
+    if not args.directory.exists():
+        get_logger().error('Specified directory does not exist: %s', args.directory)
+        sys.exit(1)
+    found_binaries = audit_files(args.directory, args.jobs)
+    if args.report:
+        with args.report.open('w', encoding=ENCODING) as report_file:
+            report_file.writelines('{}\t{}\n'.format(*entry) for entry in found_binaries)
+    if found_binaries:
+        for relative_posix, format_name in found_binaries:
+            get_logger().warning('%s: %s', format_name, relative_posix)
+        format_counts = collections.Counter(format_name for _, format_name in found_binaries)
+        get_logger().error(
+            '%d binary files found after pruning (%s)', len(found_binaries),
+            ', '.join('{}: {}'.format(name, count)
+                      for name, count in sorted(format_counts.items())))
+        sys.exit(1)
+    get_logger().info('No binary files found')
+
+
 def _callback(args):
     if not args.directory.exists():
         get_logger().error('Specified directory does not exist: %s', args.directory)
@@ -141,8 +318,13 @@ def _callback(args):
 def main():
     """CLI Entrypoint"""
     parser = argparse.ArgumentParser()
-    parser.add_argument('directory', type=Path, help='The directory to apply binary pruning.')
-    parser.add_argument('pruning_list', type=Path, help='Path to pruning.list')
+    parser.add_argument('directory',
+                        type=Path,
+                        help='The directory to apply binary pruning, or to audit with --audit.')
+    parser.add_argument('pruning_list',
+                        type=Path,
+                        nargs='?',
+                        help='Path to pruning.list. Required unless --audit is used.')
     parser.add_argument('--keep-contingent-paths',
                         action='store_true',
                         help=('Skip pruning the contingent paths. '
@@ -151,11 +333,36 @@ def main():
                         choices=('amd64', 'i386'),
                         help=('Skip pruning the sysroot for the specified architecture. '
                               'Not needed when --keep-contingent-paths is used.'))
+    parser.add_argument('--audit',
+                        action='store_true',
+                        help=('Instead of pruning, audit the pruned directory for executables, '
+                              'shared objects, object files and archives by reading only the '
+                              'first bytes of each file. Exits with status 1 if any are found.'))
+    parser.add_argument('--report',
+                        type=Path,
+                        metavar='PATH',
+                        help=('With --audit, write a tab-separated report of the files found '
+                              'to PATH.'))
+    parser.add_argument('--jobs',
+                        '-j',
+                        type=int,
+                        metavar='NUM',
+                        help=('With --audit, the number of threads to read file headers with. '
+                              'Default: Python\'s default'))
     add_common_params(parser)
-    parser.set_defaults(callback=_callback)
 
     args = parser.parse_args()
-    args.callback(args)
+    if args.audit:
+        if args.pruning_list or args.keep_contingent_paths or args.sysroot:
+            parser.error('pruning_list, --keep-contingent-paths and --sysroot cannot be used '
+                         'with --audit')
+        _audit_callback(args)
+    else:
+        if args.pruning_list is None:
+            parser.error('the following arguments are required: pruning_list')
+        if args.report or args.jobs:
+            parser.error('--report and --jobs can only be used with --audit')
+        _callback(args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import io
+import lzma
+import os
+import tarfile
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from .. import _xz, archive_index
+
+
+def _make_tar_data():
+    """Returns the data of a tar archive of a source tree and a dict of its files"""
+    files = {
+        'chrome/app/main.cc': b'int main() {}\n',
+        'third_party/big.bin': os.urandom(200000),
+        'empty.txt': b'',
+    }
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar_file:
+        for name, data in files.items():
+            tarinfo = tarfile.TarInfo('chromium-1.0/' + name)
+            tarinfo.size = len(data)
+            tar_file.addfile(tarinfo, io.BytesIO(data))
+        tarinfo = tarfile.TarInfo('chromium-1.0/chrome/app/link.cc')
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = 'main.cc'
+        tar_file.addfile(tarinfo)
+        tarinfo = tarfile.TarInfo('chromium-1.0/hardlink.bin')
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = 'chromium-1.0/third_party/big.bin'
+        tar_file.addfile(tarinfo)
+        tarinfo = tarfile.TarInfo('chromium-1.0/dangling.cc')
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = 'missing.cc'
+        tar_file.addfile(tarinfo)
+    return archive.getvalue(), files
+
+
+def _write_multi_stream_xz(path, data, chunk_size, padding=False):
+    """Writes data as concatenated single-block xz streams of chunk_size bytes of data"""
+    with path.open('wb') as xz_file:
+        for offset in range(0, len(data), chunk_size):
+            xz_file.write(lzma.compress(data[offset:offset + chunk_size]))
+            if padding:
+                xz_file.write(b'\0' * 4)
+
+
+def test_xz_blocks():
+    data = os.urandom(50000) * 4
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        xz_path = Path(tmpdirname, 'data.xz')
+        _write_multi_stream_xz(xz_path, data, 30000, padding=True)
+        with xz_path.open('rb') as xz_file:
+            blocks = _xz.read_block_index(xz_file)
+            assert [block.uncompressed_offset for block in blocks] == list(range(0, 200000, 30000))
+            decompressed = b''.join(
+                _xz.decompress_block(block, _xz.read_block_data(xz_file, block))
+                for block in blocks)
+        assert decompressed == data
+
+        xz_path.write_bytes(b'not xz data')
+        with pytest.raises(ValueError), xz_path.open('rb') as xz_file:
+            _xz.read_block_index(xz_file)
+
+
+@pytest.mark.parametrize('archive_name', ['source.tar', 'source.tar.xz', 'single.tar.xz'])
+def test_archive_index(archive_name):
+    tar_data, files = _make_tar_data()
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, archive_name)
+        if archive_name == 'source.tar':
+            archive_path.write_bytes(tar_data)
+        elif archive_name == 'source.tar.xz':
+            _write_multi_stream_xz(archive_path, tar_data, 50000)
+        else:
+            archive_path.write_bytes(lzma.compress(tar_data))
+
+        index = archive_index.load_index(archive_path)
+        assert archive_index.get_index_path(archive_path).exists()
+        assert index.root == 'chromium-1.0'
+        assert 'chrome/app/main.cc' in index
+        assert 'chrome/app' in index
+        assert 'missing.cc' not in index
+        assert index.is_file('chrome/app/link.cc') and index.is_file('hardlink.bin')
+        assert not index.is_file('chrome/app')
+        assert not index.is_file('dangling.cc')
+        assert not index.is_file('missing.cc')
+
+        paths = ['third_party/big.bin', 'chrome/app/main.cc', 'empty.txt']
+        assert dict(index.read_members(paths)) == {path: files[path] for path in paths}
+        assert dict(index.read_members(['chrome/app/link.cc', 'hardlink.bin'])) == {
+            'chrome/app/link.cc': files['chrome/app/main.cc'],
+            'hardlink.bin': files['third_party/big.bin'],
+        }
+        with pytest.raises(KeyError):
+            list(index.read_members(['chrome/app']))
+
+        # The stored index is reused until the archive changes
+        assert len(archive_index.load_index(archive_path)) == len(index)
+        archive_index.get_index_path(archive_path).write_bytes(b'invalid')
+        assert 'empty.txt' in archive_index.load_index(archive_path)
@@ -5,9 +5,12 @@
 # found in the LICENSE file.
 
 import os
+import shutil
 import tempfile
 from pathlib import Path
 
+import pytest
+
 from .. import domain_substitution
 
 
@@ -34,3 +37,27 @@ def test_update_timestamp():
         new_stats: os.stat_result = path.stat()
         assert orig_stats.st_atime_ns == new_stats.st_atime_ns
         assert orig_stats.st_mtime_ns == new_stats.st_mtime_ns
+
+
+@pytest.mark.parametrize('cache_name', ['cache.tar.gz', 'cache.tar.zst'])
+def test_substitution_cache(cache_name):
+    if cache_name.endswith('.zst') and shutil.which('zstd') is None:
+        try:
+            from compression import zstd #pylint: disable=import-outside-toplevel,unused-import
+        except ImportError:
+            pytest.skip('zstd is not available')
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        source_tree = Path(tmpdirname, 'src')
+        source_tree.mkdir()
+        (source_tree / 'file.txt').write_text('https://www.google.com/\n')
+        regex_path = Path(tmpdirname, 'domain_regex.list')
+        regex_path.write_text('google\\.com#9oo91e.qjz9zk\n')
+        files_path = Path(tmpdirname, 'domain_substitution.list')
+        files_path.write_text('file.txt\n')
+        cache_path = Path(tmpdirname, cache_name)
+
+        domain_substitution.apply_substitution(regex_path, files_path, source_tree, cache_path)
+        assert (source_tree / 'file.txt').read_text() == 'https://www.9oo91e.qjz9zk/\n'
+        domain_substitution.revert_substitution(cache_path, source_tree)
+        assert (source_tree / 'file.txt').read_text() == 'https://www.google.com/\n'
+        assert not cache_path.exists()
@@ -0,0 +1,825 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from .. import _cache, _downloader, _metrics, _unpacking, downloads
+
+
+class _RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files of the server from memory with support for single byte ranges"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        pass
+
+    def _send_body(self, send_body):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        time.sleep(self.server.latency)
+        if self.path in self.server.redirects:
+            self.send_response(302)
+            self.send_header('Location', self.server.redirects[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        data = self.server.files[self.path]
+        range_match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if range_match and self.server.accept_ranges:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2) or len(data) - 1)
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = data[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, start + len(body) - 1, len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body and self.server.stall_after is not None and len(
+                body) > self.server.stall_after:
+            # Send part of the body, then stop sending data without closing the connection
+            self.wfile.write(body[:self.server.stall_after])
+            self.wfile.flush()
+            time.sleep(1)
+            self.close_connection = True
+        elif send_body:
+            self.wfile.write(body)
+
+    def do_GET(self): #pylint: disable=invalid-name
+        """Handle GET requests"""
+        self._send_body(True)
+
+    def do_HEAD(self): #pylint: disable=invalid-name
+        """Handle HEAD requests"""
+        self._send_body(False)
+
+
+@contextlib.contextmanager
+def _serve_files(files, redirects=None, accept_ranges=True, latency=0, stall_after=None):
+    """
+    Context manager yielding a local HTTP server and its base URL
+
+    latency is the number of seconds to wait before responding to each request.
+    stall_after is the number of bytes of response bodies to send before stalling, or None.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _RangeRequestHandler)
+    server.daemon_threads = True
+    server.files = files
+    server.redirects = redirects or {}
+    server.accept_ranges = accept_ranges
+    server.latency = latency
+    server.stall_after = stall_after
+    server.requests = []
+    server.connection_count = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, args=(0.01, ), daemon=True)
+    thread.start()
+    try:
+        yield server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_download_resume():
+    data = bytes(range(256)) * 4096
+    with _serve_files({'/file.bin': data}) as (server, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname, 'file.bin')
+        file_path.with_name('file.bin.partial').write_bytes(data[:1000])
+        connection_pool = downloads.HTTPConnectionPool()
+        downloads._download_if_needed(file_path, base_url + '/file.bin', None, connection_pool)
+        connection_pool.close()
+        assert file_path.read_bytes() == data
+        assert not file_path.with_name('file.bin.partial').exists()
+        assert server.requests == [('/file.bin', 'bytes=1000-')]
+
+
+def test_download_restarts_without_range_support():
+    data = b'0123456789' * 1000
+    with _serve_files({'/file.bin': data}, accept_ranges=False) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname, 'file.bin')
+        file_path.with_name('file.bin.partial').write_bytes(b'garbage')
+        connection_pool = downloads.HTTPConnectionPool()
+        downloads._download_if_needed(file_path, base_url + '/file.bin', None, connection_pool)
+        connection_pool.close()
+        assert file_path.read_bytes() == data
+
+
+def test_download_errors():
+    with _serve_files({}) as (_, base_url), tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname, 'missing.bin')
+        connection_pool = downloads.HTTPConnectionPool()
+        with pytest.raises(_downloader.urllib.error.HTTPError):
+            downloads._download_if_needed(file_path, base_url + '/missing.bin', None,
+                                          connection_pool)
+        connection_pool.close()
+        assert not file_path.exists()
+
+
+def test_connection_reuse():
+    files = {'/{}.bin'.format(index): bytes([index]) * 100 for index in range(5)}
+    redirects = {'/redirect.bin': '/0.bin'}
+    with _serve_files(files, redirects) as (server, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        connection_pool = downloads.HTTPConnectionPool()
+        for index in range(5):
+            downloads._download_if_needed(Path(tmpdirname, '{}.bin'.format(index)),
+                                          '{}/{}.bin'.format(base_url, index), None,
+                                          connection_pool)
+        downloads._download_if_needed(Path(tmpdirname, 'redirect.bin'),
+                                      base_url + '/redirect.bin', None, connection_pool)
+        connection_pool.close()
+        assert server.connection_count == 1
+        assert Path(tmpdirname, 'redirect.bin').read_bytes() == files['/0.bin']
+
+
+def _write_downloads_ini(ini_path, base_url, files):
+    """Writes a downloads.ini for files with each component in its own section"""
+    with ini_path.open('w') as ini_file:
+        for name, data in files.items():
+            ini_file.write('[{name}]\nurl = {url}/{name}.tar\ndownload_filename = {name}.tar\n'
+                           'sha256 = {sha256}\noutput_path = {name}\n\n'.format(
+                               name=name, url=base_url, sha256=hashlib.sha256(data).hexdigest()))
+
+
+def test_retrieve_downloads_concurrent():
+    files = {'component{}'.format(index): bytes([index]) * 200000 for index in range(4)}
+    served_files = {'/{}.tar'.format(name): data for name, data in files.items()}
+    with _serve_files(served_files) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        _write_downloads_ini(ini_path, base_url, files)
+        info = downloads.DownloadInfo([ini_path])
+        downloads.retrieve_downloads(info, cache_dir, None, False, jobs=3)
+        downloads.check_downloads(info, cache_dir, None)
+        for name, data in files.items():
+            assert (cache_dir / '{}.tar'.format(name)).read_bytes() == data
+
+
+def test_download_segmented():
+    data = bytes(range(256)) * 4000
+    with _serve_files({'/file.bin': data}) as (server, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname, 'file.bin')
+        connection_pool = downloads.HTTPConnectionPool()
+        downloads._download_if_needed(file_path,
+                                      base_url + '/file.bin',
+                                      None,
+                                      connection_pool,
+                                      segments=4)
+        connection_pool.close()
+        assert file_path.read_bytes() == data
+        assert not Path(tmpdirname, 'file.bin.partial.segments').exists()
+        assert sorted(server.requests[1:]) == [('/file.bin', 'bytes=0-255999'),
+                                               ('/file.bin', 'bytes=256000-511999'),
+                                               ('/file.bin', 'bytes=512000-767999'),
+                                               ('/file.bin', 'bytes=768000-1023999')]
+
+
+def test_download_segmented_resume():
+    data = bytes(range(256)) * 4000
+    with _serve_files({'/file.bin': data}) as (server, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname, 'file.bin')
+        tmp_file_path = Path(tmpdirname, 'file.bin.partial')
+        # Simulate an interrupted download with the first and third segments complete
+        segment_state = _downloader._SegmentState.create(
+            downloads.get_segments_sidecar(tmp_file_path), len(data), 4)
+        partial_data = bytearray(len(data))
+        for index in (0, 2):
+            start, end = segment_state.ranges[index]
+            partial_data[start:end + 1] = data[start:end + 1]
+            segment_state.completed.add(index)
+        tmp_file_path.write_bytes(partial_data)
+        segment_state.save()
+
+        connection_pool = downloads.HTTPConnectionPool()
+        downloads._download_if_needed(file_path, base_url + '/file.bin', None, connection_pool)
+        connection_pool.close()
+        assert file_path.read_bytes() == data
+        assert sorted(server.requests[1:]) == [('/file.bin', 'bytes=256000-511999'),
+                                               ('/file.bin', 'bytes=768000-1023999')]
+
+
+def test_download_segmented_without_range_support():
+    data = b'0123456789' * 1000
+    with _serve_files({'/file.bin': data}, accept_ranges=False) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname, 'file.bin')
+        connection_pool = downloads.HTTPConnectionPool()
+        downloads._download_if_needed(file_path,
+                                      base_url + '/file.bin',
+                                      None,
+                                      connection_pool,
+                                      segments=4)
+        connection_pool.close()
+        assert file_path.read_bytes() == data
+
+
+@pytest.mark.parametrize('hash_threads', [1, 4])
+def test_check_downloads_single_pass(hash_threads):
+    data = bytes(range(256)) * 3000
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache_dir = Path(tmpdirname)
+        (cache_dir / 'component.tar').write_bytes(data)
+        (cache_dir / 'component.tar.hashes').write_text(''.join(
+            '{}  {}  component.tar\n'.format(name,
+                                             hashlib.new(name, data).hexdigest())
+            for name in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')))
+        ini_path = cache_dir / 'downloads.ini'
+        ini_path.write_text('[component]\nurl = https://localhost/component.tar\n'
+                            'download_filename = component.tar\n'
+                            'hash_url = chromium|component.tar.hashes|'
+                            'https://localhost/component.tar.hashes\n'
+                            'output_path = component\n')
+        info = downloads.DownloadInfo([ini_path])
+        downloads.check_downloads(info, cache_dir, None, chunk_bytes=4096,
+                                  hash_threads=hash_threads)
+
+        (cache_dir / 'component.tar').write_bytes(data[:-1] + b'\x00')
+        with pytest.raises(downloads.HashMismatchError):
+            downloads.check_downloads(info, cache_dir, None, chunk_bytes=4096,
+                                      hash_threads=hash_threads)
+
+
+def test_retrieve_downloads_verify_during_download():
+    files = {'component0': b'a' * 300000, 'component1': b'b' * 300000}
+    served_files = {'/{}.tar'.format(name): data for name, data in files.items()}
+    with _serve_files(served_files) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        _write_downloads_ini(ini_path, base_url, files)
+        # Resumed downloads must include the existing partial content in the hashes
+        (cache_dir / 'component1.tar.partial').write_bytes(files['component1'][:1234])
+        info = downloads.DownloadInfo([ini_path])
+        assert downloads.retrieve_downloads(info, cache_dir, None, False,
+                                            verify_hashes=True) == {'component0', 'component1'}
+        # Existing files are not verified while downloading
+        assert not downloads.retrieve_downloads(info, cache_dir, None, False, verify_hashes=True)
+
+        (cache_dir / 'component0.tar').unlink()
+        served_files['/component0.tar'] = b'c' * 300000
+        with pytest.raises(downloads.HashMismatchError):
+            downloads.retrieve_downloads(info, cache_dir, None, False, verify_hashes=True)
+
+
+def test_check_downloads_verified_sidecar(monkeypatch):
+    data = b'0123456789' * 1000
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache_dir = Path(tmpdirname)
+        download_path = cache_dir / 'component.tar'
+        download_path.write_bytes(data)
+        ini_path = cache_dir / 'downloads.ini'
+        _write_downloads_ini(ini_path, 'https://localhost', {'component': data})
+        info = downloads.DownloadInfo([ini_path])
+        downloads.check_downloads(info, cache_dir, None)
+        assert (cache_dir / 'component.tar.verified').exists()
+
+        hashed_files = []
+        orig_hash_file = downloads.hash_file
+        monkeypatch.setattr(downloads, 'hash_file',
+                            lambda *args: hashed_files.append(args[0]) or orig_hash_file(*args))
+
+        # Hashing is skipped while the file and the expected hashes are unchanged
+        downloads.check_downloads(info, cache_dir, None)
+        assert not hashed_files
+        downloads.check_downloads(info, cache_dir, None, force_verify=True)
+        assert hashed_files == [download_path]
+
+        # Changing the expected hashes invalidates the sidecar
+        _write_downloads_ini(ini_path, 'https://localhost', {'component': b'other'})
+        with pytest.raises(downloads.HashMismatchError):
+            downloads.check_downloads(downloads.DownloadInfo([ini_path]), cache_dir, None)
+        assert not (cache_dir / 'component.tar.verified').exists()
+
+        # Changing the file invalidates the sidecar
+        downloads.check_downloads(info, cache_dir, None)
+        download_path.write_bytes(data + b'0')
+        with pytest.raises(downloads.HashMismatchError):
+            downloads.check_downloads(info, cache_dir, None)
+
+
+def test_retrieve_downloads_shared_cache():
+    files = {'component0': b'a' * 100000, 'component1': b'b' * 100000}
+    served_files = {'/{}.tar'.format(name): data for name, data in files.items()}
+    with _serve_files(served_files) as (server, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        _write_downloads_ini(ini_path, base_url, files)
+        info = downloads.DownloadInfo([ini_path])
+        shared_cache = _cache.SharedCache(Path(tmpdirname, 'shared'))
+        cache_dirs = [Path(tmpdirname, 'job0'), Path(tmpdirname, 'job1')]
+        for cache_dir in cache_dirs:
+            cache_dir.mkdir()
+
+        assert not downloads.retrieve_downloads(
+            info, cache_dirs[0], None, False, shared_cache=shared_cache)
+        downloads.check_downloads(info, cache_dirs[0], None, shared_cache=shared_cache)
+        assert len(server.requests) == 2
+
+        # Downloads in the shared cache are hardlinked without downloading or hashing
+        verified = downloads.retrieve_downloads(info,
+                                                cache_dirs[1],
+                                                None,
+                                                None,
+                                                shared_cache=shared_cache)
+        assert verified == set(files)
+        assert len(server.requests) == 2
+        for name, data in files.items():
+            download_path = cache_dirs[1] / '{}.tar'.format(name)
+            assert download_path.read_bytes() == data
+            assert download_path.samefile(cache_dirs[0] / '{}.tar'.format(name))
+            hash_pairs = [('sha256', hashlib.sha256(data).hexdigest())]
+            assert downloads.is_verified(download_path, hash_pairs)
+
+
+def test_shared_cache_eviction():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        shared_cache = _cache.SharedCache(Path(tmpdirname, 'shared'), size_budget=250)
+        keys = []
+        for index in range(3):
+            download_path = Path(tmpdirname, '{}.tar'.format(index))
+            download_path.write_bytes(bytes([index]) * 100)
+            keys.append(_cache.get_cache_key([('md5', 'ab' * 16), ('sha256', str(index) * 64)]))
+            if index == 2:
+                # Using an object makes it the most recently used
+                assert shared_cache.fetch(keys[0], Path(tmpdirname, 'fetched0.tar'))
+            shared_cache.store(keys[index], download_path)
+        assert keys[0] == ('sha256', '0' * 64)
+        # The least recently used object is evicted to fit the size budget
+        assert not shared_cache.fetch(keys[1], Path(tmpdirname, 'missing.tar'))
+        assert shared_cache.fetch(keys[2], Path(tmpdirname, 'fetched2.tar'))
+
+        stray_path = Path(tmpdirname, 'shared', 'objects', 'sha256', 'ff', 'f' * 64)
+        stray_path.parent.mkdir()
+        stray_path.write_bytes(b'stray')
+        assert shared_cache.collect_garbage() == 200
+        assert not stray_path.exists()
+        assert shared_cache.collect_garbage(100) == 100
+        assert not shared_cache.fetch(keys[0], Path(tmpdirname, 'missing.tar'))
+        assert _cache.parse_size('50G') == 50 << 30
+
+
+def test_rank_mirrors():
+    data = b'0123456789' * 10000
+    with _serve_files({'/file.bin': data}, latency=0.3) as (_, slow_url), \
+            _serve_files({'/file.bin': data}) as (_, fast_url), \
+            _serve_files({'/file.bin': data}, latency=0.1) as (_, medium_url), \
+            _serve_files({}) as (_, missing_url):
+        urls = [url + '/file.bin' for url in (missing_url, slow_url, fast_url, medium_url)]
+        connection_pool = downloads.HTTPConnectionPool()
+        assert downloads.rank_mirrors(urls, connection_pool) == [urls[2], urls[3], urls[1], urls[0]]
+        connection_pool.close()
+
+
+def test_download_mirror_failover():
+    data = bytes(range(256)) * 2000
+    with _serve_files({'/file.bin': data}, stall_after=100000) as (stall_server, stall_url), \
+            _serve_files({'/file.bin': data}, latency=0.2) as (slow_server, slow_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname, 'file.bin')
+        hasher = downloads.MultiHasher([('sha256', hashlib.sha256(data).hexdigest())])
+        connection_pool = downloads.HTTPConnectionPool(timeout=0.5)
+        # The lowest latency mirror is tried first regardless of its position
+        assert downloads._download_if_needed(file_path,
+                                             slow_url + '/file.bin',
+                                             None,
+                                             connection_pool,
+                                             hasher=hasher,
+                                             mirror_urls=[stall_url + '/file.bin'])
+        connection_pool.close()
+        assert file_path.read_bytes() == data
+        hasher.verify(file_path)
+        assert stall_server.requests[-1] == ('/file.bin', None)
+        # The download is resumed from the next mirror after the stall
+        assert slow_server.requests[-1] == ('/file.bin', 'bytes=100000-')
+
+
+def test_download_info_mirror_urls():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        ini_path.write_text('[component]\nurl = https://example.com/a.tar\n'
+                            'mirror_urls =\n    https://mirror1.example.com/a.tar\n'
+                            '    https://mirror2.example.com/a.tar\n'
+                            'download_filename = a.tar\noutput_path = a\n\n'
+                            '[other]\nurl = https://example.com/b.tar\n'
+                            'download_filename = b.tar\noutput_path = b\n')
+        info = downloads.DownloadInfo([ini_path])
+        assert info['component'].get_mirror_urls() == [
+            'https://mirror1.example.com/a.tar', 'https://mirror2.example.com/a.tar'
+        ]
+        assert not info['other'].get_mirror_urls()
+
+
+def test_metrics_json():
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar_file:
+        tarinfo = tarfile.TarInfo('component/file.txt')
+        tarinfo.size = 5
+        tar_file.addfile(tarinfo, io.BytesIO(b'hello'))
+    files = {'component': archive.getvalue()}
+    with _serve_files({'/component.tar': files['component']}) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        _write_downloads_ini(ini_path, base_url, files)
+        with ini_path.open('a') as ini_file:
+            ini_file.write('strip_leading_dirs = component\n')
+        info = downloads.DownloadInfo([ini_path])
+        Path(tmpdirname, 'out').mkdir()
+        metrics_path = Path(tmpdirname, 'metrics.jsonl')
+        downloads.get_metrics().open(metrics_path)
+        try:
+            downloads.retrieve_downloads(info, cache_dir, None, False)
+            downloads.check_downloads(info, cache_dir, None)
+            downloads.unpack_downloads(info, cache_dir, None, Path(tmpdirname, 'out'), False, None)
+        finally:
+            downloads.get_metrics().close()
+        assert Path(tmpdirname, 'out', 'component', 'file.txt').read_bytes() == b'hello'
+
+        events = [json.loads(line) for line in metrics_path.read_text().splitlines()]
+        phase_ends = [event for event in events if event['event'] == 'phase_end']
+        assert [event['phase'] for event in phase_ends] == ['download', 'verify', 'unpack']
+        for event in phase_ends:
+            assert event['component'] == 'component'
+            assert event['status'] == 'ok'
+            assert event['bytes'] == len(files['component'])
+            assert event['seconds'] >= 0
+        # The last progress of each phase
+        progress = {
+            event['phase']: (event['bytes'], event['total_bytes'])
+            for event in events if event['event'] == 'progress'
+        }
+        assert progress == dict.fromkeys(('download', 'verify', 'unpack'),
+                                         (len(files['component']), len(files['component'])))
+
+
+def test_progress_reporter_rate_limit(capsys):
+    progress = _metrics.ProgressReporter('download', 'component')
+    for current_bytes in range(0, 1001, 10):
+        progress(current_bytes, 1000)
+    progress.finish()
+    status_lines = capsys.readouterr().out.split('\r')[1:]
+    # The first report is printed, and the final one regardless of the rate limit
+    assert len(status_lines) == 2
+    assert status_lines[-1].startswith('Progress: 100.0% of 1000 B')
+    assert status_lines[-1].endswith('\n')
+
+
+def _make_tar(files, mode='w'):
+    """Returns the data of a tar archive of the dict of member names to their data"""
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode=mode) as tar_file:
+        for name, data in files.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar_file.addfile(tarinfo, io.BytesIO(data))
+    return archive.getvalue()
+
+
+@pytest.mark.parametrize('download_filename,mode', [('component.tar', 'w'),
+                                                    ('component.tarball', 'w:gz')])
+def test_fetch_unpack_downloads(download_filename, mode):
+    # The unknown suffix of component.tarball is extracted by the Python extractor
+    data = _make_tar({
+        'component/dir/file.txt': b'hello',
+        'component/other.txt': b'x' * 300000
+    }, mode)
+    with _serve_files({'/' + download_filename: data}) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        ini_path.write_text('[component]\nurl = {}/{}\ndownload_filename = {}\nsha256 = {}\n'
+                            'output_path = third_party/component\n'
+                            'strip_leading_dirs = component\n'.format(
+                                base_url, download_filename, download_filename,
+                                hashlib.sha256(data).hexdigest()))
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        output_dir = Path(tmpdirname, 'out')
+        (output_dir / 'third_party' / 'component').mkdir(parents=True)
+        (output_dir / 'third_party' / 'component' / 'existing.txt').write_text('existing')
+        info = downloads.DownloadInfo([ini_path])
+        # The partial download is fed to the extractor before the rest is downloaded
+        (cache_dir / (download_filename + '.partial')).write_bytes(data[:1000])
+        downloads.fetch_unpack_downloads(info, cache_dir, None, output_dir, False, None,
+                                         show_progress=False)
+        assert (cache_dir / download_filename).read_bytes() == data
+        assert downloads.is_verified(cache_dir / download_filename,
+                                     [('sha256', hashlib.sha256(data).hexdigest())])
+        component_dir = output_dir / 'third_party' / 'component'
+        assert (component_dir / 'dir' / 'file.txt').read_bytes() == b'hello'
+        assert (component_dir / 'other.txt').read_bytes() == b'x' * 300000
+        assert (component_dir / 'existing.txt').read_text() == 'existing'
+        assert sorted(path.name for path in output_dir.iterdir()) == ['third_party']
+
+        # Existing downloads are unpacked from the cache
+        Path(tmpdirname, 'out2', 'third_party').mkdir(parents=True)
+        downloads.fetch_unpack_downloads(info, cache_dir, None, Path(tmpdirname, 'out2'), False,
+                                         None)
+        assert Path(tmpdirname, 'out2', 'third_party', 'component', 'dir',
+                    'file.txt').read_bytes() == b'hello'
+
+        # The output directory is created if it does not exist
+        cache_dir = Path(tmpdirname, 'cache3')
+        cache_dir.mkdir()
+        output_dir = Path(tmpdirname, 'build', 'src')
+        downloads.fetch_unpack_downloads(info, cache_dir, None, output_dir, False, None,
+                                         show_progress=False)
+        assert (output_dir / 'third_party' / 'component' /
+                'other.txt').read_bytes() == b'x' * 300000
+
+
+def test_fetch_unpack_cli_unpack_error(monkeypatch):
+    data = _make_tar({'component/file.txt': b'hello'})
+    with _serve_files({'/component.tar': data}) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        _write_downloads_ini(ini_path, base_url, {'component': data})
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        # The output directory cannot be created over a file
+        output_dir = Path(tmpdirname, 'out')
+        output_dir.write_text('not a directory')
+        monkeypatch.setattr(sys, 'argv', [
+            'downloads.py', 'fetch-unpack', '-i',
+            str(ini_path), '-c',
+            str(cache_dir),
+            str(output_dir), '--hide-progress-bar'
+        ])
+        with pytest.raises(SystemExit) as exc_info:
+            downloads.main()
+        assert exc_info.value.code == 1
+
+
+def test_fetch_unpack_downloads_quarantine():
+    data = _make_tar({'component/file.txt': b'hello'})
+    with _serve_files({'/component.tar': data}) as (_, base_url), \
+            tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        _write_downloads_ini(ini_path, base_url, {'component': b'other data'})
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        output_dir = Path(tmpdirname, 'out')
+        output_dir.mkdir()
+        quarantine_dir = Path(tmpdirname, 'quarantine')
+        info = downloads.DownloadInfo([ini_path])
+        with pytest.raises(downloads.HashMismatchError):
+            downloads.fetch_unpack_downloads(info,
+                                             cache_dir,
+                                             None,
+                                             output_dir,
+                                             False,
+                                             None,
+                                             show_progress=False,
+                                             quarantine_dir=quarantine_dir)
+        assert not list(output_dir.iterdir())
+        assert (quarantine_dir / 'component' / 'component' / 'file.txt').read_bytes() == b'hello'
+
+        with pytest.raises(downloads.HashMismatchError):
+            downloads.fetch_unpack_downloads(info,
+                                             cache_dir,
+                                             None,
+                                             output_dir,
+                                             False,
+                                             None,
+                                             show_progress=False)
+        assert not list(output_dir.iterdir())
+
+
+def test_unpack_downloads_concurrent():
+    files = {
+        'component{}'.format(index): _make_tar({'component/file{}.txt'.format(index): b'data'})
+        for index in range(4)
+    }
+    output_paths = {
+        'component0': 'third_party/a',
+        'component1': 'third_party/a/b',
+        'component2': 'third_party/c',
+        'component3': 'third_party',
+    }
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        output_dir = Path(tmpdirname, 'out')
+        (output_dir / 'third_party' / 'a').mkdir(parents=True)
+        with ini_path.open('w') as ini_file:
+            for name, data in files.items():
+                (cache_dir / '{}.tar'.format(name)).write_bytes(data)
+                ini_file.write('[{}]\nurl = https://localhost/{}.tar\ndownload_filename = {}.tar\n'
+                               'output_path = {}\nstrip_leading_dirs = component\n\n'.format(
+                                   name, name, name, output_paths[name]))
+        info = downloads.DownloadInfo([ini_path])
+        assert [[name for name, _ in group]
+                for group in _unpacking._group_overlapping_downloads(list(info.properties_iter()))
+                ] == [['component3', 'component0', 'component1', 'component2']]
+        assert [[name for name, _ in group] for group in _unpacking._group_overlapping_downloads(
+            list(info.properties_iter())[1:])] == [['component0', 'component1'], ['component2']]
+
+        downloads.unpack_downloads(info, cache_dir, None, output_dir, False, None, jobs=3)
+        assert (output_dir / 'third_party' / 'a' / 'file0.txt').read_bytes() == b'data'
+        assert (output_dir / 'third_party' / 'a' / 'b' / 'file1.txt').read_bytes() == b'data'
+        assert (output_dir / 'third_party' / 'c' / 'file2.txt').read_bytes() == b'data'
+        assert (output_dir / 'third_party' / 'file3.txt').read_bytes() == b'data'
+
+
+def test_unpack_downloads_verify(monkeypatch):
+    data = _make_tar({'component/file.txt': b'hello'})
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        _write_downloads_ini(ini_path, 'https://localhost', {'component': data})
+        with ini_path.open('a') as ini_file:
+            ini_file.write('strip_leading_dirs = component\n')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        output_dir = Path(tmpdirname, 'out')
+        output_dir.mkdir()
+        info = downloads.DownloadInfo([ini_path])
+
+        # A corrupt archive is not unpacked
+        (cache_dir / 'component.tar').write_bytes(data[:-1] + b'\x01')
+        with pytest.raises(downloads.HashMismatchError):
+            downloads.unpack_downloads(info, cache_dir, None, output_dir, False, None, verify=True)
+        assert not list(output_dir.iterdir())
+
+        # The archive is read once for hashing and unpacking
+        (cache_dir / 'component.tar').write_bytes(data)
+        read_paths = []
+        # The module imported by downloads, not the one of this package
+        unpacking_module = sys.modules[downloads.unpack_downloads.__module__]
+        original_hash_file = unpacking_module.hash_file
+
+        def _hash_file(file_path, *args, **kwargs):
+            read_paths.append(file_path)
+            original_hash_file(file_path, *args, **kwargs)
+
+        monkeypatch.setattr(unpacking_module, 'hash_file', _hash_file)
+        downloads.unpack_downloads(info, cache_dir, None, output_dir, False, None, verify=True)
+        assert read_paths == [cache_dir / 'component.tar']
+        assert (output_dir / 'component' / 'file.txt').read_bytes() == b'hello'
+        assert sorted(path.name for path in output_dir.iterdir()) == ['component']
+        assert downloads.is_verified(cache_dir / 'component.tar',
+                                     [('sha256', hashlib.sha256(data).hexdigest())])
+
+        # Verified downloads are not hashed again
+        downloads.unpack_downloads(info, cache_dir, None, output_dir, False, None, verify=True)
+        assert len(read_paths) == 1
+
+
+def test_unpack_downloads_verify_new_output_dir():
+    data = _make_tar({'component/file.txt': b'hello'})
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        _write_downloads_ini(ini_path, 'https://localhost', {'component': data})
+        with ini_path.open('a') as ini_file:
+            ini_file.write('strip_leading_dirs = component\n')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        (cache_dir / 'component.tar').write_bytes(data)
+        # The output directory and its parent do not exist yet
+        output_dir = Path(tmpdirname, 'build', 'src')
+        info = downloads.DownloadInfo([ini_path])
+
+        downloads.unpack_downloads(info, cache_dir, None, output_dir, False, None, verify=True)
+        assert (output_dir / 'component' / 'file.txt').read_bytes() == b'hello'
+        assert sorted(path.name for path in output_dir.iterdir()) == ['component']
+
+
+def test_unpack_pristine():
+    data = _make_tar({'component/file.txt': b'hello'})
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        _write_downloads_ini(ini_path, 'https://localhost', {'component': data})
+        with ini_path.open('a') as ini_file:
+            ini_file.write('strip_leading_dirs = component\n')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        (cache_dir / 'component.tar').write_bytes(data)
+        pristine_dir = Path(tmpdirname, 'pristine')
+        info = downloads.DownloadInfo([ini_path])
+
+        downloads.unpack_pristine(info, cache_dir, None, pristine_dir, Path(tmpdirname, 'out1'),
+                                  False, None)
+        assert (pristine_dir / 'component' / 'file.txt').read_bytes() == b'hello'
+        assert Path(tmpdirname, 'out1', 'component', 'file.txt').read_bytes() == b'hello'
+        assert not Path(tmpdirname, 'out1', '.pristine.json').exists()
+
+        # The pristine tree is reused while the downloads are unchanged
+        pristine_inode = (pristine_dir / 'component' / 'file.txt').stat().st_ino
+        downloads.unpack_pristine(info, cache_dir, None, pristine_dir, Path(tmpdirname, 'out2'),
+                                  False, None)
+        assert (pristine_dir / 'component' / 'file.txt').stat().st_ino == pristine_inode
+        assert Path(tmpdirname, 'out2', 'component', 'file.txt').read_bytes() == b'hello'
+
+        # It is replaced otherwise
+        data = _make_tar({'component/file.txt': b'changed'})
+        _write_downloads_ini(ini_path, 'https://localhost', {'component': data})
+        with ini_path.open('a') as ini_file:
+            ini_file.write('strip_leading_dirs = component\n')
+        (cache_dir / 'component.tar').write_bytes(data)
+        info = downloads.DownloadInfo([ini_path])
+        downloads.unpack_pristine(info, cache_dir, None, pristine_dir, Path(tmpdirname, 'out3'),
+                                  False, None)
+        assert Path(tmpdirname, 'out3', 'component', 'file.txt').read_bytes() == b'changed'
+        assert Path(tmpdirname, 'out1', 'component', 'file.txt').read_bytes() == b'hello'
+
+        with pytest.raises(FileExistsError):
+            downloads.unpack_pristine(info, cache_dir, None, pristine_dir,
+                                      Path(tmpdirname, 'out1'), False, None)
+
+
+def test_unpack_downloads_update_existing():
+    old_files = {
+        'chromium/unchanged.txt': b'same',
+        'chromium/changed.txt': b'old!',
+        'chromium/removed.txt': b'removed',
+        'chromium/removed_dir/file.txt': b'removed',
+    }
+    new_files = {
+        'chromium/unchanged.txt': b'same',
+        'chromium/changed.txt': b'new!',
+        'chromium/added/file.txt': b'added',
+    }
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        ini_path = Path(tmpdirname, 'downloads.ini')
+        with ini_path.open('w') as ini_file:
+            ini_file.write('[chromium]\nurl = https://localhost/chromium.tar\n'
+                           'download_filename = chromium.tar\noutput_path = ./\n'
+                           'strip_leading_dirs = chromium\n\n'
+                           '[node]\nurl = https://localhost/node.tar\n'
+                           'download_filename = node.tar\noutput_path = third_party/node\n')
+        cache_dir = Path(tmpdirname, 'cache')
+        cache_dir.mkdir()
+        output_dir = Path(tmpdirname, 'src')
+        output_dir.mkdir()
+        info = downloads.DownloadInfo([ini_path])
+        (cache_dir / 'chromium.tar').write_bytes(_make_tar(old_files))
+        downloads.unpack_downloads(info, cache_dir, ['chromium'], output_dir, False, None)
+        # Files of other components and build outputs are kept
+        (output_dir / 'third_party' / 'node').mkdir(parents=True)
+        (output_dir / 'third_party' / 'node' / 'node.bin').write_bytes(b'node')
+        (output_dir / 'out' / 'Default').mkdir(parents=True)
+        (output_dir / 'out' / 'Default' / 'build.ninja').write_bytes(b'ninja')
+        for path in output_dir.rglob('*.txt'):
+            os.utime(str(path), (1000000000, 1000000000))
+        # Changed files are replaced, not modified in place
+        os.link(str(output_dir / 'changed.txt'), str(Path(tmpdirname, 'changed_link.txt')))
+
+        (cache_dir / 'chromium.tar').write_bytes(_make_tar(new_files))
+        downloads.unpack_downloads(info,
+                                   cache_dir, ['chromium'],
+                                   output_dir,
+                                   False,
+                                   None,
+                                   update_existing=True)
+        assert sorted(path.relative_to(output_dir).as_posix()
+                      for path in output_dir.rglob('*') if path.is_file()) == [
+                          'added/file.txt', 'changed.txt', 'out/Default/build.ninja',
+                          'third_party/node/node.bin', 'unchanged.txt'
+                      ]
+        assert not (output_dir / 'removed_dir').exists()
+        assert (output_dir / 'changed.txt').read_bytes() == b'new!'
+        assert Path(tmpdirname, 'changed_link.txt').read_bytes() == b'old!'
+        assert (output_dir / 'unchanged.txt').stat().st_mtime == 1000000000
@@ -0,0 +1,295 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import io
+import lzma
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from .. import _extraction, _zstdtar
+
+
+def _write_tar(archive_path, files, mode):
+    with tarfile.open(str(archive_path), mode) as tar_file:
+        for name, data in files.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar_file.addfile(tarinfo, io.BytesIO(data))
+
+
+def _record_progress():
+    """Returns a list of the reported (read_bytes, total_bytes) and the callable reporting them"""
+    reports = []
+    return reports, lambda *report: reports.append(report)
+
+
+def _check_progress(reports, archive_path):
+    """Checks the (read_bytes, total_bytes) reported while unpacking archive_path"""
+    size = archive_path.stat().st_size
+    assert reports[-1] == (size, size)
+    assert [x for x, _ in reports] == sorted(x for x, _ in reports)
+
+
+def _list_tree(root):
+    return {
+        path.relative_to(root).as_posix(): path.read_bytes()
+        for path in root.rglob('*') if path.is_file()
+    }
+
+
+@pytest.mark.parametrize('suffix,mode', [('.tar.xz', 'w:xz'), ('.tar.gz', 'w:gz')])
+def test_extract_tar_with_parallel_decompressor(suffix, mode):
+    tar_bin = shutil.which('tar')
+    if tar_bin is None:
+        pytest.skip('tar is not available')
+    if _extraction.get_parallel_decompressor(Path(suffix).suffix) is None:
+        pytest.skip('No parallel decompressor for {}'.format(suffix))
+    files = {
+        'src/chrome/file.txt': b'chrome',
+        'src/third_party/instrumented_libs/file.txt': b'unused',
+    }
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, 'archive' + suffix)
+        _write_tar(archive_path, files, mode)
+        trees = []
+        for parallel in (True, False):
+            output_dir = Path(tmpdirname, 'parallel' if parallel else 'serial')
+            reports, progress = _record_progress()
+            _extraction._extract_tar_with_tar(tar_bin,
+                                              archive_path,
+                                              output_dir,
+                                              Path('src'),
+                                              True,
+                                              None,
+                                              parallel=parallel,
+                                              progress=progress)
+            _check_progress(reports, archive_path)
+            trees.append(_list_tree(output_dir))
+        assert trees[0] == trees[1] == {'chrome/file.txt': b'chrome'}
+
+
+def test_extract_tar_with_tar_progress():
+    tar_bin = shutil.which('tar')
+    if tar_bin is None:
+        pytest.skip('tar is not available')
+    files = {'src/file.bin': os.urandom(1000000)}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        # The compression of archives written to tar through a pipe is not told by their name
+        for name, mode in (('archive.tar', 'w'), ('archive.tar.bz2', 'w:bz2'),
+                           ('gzip.tar', 'w:gz')):
+            archive_path = Path(tmpdirname, name)
+            _write_tar(archive_path, files, mode)
+            output_dir = Path(tmpdirname, name + '.out')
+            reports, progress = _record_progress()
+            _extraction._extract_tar_with_tar(tar_bin,
+                                              archive_path,
+                                              output_dir,
+                                              Path('src'),
+                                              False,
+                                              None,
+                                              parallel=False,
+                                              progress=progress)
+            _check_progress(reports, archive_path)
+            assert len(reports) > 1
+            assert _list_tree(output_dir) == {'file.bin': files['src/file.bin']}
+
+        # Failures of tar are still detected
+        archive_path = Path(tmpdirname, 'corrupt.tar')
+        archive_path.write_bytes(b'\x1f\x8b' + bytes(100000))
+        with pytest.raises(Exception):
+            _extraction._extract_tar_with_tar(tar_bin,
+                                              archive_path,
+                                              Path(tmpdirname, 'corrupt'),
+                                              None,
+                                              False,
+                                              None,
+                                              parallel=False,
+                                              progress=lambda *x: None)
+
+
+def test_extract_tar_with_failing_decompressor():
+    tar_bin = shutil.which('tar')
+    if tar_bin is None or _extraction.get_parallel_decompressor('.xz') is None:
+        pytest.skip('tar or a parallel xz decompressor is not available')
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, 'archive.tar.xz')
+        archive_path.write_bytes(b'not an xz archive')
+        with pytest.raises(Exception):
+            _extraction._extract_tar_with_tar(tar_bin, archive_path, Path(tmpdirname, 'out'),
+                                              None, False, None)
+
+
+def test_extract_tar_with_python(monkeypatch):
+    # Files larger than this are streamed by the reading thread
+    monkeypatch.setattr(_extraction, '_INLINE_WRITE_SIZE', 100)
+    written_types = {}
+
+    def _write_file(path, data, tarinfo):
+        written_types[path.name] = type(data)
+        _extraction._write_member_file(path, data, tarinfo)
+
+    monkeypatch.setattr(_extraction._TarMemberExtractor, '_write_file', staticmethod(_write_file))
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, 'archive.tar.gz')
+        with tarfile.open(str(archive_path), 'w:gz') as tar_file:
+            tarinfo = tarfile.TarInfo('src/dir')
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0o755
+            tar_file.addfile(tarinfo)
+            for name, data in (('src/dir/small.txt', b'old'), ('src/dir/large.bin', bytes(1000)),
+                               ('src/dir/small.txt', b'new'),
+                               ('src/third_party/instrumented_libs/unused.txt', b'unused'),
+                               ('src/tool.sh', b'#!/bin/sh\n')):
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                tarinfo.mode = 0o755 if name.endswith('.sh') else 0o644
+                tarinfo.mtime = 1000000000
+                tar_file.addfile(tarinfo, io.BytesIO(data))
+            tarinfo = tarfile.TarInfo('src/hardlink.txt')
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = 'src/dir/small.txt'
+            tar_file.addfile(tarinfo)
+            tarinfo = tarfile.TarInfo('src/symlink.txt')
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = 'dir/large.bin'
+            tar_file.addfile(tarinfo)
+        output_dir = Path(tmpdirname, 'out')
+        output_dir.mkdir()
+        reports, progress = _record_progress()
+        _extraction._extract_tar_with_python(archive_path, output_dir, Path('src'), True, None,
+                                             progress)
+        _check_progress(reports, archive_path)
+
+        assert _list_tree(output_dir) == {
+            'dir/small.txt': b'new',
+            'dir/large.bin': bytes(1000),
+            'hardlink.txt': b'new',
+            'symlink.txt': bytes(1000),
+            'tool.sh': b'#!/bin/sh\n',
+        }
+        assert not (output_dir / 'third_party').exists()
+        assert (output_dir / 'hardlink.txt').samefile(output_dir / 'dir' / 'small.txt')
+        assert (output_dir / 'symlink.txt').is_symlink()
+        assert (output_dir / 'tool.sh').stat().st_mode & 0o777 == 0o755
+        assert (output_dir / 'dir' / 'small.txt').stat().st_mtime == 1000000000
+        # Only small files are read into memory
+        assert written_types['small.txt'] is bytes
+        assert written_types['large.bin'] is not bytes
+
+
+def test_update_tar_file_streamed(monkeypatch):
+    monkeypatch.setattr(_extraction, '_INLINE_WRITE_SIZE', 100)
+    monkeypatch.setattr(_extraction, '_STREAM_CHUNK_SIZE', 64)
+    old_files = {
+        'unchanged.bin': bytes(1000),
+        'changed_late.bin': bytes(1000),
+        'changed_early.bin': bytes(1000),
+        'resized.bin': bytes(1000),
+    }
+    new_files = {
+        'unchanged.bin': bytes(1000),
+        'changed_late.bin': bytes(900) + b'x' * 100,
+        'changed_early.bin': b'x' + bytes(999),
+        'resized.bin': bytes(2000),
+    }
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, 'archive.tar')
+        output_dir = Path(tmpdirname, 'out')
+        _write_tar(archive_path, old_files, 'w')
+        _extraction.extract_tar_file(archive_path, output_dir, None, False, None)
+        # Changed files are replaced, not modified in place
+        os.link(str(output_dir / 'changed_late.bin'), str(Path(tmpdirname, 'link.bin')))
+
+        _write_tar(archive_path, new_files, 'w')
+        counts = _extraction.update_tar_file(archive_path, output_dir, None, False, None)
+        assert counts == {'unchanged': 1, 'written': 3, 'removed': 0}
+        assert _list_tree(output_dir) == new_files
+        assert Path(tmpdirname, 'link.bin').read_bytes() == bytes(1000)
+
+
+def test_extract_multi_block_xz_with_python(monkeypatch):
+    files = {'src/dir/file{}.bin'.format(index): os.urandom(30000) for index in range(10)}
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode='w') as tar_file:
+        for name, data in files.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar_file.addfile(tarinfo, io.BytesIO(data))
+    tar_data = tar_data.getvalue()
+    # The module imported by _extraction, not the one of this package
+    xz_module = sys.modules[_extraction.open_parallel_xz.__module__]
+    # Limit the blocks decompressed ahead
+    monkeypatch.setattr(xz_module, '_MAX_PENDING_SIZE', 100000)
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, 'archive.tar.xz')
+        archive_path.write_bytes(lzma.compress(tar_data))
+        assert xz_module.open_parallel_xz(archive_path) is None
+
+        # Concatenated streams have a block each
+        with archive_path.open('wb') as archive_file:
+            for offset in range(0, len(tar_data), 40000):
+                archive_file.write(lzma.compress(tar_data[offset:offset + 40000]))
+        with xz_module.open_parallel_xz(archive_path, workers=3) as xz_reader:
+            assert xz_reader.read() == tar_data
+
+        reports, progress = _record_progress()
+        _extraction._extract_tar_with_python(archive_path, Path(tmpdirname, 'out'), Path('src'),
+                                             False, None, progress)
+        _check_progress(reports, archive_path)
+        # The blocks are reported as they are read
+        assert len(reports) > 2
+        assert _list_tree(Path(tmpdirname, 'out')) == {
+            name[len('src/'):]: data
+            for name, data in files.items()
+        }
+
+        # Corrupt blocks are detected
+        corrupt_data = bytearray(archive_path.read_bytes())
+        corrupt_data[100] ^= 0xff
+        archive_path.write_bytes(corrupt_data)
+        with pytest.raises(lzma.LZMAError):
+            _extraction._extract_tar_with_python(archive_path, Path(tmpdirname, 'corrupt'),
+                                                 Path('src'), False, None)
+
+
+def test_extract_zstd_archive():
+    if shutil.which('zstd') is None and _zstdtar.zstd_module is None:
+        pytest.skip('zstd is not available')
+    files = {'src/dir/file.txt': b'hello', 'src/other.txt': b'x' * 100000}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        archive_path = Path(tmpdirname, 'archive.tar.zst')
+        with _zstdtar.open_zstd_tar(archive_path, 'w', level=1) as tar_file:
+            for name, data in files.items():
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                tar_file.addfile(tarinfo, io.BytesIO(data))
+        assert archive_path.read_bytes().startswith(b'\x28\xb5\x2f\xfd')
+        expected_tree = {'dir/file.txt': b'hello', 'other.txt': b'x' * 100000}
+
+        output_dir = Path(tmpdirname, 'python')
+        output_dir.mkdir()
+        _extraction._extract_tar_with_python(archive_path, output_dir, Path('src'), False, None)
+        assert _list_tree(output_dir) == expected_tree
+
+        output_dir = Path(tmpdirname, 'default')
+        output_dir.mkdir()
+        _extraction.extract_tar_file(archive_path, output_dir, Path('src'), False, None)
+        assert _list_tree(output_dir) == expected_tree
+
+        output_dir = Path(tmpdirname, 'stream')
+        output_dir.mkdir()
+        stream_extractor = _extraction.TarStreamExtractor(archive_path.name, output_dir,
+                                                          Path('src'), False, None,
+                                                          {_extraction.ExtractorEnum.TAR: None})
+        stream_extractor.write(archive_path.read_bytes())
+        stream_extractor.close()
+        assert _list_tree(output_dir) == expected_tree
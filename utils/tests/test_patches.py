@@ -6,6 +6,7 @@
 
 from pathlib import Path
 import os
+import tempfile
 import shutil
 
 import pytest
@@ -38,3 +39,241 @@ def test_patch_from_env():
 
     del os.environ['PATCH_BIN']
     assert patches._find_patch_from_env() is None
+
+
+_ORIGINAL_FILES = {
+    'a.txt': ('extra1\nextra2\nextra3\n'
+              'one\ntwo\nthree\n\tint  x = 1;\nfour\nfive\nsix\nseven\neight\n'),
+    'b.txt': 'first\nlast',
+    'c.txt': 'x\r\ny\r\n',
+    'old/gone.txt': 'bye\n',
+}
+
+_SERIES = {
+    # Applies at an offset and with different blanks
+    'offset.patch': ('--- a/a.txt\n+++ b/a.txt\n@@ -1,7 +1,7 @@\n'
+                     ' one\n two\n three\n-\tint x = 1;\n+\tint x = 2;\n four\n five\n six\n'),
+    # Modifies a file modified by a previous patch, and adds files
+    'add.patch': ('--- a/a.txt\n+++ b/a.txt\n@@ -6,4 +6,4 @@\n five\n six\n seven\n-eight\n+EIGHT\n'
+                  'diff --git a/tools/run.sh b/tools/run.sh\nnew file mode 100755\n'
+                  '--- /dev/null\n+++ b/tools/run.sh\n@@ -0,0 +1,2 @@\n+#!/bin/sh\n+echo run\n'
+                  '--- a/c.txt\n+++ b/c.txt\n@@ -1,2 +1,2 @@\n x\r\n-y\r\n+z\r\n'),
+    # Removes a file, and adds a newline at the end of a file
+    'remove.patch': ('--- a/old/gone.txt\n+++ /dev/null\n@@ -1 +0,0 @@\n-bye\n'
+                     '--- a/b.txt\n+++ b/b.txt\n@@ -1,2 +1,2 @@\n first\n-last\n'
+                     '\\ No newline at end of file\n+last line\n'),
+}
+
+
+def _write_series(patches_dir, series):
+    patches_dir.mkdir()
+    for name, content in series.items():
+        (patches_dir / name).write_bytes(content.encode())
+    return [patches_dir / name for name in series]
+
+
+def _make_tree(tree_path):
+    for name, content in _ORIGINAL_FILES.items():
+        (tree_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tree_path / name).write_bytes(content.encode())
+
+
+def _read_tree(tree_path):
+    """Returns a dict of the relative paths of files and directories to their content"""
+    contents = {}
+    for path in tree_path.rglob('*'):
+        if path.is_dir():
+            contents[path.relative_to(tree_path).as_posix()] = None
+        else:
+            contents[path.relative_to(tree_path).as_posix()] = (path.read_bytes(),
+                                                                bool(path.stat().st_mode & 0o100))
+    return contents
+
+
+def test_apply_patches_in_process():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        patch_paths = _write_series(Path(tmpdirname, 'patches'), _SERIES)
+        gnu_tree = Path(tmpdirname, 'gnu')
+        in_process_tree = Path(tmpdirname, 'in_process')
+        _make_tree(gnu_tree)
+        _make_tree(in_process_tree)
+        original = _read_tree(gnu_tree)
+
+        patches.apply_patches(patch_paths, gnu_tree, in_process=False)
+        assert patches.apply_patches_in_process(patch_paths, in_process_tree) == 5
+        patched = _read_tree(gnu_tree)
+        assert _read_tree(in_process_tree) == patched
+        assert patched['tools/run.sh'] == (b'#!/bin/sh\necho run\n', True)
+        assert 'old' not in patched
+
+        patches.apply_patches(patch_paths, gnu_tree, reverse=True, in_process=False)
+        patches.apply_patches(patch_paths, in_process_tree, reverse=True)
+        reversed_tree = _read_tree(gnu_tree)
+        assert _read_tree(in_process_tree) == reversed_tree
+        # Reversing restores the blanks of the patches
+        assert reversed_tree['a.txt'][0] == _ORIGINAL_FILES['a.txt'].replace('  ', ' ').encode()
+        del reversed_tree['a.txt'], original['a.txt']
+        assert reversed_tree == original
+
+
+def test_apply_patches_fallback():
+    series = dict(_SERIES)
+    # Only applies with fuzz
+    series['fuzz.patch'] = '--- a/a.txt\n+++ b/a.txt\n@@ -6,3 +6,3 @@\n five\n-six\n+SIX\n sevenX\n'
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        patch_paths = _write_series(Path(tmpdirname, 'patches'), series)
+        tree_path = Path(tmpdirname, 'tree')
+        _make_tree(tree_path)
+        with pytest.raises(patches.PatchApplicationError):
+            patches.apply_patches_in_process(patch_paths, tree_path)
+        assert _read_tree(tree_path)['a.txt'][0] == _ORIGINAL_FILES['a.txt'].encode()
+
+        patches.apply_patches(patch_paths, tree_path)
+        assert b'SIX\n' in (tree_path / 'a.txt').read_bytes()
+        assert (tree_path / 'tools' / 'run.sh').exists()
+
+
+def test_group_patches():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        patch_paths = _write_series(Path(tmpdirname, 'patches'), _SERIES)
+        assert patches.group_patches(patch_paths) == [[0, 1], [2]]
+
+        series = dict(_SERIES)
+        series['both.patch'] = ('--- a/b.txt\n+++ b/b.txt\n@@ -1 +1 @@\n-first\n+1st\n'
+                                '--- a/tools/run.sh\n+++ b/tools/run.sh\n@@ -1 +1 @@\n'
+                                '-#!/bin/sh\n+#!/bin/bash\n')
+        patch_paths = _write_series(Path(tmpdirname, 'more_patches'), series)
+        assert patches.group_patches(patch_paths) == [[0, 1, 2, 3]]
+
+
+@pytest.mark.parametrize('in_process', [True, False])
+def test_apply_patches_concurrently(in_process):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        patch_paths = _write_series(Path(tmpdirname, 'patches'), _SERIES)
+        serial_tree = Path(tmpdirname, 'serial')
+        concurrent_tree = Path(tmpdirname, 'concurrent')
+        _make_tree(serial_tree)
+        _make_tree(concurrent_tree)
+
+        patches.apply_patches(patch_paths, serial_tree, in_process=in_process)
+        patches.apply_patches(patch_paths, concurrent_tree, in_process=in_process, jobs=2)
+        assert _read_tree(concurrent_tree) == _read_tree(serial_tree)
+
+        patches.apply_patches(patch_paths, concurrent_tree, reverse=True, in_process=in_process,
+                              jobs=2)
+        assert 'tools/run.sh' not in _read_tree(concurrent_tree)
+
+
+def test_push_pop_patches():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        patches_dir = Path(tmpdirname, 'patches')
+        _write_series(patches_dir, _SERIES)
+        (patches_dir / 'series').write_text('\n'.join(_SERIES))
+        tree_path = Path(tmpdirname, 'tree')
+        _make_tree(tree_path)
+
+        assert patches.push_patches(patches_dir, tree_path, 2) == (0, 2)
+        assert patches.push_patches(patches_dir, tree_path, 3) == (0, 1)
+        state = patches.AppliedState(tree_path)
+        assert [x['name'] for x in state.entries] == list(_SERIES)
+        assert state.entries[1]['files'] == {
+            'a.txt': patches.hash_file(tree_path / 'a.txt'),
+            'c.txt': patches.hash_file(tree_path / 'c.txt'),
+            'tools/run.sh': patches.hash_file(tree_path / 'tools' / 'run.sh'),
+        }
+        assert state.entries[2]['files']['old/gone.txt'] is None
+
+        # Only the edited patch and the patches after it are applied again
+        (patches_dir / 'add.patch').write_text(_SERIES['add.patch'].replace('EIGHT', 'Eight'))
+        assert patches.push_patches(patches_dir, tree_path, 3) == (2, 2)
+        assert (tree_path / 'a.txt').read_bytes().endswith(b'seven\nEight\n')
+
+        # Out-of-band edits are detected
+        (tree_path / 'b.txt').write_text('edited\n')
+        with pytest.raises(patches.PatchStateError):
+            patches.pop_patches(tree_path, 1)
+        with pytest.raises(patches.PatchStateError):
+            patches.push_patches(patches_dir, tree_path, 1)
+        (tree_path / 'b.txt').write_text('first\nlast line\n')
+
+        patches.pop_patches(tree_path, 3)
+        assert not (tree_path / patches.STATE_DIR).exists()
+        assert (tree_path / 'old' / 'gone.txt').read_text() == 'bye\n'
+        assert not (tree_path / 'tools').exists()
+
+
+@pytest.mark.parametrize('in_process', [True, False])
+def test_patch_bundle(in_process):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        patches_dir = Path(tmpdirname, 'patches')
+        patch_paths = _write_series(patches_dir, _SERIES)
+        (patches_dir / 'series').write_text('\n'.join(_SERIES))
+        bundle_path = Path(tmpdirname, 'patches.bundle')
+        patches.merge_patches([patches_dir], bundle_path, bundle=True)
+        assert patches.is_bundle(bundle_path)
+        assert not patches.is_bundle(patches_dir / 'series')
+
+        bundle = patches.PatchBundle(bundle_path)
+        assert bundle.series == list(_SERIES)
+        assert bundle.read_patch('add.patch') == _SERIES['add.patch'].encode()
+        assert bundle.get_paths('add.patch') == ['a.txt', 'c.txt', 'tools/run.sh']
+
+        directory_tree = Path(tmpdirname, 'directory')
+        bundle_tree = Path(tmpdirname, 'bundle')
+        _make_tree(directory_tree)
+        _make_tree(bundle_tree)
+        patches.apply_patches(patch_paths, directory_tree, in_process=in_process)
+        patches.apply_patches(patches.generate_patches_from_series(bundle_path, resolve=True),
+                              bundle_tree,
+                              in_process=in_process,
+                              jobs=2)
+        assert _read_tree(bundle_tree) == _read_tree(directory_tree)
+
+        # Bundles can be merged with directories, and back into directories
+        other_dir = Path(tmpdirname, 'other')
+        _write_series(other_dir, {'other.patch': _SERIES['offset.patch']})
+        (other_dir / 'series').write_text('other.patch\n')
+        patches.merge_patches([other_dir], bundle_path, prepend=True, bundle=True)
+        assert patches.PatchBundle(bundle_path).series == ['other.patch', *_SERIES]
+        merged_dir = Path(tmpdirname, 'merged')
+        patches.merge_patches([bundle_path], merged_dir)
+        assert (merged_dir / 'series').read_text().split() == ['other.patch', *_SERIES]
+        assert (merged_dir / 'remove.patch').read_text() == _SERIES['remove.patch']
+
+
+def test_refresh_patches():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        patches_dir = Path(tmpdirname, 'patches')
+        patch_paths = _write_series(patches_dir, _SERIES)
+        (patches_dir / 'series').write_text('\n'.join(_SERIES))
+        tree_path = Path(tmpdirname, 'tree')
+        _make_tree(tree_path)
+        original = _read_tree(tree_path)
+
+        assert patches.refresh_patches(patches_dir, tree_path) == 2
+        assert _read_tree(tree_path) == original
+        refreshed = (patches_dir / 'offset.patch').read_text()
+        assert refreshed.startswith('--- a/a.txt\n+++ b/a.txt\n@@ -4,7 +4,7 @@ extra3\n')
+        assert '-\tint  x = 1;\n' in refreshed
+        refreshed_add = (patches_dir / 'add.patch').read_text()
+        assert refreshed_add.startswith('--- a/a.txt\n+++ b/a.txt\n@@ -9,4 +9,4 @@ four\n')
+        assert ('diff --git a/tools/run.sh b/tools/run.sh\nnew file mode 100755\n'
+                '--- /dev/null\n+++ b/tools/run.sh\n@@ -0,0 +1,2 @@\n' in refreshed_add)
+        # Up-to-date patches are kept as they are
+        assert (patches_dir / 'remove.patch').read_text() == _SERIES['remove.patch']
+
+        # Refreshed patches apply without offsets, and refreshing is idempotent
+        patched_tree = Path(tmpdirname, 'patched')
+        _make_tree(patched_tree)
+        patches.apply_patches(patch_paths, patched_tree, in_process=False)
+        patches.apply_patches_in_process(patch_paths, tree_path)
+        assert _read_tree(tree_path) == _read_tree(patched_tree)
+        patches.apply_patches_in_process(patch_paths, tree_path, reverse=True)
+        assert patches.refresh_patches(patches_dir, tree_path) == 0
+
+        # Patches before a conflict are refreshed
+        (patches_dir / 'offset.patch').write_text(_SERIES['offset.patch'])
+        (patches_dir / 'add.patch').write_text(_SERIES['add.patch'].replace(' seven\n', ' 7\n'))
+        with pytest.raises(patches.PatchApplicationError):
+            patches.refresh_patches(patches_dir, tree_path)
+        assert (patches_dir / 'offset.patch').read_text() == refreshed
@@ -0,0 +1,43 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import struct
+import tempfile
+from pathlib import Path
+
+from .. import prune_binaries
+
+
+def test_audit_files():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        root = Path(tmpdirname)
+        (root / 'out').mkdir()
+        (root / 'out' / 'libfoo.so').write_bytes(b'\x7fELF\x02\x01\x01' + bytes(64))
+        (root / 'out' / 'foo.exe').write_bytes(b'MZ\x90\x00' + bytes(56) + struct.pack('<I', 128) +
+                                               bytes(64) + b'PE\0\0' + bytes(16))
+        (root / 'foo.jar').write_bytes(b'PK\x03\x04' + bytes(16))
+        (root / 'foo.wasm').write_bytes(b'\x00asm\x01\x00\x00\x00')
+        (root / 'libbar.a').write_bytes(b'!<arch>\nfoo.o/')
+        (root / 'empty').touch()
+        (root / 'README').write_text('Not a binary')
+        # Files starting with MZ without a PE signature
+        (root / 'MZ_NOTES').write_text('MZ is the magic number of DOS executables.\n' * 4)
+        (root / 'truncated.exe').write_bytes(b'MZ' + bytes(58) + struct.pack('<I', 4096))
+        # Excluded by PRUNING_EXCLUDE_PATTERNS
+        (root / 'image.png').write_bytes(b'PK\x03\x04')
+        # Skipped directories
+        (root / '.git').mkdir()
+        (root / '.git' / 'index').write_bytes(b'\x7fELF')
+        # Symlinks are not followed
+        (root / 'link.so').symlink_to(root / 'out' / 'libfoo.so')
+
+        assert prune_binaries.audit_files(root, jobs=2) == [
+            ('foo.jar', 'jar/zip'),
+            ('foo.wasm', 'wasm'),
+            ('libbar.a', 'ar'),
+            ('out/foo.exe', 'PE'),
+            ('out/libfoo.so', 'ELF'),
+        ]
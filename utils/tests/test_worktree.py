@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+
+# Copyright (c) 2024 The ungoogled-chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import re
+import stat
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from .. import _worktree, domain_substitution, patches, prune_binaries
+
+
+def _make_pristine_tree(tree):
+    (tree / 'src' / 'dir').mkdir(parents=True)
+    (tree / 'src' / 'dir' / 'file.txt').write_text('see https://google.com/\n')
+    (tree / 'src' / 'other.txt').write_text('line1\nline2\n')
+    (tree / 'src' / 'pruned.bin').write_bytes(b'\0' * 10)
+    os.symlink('other.txt', str(tree / 'src' / 'link.txt'))
+    _worktree.mark_pristine(tree, {'components': {}})
+
+
+@pytest.mark.parametrize('use_reflinks', [True, False])
+def test_clone_tree(use_reflinks):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        pristine = Path(tmpdirname, 'pristine')
+        _make_pristine_tree(pristine)
+        assert _worktree.read_pristine_record(pristine) == {'components': {}}
+        if os.name == 'posix':
+            assert not pristine.joinpath('src', 'other.txt').stat().st_mode & stat.S_IWUSR
+
+        work = Path(tmpdirname, 'work')
+        counts = _worktree.clone_tree(pristine, work, jobs=2, use_reflinks=use_reflinks)
+        assert sum(counts.values()) == 3
+        if not use_reflinks:
+            assert counts['reflink'] == 0
+        assert not (work / _worktree.PRISTINE_RECORD).exists()
+        assert os.readlink(str(work / 'src' / 'link.txt')) == 'other.txt'
+        assert (work / 'src' / 'dir' / 'file.txt').read_text() == 'see https://google.com/\n'
+
+        with pytest.raises(FileExistsError):
+            _worktree.clone_tree(pristine, work)
+
+
+def test_break_link():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        pristine = Path(tmpdirname, 'pristine')
+        _make_pristine_tree(pristine)
+        work = Path(tmpdirname, 'work')
+        _worktree.clone_tree(pristine, work, use_reflinks=False)
+        work_file = work / 'src' / 'other.txt'
+        assert work_file.stat().st_nlink == 2
+
+        _worktree.break_link(work_file)
+        assert work_file.stat().st_nlink == 1
+        assert work_file.stat().st_mode & stat.S_IWUSR
+        work_file.write_text('changed\n')
+        assert (pristine / 'src' / 'other.txt').read_text() == 'line1\nline2\n'
+
+
+def test_modify_cloned_tree():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        pristine = Path(tmpdirname, 'pristine')
+        _make_pristine_tree(pristine)
+        work = Path(tmpdirname, 'work')
+        _worktree.clone_tree(pristine, work, use_reflinks=False)
+
+        assert not prune_binaries.prune_files(work / 'src', ['pruned.bin'])
+        assert (pristine / 'src' / 'pruned.bin').exists()
+
+        regex_pair = domain_substitution.DomainRegexList._regex_pair_tuple(
+            re.compile(r'google\.com'), '9oo.qjz')
+        substituted = domain_substitution._substitute_path(work / 'src' / 'dir' / 'file.txt',
+                                                           [regex_pair])
+        assert substituted[0] is not None
+        assert (work / 'src' / 'dir' / 'file.txt').read_text() == 'see https://9oo.qjz/\n'
+        assert (pristine / 'src' / 'dir' / 'file.txt').read_text() == 'see https://google.com/\n'
+
+        patch_path = Path(tmpdirname, 'change.patch')
+        patch_path.write_text('--- a/other.txt\n+++ b/other.txt\n@@ -1,2 +1,2 @@\n'
+                              ' line1\n-line2\n+patched\n')
+        patches.apply_patches([patch_path], work / 'src')
+        assert (work / 'src' / 'other.txt').read_text() == 'line1\npatched\n'
+        assert (pristine / 'src' / 'other.txt').read_text() == 'line1\nline2\n'